@@ -1,4 +1,5 @@
 import math
+import numpy as np
 #import statistics as stats
 
 class Analyzer:
@@ -27,79 +28,282 @@ class Analyzer:
             
         return min_reading
 
-def r_squared (pairs):
-    #This calculates r-squared for 4 points
-    #I split the equation into 3 variables to minimize risk of a mistake
-    length = len(pairs)
-    numerator = length*sum(x*y for x,y in pairs) - sum(x for x,_ in pairs)*sum(y for _,y in pairs)
-    denominator1 = math.sqrt( length*sum(x**2 for x,_ in pairs) - sum(x for x,_ in pairs)**2 )
-    denominator2 = math.sqrt( length*sum(y**2 for _,y in pairs) - sum(y for _,y in pairs)**2 )
-    
-    if denominator1*denominator2 != 0:
-    	combination1 = float(numerator) / float(denominator1*denominator2)
-    	combination2 = combination1**2
-    	return combination2
+class HeadingIndex(object):
+    """
+    Rotation view addressed by heading.  Ranges live in a 360 slot
+    array indexed by degree (heading mod 360), so a sweep query is
+    just the min over a slice of the array.
+
+    Sweeps are (start, stop) pairs like Analyzer.range_at_heading
+    uses: start is included, stop is not.   A sweep can wrap around
+    zero, either as (-10, 11) or as (350, 10).
+    """
+    slots = 360
+    no_reading = np.inf
+
+    def __init__(self, polar_data):
+        """Build the index from (heading, range) tuples"""
+        if polar_data:
+            headings, ranges = zip(*polar_data)
+        else:
+            headings, ranges = (), ()
+        self.load(np.asarray(headings, dtype=int), np.asarray(ranges, dtype=float))
+
+    @classmethod
+    def from_arrays(cls, headings, ranges):
+        """Build the index from heading and range arrays (like ArrayRotation.polar_array())"""
+        index = cls.__new__(cls)
+        index.load(np.asarray(headings, dtype=int), np.asarray(ranges, dtype=float))
+        return index
+
+    def load(self, headings, ranges):
+        self.ranges = np.full(HeadingIndex.slots, HeadingIndex.no_reading)
+        # if two readings land in the same slot, keep the closer one
+        np.minimum.at(self.ranges, headings % HeadingIndex.slots, ranges)
+        # a second copy back to back, so wrapping sweeps are plain slices
+        self.wrapped = np.concatenate((self.ranges, self.ranges))
+
+    @staticmethod
+    def sweep_length(start, stop):
+        """Number of headings covered by the sweep"""
+        if stop == start:
+            return 0
+        elif stop > start:
+            return min(stop - start, HeadingIndex.slots)
+        else:
+            return stop - start + HeadingIndex.slots
+
+    def range_at_heading(self, sweep):
+        """
+        Find the closest hit at a heading in the sweep.
+        Return the range and the heading as a tuple.
+        (heading, range)   (0, 0) if there is nothing in the sweep.
+        """
+        start, stop = sweep
+        first = start % HeadingIndex.slots
+        window = self.wrapped[first:first + HeadingIndex.sweep_length(start, stop)]
+        if len(window) == 0:
+            return (0, 0)
+
+        offset = int(window.argmin())
+        if window[offset] == HeadingIndex.no_reading:
+            return (0, 0)
+
+        heading = start + offset
+        if heading >= HeadingIndex.slots:
+            heading = heading - HeadingIndex.slots
+        return (heading, float(window[offset]))
+
+    def ranges_at_headings(self, sweeps):
+        """
+        Answer many sweeps in a single vectorized pass.
+        Return a list of (heading, range) tuples, one per sweep.
+        """
+        if len(sweeps) == 0:
+            return []
+
+        starts = np.array([start for start, _ in sweeps])
+        lengths = np.array([HeadingIndex.sweep_length(start, stop) for start, stop in sweeps])
+        offsets = np.arange(max(lengths.max(), 1))
+
+        # one row per sweep, padded out to the longest sweep with no_reading
+        windows = self.wrapped[(starts % HeadingIndex.slots)[:, np.newaxis] + offsets]
+        windows[offsets >= lengths[:, np.newaxis]] = HeadingIndex.no_reading
+
+        best = windows.argmin(axis=1)
+        ranges = windows[np.arange(len(sweeps)), best]
+        headings = starts + best
+        headings[headings >= HeadingIndex.slots] -= HeadingIndex.slots
+
+        return [(int(heading), float(distance)) if distance != HeadingIndex.no_reading else (0, 0)
+                for heading, distance in zip(headings, ranges)]
+
+
+def r_squared_from_sums (n, sx, sy, sxx, syy, sxy):
+    """
+    r-squared of a run of points from its sums (count, x, y, x^2, y^2, xy).
+    A perfectly horizontal or vertical run is a perfect line, so 1.0.
+    A run where every point is the same is no line at all, so 0.0.
+    """
+    numerator = n*sxy - sx*sy
+    spread_x = n*sxx - sx**2
+    spread_y = n*syy - sy**2
+    # anything this small is rounding error on a flat run
+    flat = 1e-12 * n * (sxx + syy)
+
+    if spread_x > flat and spread_y > flat:
+        return numerator**2 / (spread_x*spread_y)
+    elif spread_x > flat or spread_y > flat:
+        return 1.0
     else:
-    	print "There was a denominator of zero"
-    	return 0.0
+        return 0.0
+
+def r_squared (pairs):
+    """This calculates r-squared for a run of points in one pass"""
+    n = sx = sy = sxx = syy = sxy = 0.0
+    for x, y in pairs:
+        n, sx, sy, sxx, syy, sxy = n+1, sx+x, sy+y, sxx+x*x, syy+y*y, sxy+x*y
+    return r_squared_from_sums(n, sx, sy, sxx, syy, sxy)
+
+def sliding_r_squared (cart_data, window=4):
+    """
+    r-squared of every window of points, all in one call.
+    Entry i is the r-squared of cart_data[i:i+window].  The window sums
+    come from differences of prefix sums, so the cost is linear in the
+    number of points, whatever the window size.
+    """
+    points = np.asarray(cart_data, dtype=float).reshape(-1, 2)
+    if len(points) < window:
+        return np.zeros(0)
+
+    # centering keeps the prefix sums (and their rounding error) small
+    points = points - points.mean(axis=0)
+    x, y = points[:, 0], points[:, 1]
+    prefix = np.cumsum(np.column_stack((x, y, x*x, y*y, x*y)), axis=0)
+    prefix = np.vstack((np.zeros(5), prefix))
+    sx, sy, sxx, syy, sxy = (prefix[window:] - prefix[:-window]).T
+
+    n = float(window)
+    numerator = n*sxy - sx*sy
+    spread_x = n*sxx - sx**2
+    spread_y = n*syy - sy**2
+    flat = 64 * np.finfo(float).eps * n * (prefix[-1, 2] + prefix[-1, 3])
+
+    line = (spread_x > flat) & (spread_y > flat)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        r2 = np.where(line, numerator**2 / (spread_x*spread_y), 0.0)
+    r2[~line & ((spread_x > flat) | (spread_y > flat))] = 1.0
+    return r2
+
+def fit_segment (i, d, array):
+    """
+    Grow the window array[i:d] one point at a time while the points still
+    fit a line.  Return the end of the window that broke the fit (or ran
+    out of data).  r-squared is kept up to date with running sums, so each
+    new point costs O(1) instead of a pass over the whole window.
+    """
+    n = sx = sy = sxx = syy = sxy = 0.0
+    for x, y in array[i:d]:
+        n, sx, sy, sxx, syy, sxy = n+1, sx+x, sy+y, sxx+x*x, syy+y*y, sxy+x*y
+
+    while True:
+        r2 = r_squared_from_sums(n, sx, sy, sxx, syy, sxy)
+        if (r2 < Analyzer.r2_min) or (d >= len(array)-1):
+            return d
+        x, y = array[d]
+        n, sx, sy, sxx, syy, sxy = n+1, sx+x, sy+y, sxx+x*x, syy+y*y, sxy+x*y
+        d = d + 1
+
+def wall_segments (array):
+    """
+    The run of points that fits a line from every start, the way the old
+    recursive search grew them: the window array[i:i+4] grows one point at
+    a time until its r-squared falls below r2_min (the point that broke the
+    fit stays in the run) or the data runs out.   Returns (start, end)
+    slice indices, one pair per start.   Unlike the old search, a perfectly
+    horizontal or vertical run is a line (see r_squared_from_sums), not a
+    break.
+
+    The window sums come from prefix sums and every start grows in the
+    same vectorized step, so there is no recursion and no recomputing r2
+    over the whole window for each new point.   It is not linear: the work
+    is the total length of the runs, up to n times the longest run, which
+    is quadratic on one long straight wall (4000 points take about 0.4 s).
+    A rotation is at most 360 points: about 20 ms if every one of them is
+    on the same straight wall, about 2 ms for a scan of the field.
+    """
+    points = np.asarray(array, dtype=float).reshape(-1, 2)
+    count = len(points)
+    if count < 4:
+        return []
+    x, y = points[:, 0], points[:, 1]
+    zero = np.zeros(1)
+    px, py, pxx, pyy, pxy = [np.concatenate((zero, np.cumsum(v))) for v in (x, y, x*x, y*y, x*y)]
+
+    starts = np.arange(count - 3)
+    # a run that never breaks ends where the data runs out
+    ends = np.maximum(starts + 4, count - 1)
+    active, d = starts, starts + 4
+    while True:
+        growing = d < count - 1
+        active, d = active[growing], d[growing]
+        if len(active) == 0:
+            break
+
+        # r-squared < r2_min, as r_squared_from_sums has it, without the division
+        n = (d - active).astype(float)
+        sx, sy = px[d] - px[active], py[d] - py[active]
+        sxx, syy = pxx[d] - pxx[active], pyy[d] - pyy[active]
+        spread_x = n*sxx - sx*sx
+        spread_y = n*syy - sy*sy
+        numerator = n*(pxy[d] - pxy[active]) - sx*sy
+        flat = 1e-12 * n * (sxx + syy)
+        wide_x, wide_y = spread_x > flat, spread_y > flat
+        broken = (wide_x & wide_y & (numerator*numerator < Analyzer.r2_min*spread_x*spread_y)) | ~(wide_x | wide_y)
+
+        ends[active[broken]] = d[broken]
+        active, d = active[~broken], d[~broken] + 1
+    return list(zip(starts.tolist(), ends.tolist()))
+
+def longest_segment (array):
+    """The (start, end) of the run with the longest span end to end, the first if there is a tie"""
+    segments = wall_segments(array)
+    if not segments:
+        return None
+    points = np.asarray(array, dtype=float).reshape(-1, 2)
+    starts, ends = np.array(segments).T
+    span = points[ends - 1] - points[starts]
+    magnitudes = np.sqrt(span[:, 0]**2 + span[:, 1]**2)
+    return segments[int(magnitudes.argmax())]
+
+def closest_point_and_magnitude (i2d):
+    """This finds the magnitude of a run of points and the closest point to the robot"""
+    closest_point = (999, 999)
+    smallest = i2d[0]
+    largest = i2d[-1]
+    magnitude = math.sqrt( (largest[0] - smallest[0])**2 + (largest[1] - smallest[1])**2 )
+    for x,y in i2d:
+        if (  x**2 + y**2 < closest_point[0]**2 + closest_point[1]**2 ):
+            closest_point = (x, y)
+    return (magnitude, closest_point)
+
+def slope_and_midpoint (i2d):
+    """
+    This finds the magnitude of a run of points and the midpoint and slope of vector along the wall.
+    Returns them as a tuple.   Slope is returned as a tuple (rise,run).
+    """
+    smallest = i2d[0]
+    largest = i2d[-1]
+    magnitude = math.sqrt( (largest[0] - smallest[0])**2 + (largest[1] - smallest[1])**2 )
+
+    #  midpoint calculation is just average of the points
+    midpoint_x = (smallest[0]+largest[0])/2.0
+    midpoint_y = (smallest[1]+largest[1])/2.0
+    midpoint = (midpoint_x, midpoint_y)
+    slope = (largest[1]-smallest[1],largest[0]-smallest[0])
+    return (magnitude, slope, midpoint)
 
 def magnitude_checker (i, d, array):
     """This finds the magnitude and the closest point to the robot"""
-    i2d = array[i:d]
-    r2 = r_squared(i2d)
-    if (r2 < Analyzer.r2_min) or (d >= len(array)-1):
-        closest_point = (999, 999)
-        smallest = i2d[0]
-        largest = i2d[-1]
-        magnitude = math.sqrt( (largest[0] - smallest[0])**2 + (largest[1] - smallest[1])**2 )
-        for x,y in i2d:
-            if (  x**2 + y**2 < closest_point[0]**2 + closest_point[1]**2 ):
-                closest_point = (x, y)
-        return (magnitude, closest_point)
-    else:
-        return magnitude_checker(i, d+1, array)
+    return closest_point_and_magnitude(array[i:fit_segment(i, d, array)])
 
 def magnitude_checker_midpoint (i, d, array):
     """
     This finds the magnitude and the midpoint and slope of vector along the wall.   Returns them as a tuple.   Slope is returned as a tuple (rise,run).
     """
-    i2d = array[i:d]
-    r2 = r_squared(i2d)
-    if (r2 < Analyzer.r2_min) or (d >= len(array)-1):
-        closest_point = (999, 999)
-        smallest = i2d[0]
-        largest = i2d[-1]
-        magnitude = math.sqrt( (largest[0] - smallest[0])**2 + (largest[1] - smallest[1])**2 )
-
-        for x,y in i2d:
-            if (  x**2 + y**2 < closest_point[0]**2 + closest_point[1]**2 ):
-                closest_point = (x, y)
-
-        #  midpoint calculation is just average of the points
-        midpoint_x = (smallest[0]+largest[0])/2.0
-        midpoint_y = (smallest[1]+largest[1])/2.0
-        midpoint = (midpoint_x, midpoint_y)
-        slope = (largest[1]-smallest[1],largest[0]-smallest[0])
-        return (magnitude, slope, midpoint)
-    else:
-        return magnitude_checker_midpoint(i, d+1, array)
+    return slope_and_midpoint(array[i:fit_segment(i, d, array)])
 
 def find_wall (array):
     """
     This does the stuff necessary to find the wall and the closest point on it.
     """
-    magnitudes_and_points = []
-    for i in range(0, len(array)-3):
-    # Since magnitudeChecker returns the magnitude and closest point, this puts the former at index 0 and the latter at index 1
-        magnitudes_and_points.append( magnitude_checker(i, i+4, array) )
-
-        (mag, point) = magnitudes_and_points[0]
-        for m,p in magnitudes_and_points:
-            if m > mag:
-                mag = m
-                point = p
+    segment = longest_segment(array)
+    if segment is None:
+        return (0, (999, 999))
 
-    return (mag, point)
+    # the longest wall wins
+    i, d = segment
+    return closest_point_and_magnitude(array[i:d])
 
 
 def find_wall_midpoint (array):
@@ -108,19 +312,10 @@ def find_wall_midpoint (array):
     Return the heading and the range from robot to the point.
     Also return the orientation of the wall with respect to the robot.   This is the angle of the normal to the wall.  i.e. if the robot turned by "orientation" amount, it could head straight to the wall.
     """
-    magnitudes_and_points = []
-    for i in range(0, len(array)-3):
-    # Since magnitudeChecker returns the magnitude and closest point, this puts the former at index 0 and the latter at index 1
-        magnitudes_and_points.append( magnitude_checker_midpoint(i, i+4, array) )
-
-        (mag, slope, midpoint) = magnitudes_and_points[0]
-        for m,s,p in magnitudes_and_points:
-            if m > mag:
-                mag = m
-                slope = s
-                midpoint = p
+    if (len(array) > 4):
+        i, d = longest_segment(array)
+        (mag, slope, midpoint) = slope_and_midpoint(array[i:d])
 
-    if (len(magnitudes_and_points) > 1):
         distance = math.sqrt(midpoint[0]**2 + midpoint[1]**2)
         heading = -math.degrees(math.atan2(midpoint[1],midpoint[0]))
         orientation = -math.degrees(math.atan2(slope[1],slope[0]))-90
@@ -165,14 +360,15 @@ def find_wall_midpoint (array):
 #         return 0.0;
 #     }
 
-def something_new(cart_data):
+def something_new(cart_data, factor=4):
     r2_markers = []
     building_vector_start = None
     building_vector_end = None
     max_mag = 0
+    r2_windows = sliding_r_squared(cart_data, factor)
     for i in range(0, len(cart_data)-factor):
         slice = cart_data[i:i+factor]
-        r2 = r_squared(slice)
+        r2 = r2_windows[i]
         # start or continue
         if r2 > .7:
             if building_vector_start is not None:
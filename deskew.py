@@ -0,0 +1,150 @@
+"""
+Motion compensation (de-skew) for lidar rotations.
+
+A rotation takes about 200 ms at 300 rpm.   When the robot drives or
+turns during the rotation, every reading is taken from a slightly
+different pose, so a flat tower face comes out smeared.   De-skew moves
+each reading into the robot's frame at one reference time (the end of
+the rotation), using the time each packet arrived and the speed and
+turn rate reported by the robot.
+
+Headings follow the lidar: 0 is straight ahead and headings increase to
+the left.   The turn rate follows Robot.turn(): positive is a right turn.
+
+    odometry = Odometry()
+    channel.on_message('odometry', odometry.update)
+    headings, ranges = deskew_rotation(rotation, *odometry.motion())
+"""
+import time
+import numpy as np
+
+from laser import Packet, ArrayRotation
+
+slices_in_rotation = Packet.slices_in_rotation
+readings_per_slice = ArrayRotation.readings_per_packet
+headings_in_rotation = ArrayRotation.headings_in_rotation
+SECONDS_PER_MINUTE = 60.0
+
+# range reported for readings in error or warning, these are left alone
+no_range = 777
+
+
+class Odometry(object):
+    """
+    Latest speed (inches/second) and turn rate (degrees/second) from the robot.
+    update() is meant to be a channel callback for 'odometry' messages.
+    """
+    # reports older than this many seconds mean the robot stopped talking
+    stale_after = 0.5
+
+    def __init__(self):
+        self.speed = 0.0
+        self.turn_rate = 0.0
+        self.timestamp = None
+
+    def update(self, message, address=None):
+        """Take the speed and turn rate from an odometry RobotMessage"""
+        self.speed = float(message.speed)
+        self.turn_rate = float(message.turn_rate)
+        self.timestamp = time.time()
+
+    def motion(self, now=None):
+        """(speed, turn rate) to de-skew with, no motion if the last report is stale"""
+        now = time.time() if now is None else now
+        if self.timestamp is None or now - self.timestamp > Odometry.stale_after:
+            return 0.0, 0.0
+        return self.speed, self.turn_rate
+
+
+def rotation_slice_times(rotation):
+    """Arrival time of each slice of the rotation (nan where unknown, or for a FakeRotation)"""
+    slice_times = getattr(rotation, 'slice_times', None)
+    if slice_times is not None:
+        return slice_times
+    return np.full(slices_in_rotation, np.nan)
+
+
+def fit_slice_times(slice_times, rpm=0, end_time=None):
+    """
+    Smooth slice arrival times into a constant rate sweep.
+
+    Packets are stamped per serial read, so several share a time.   A line
+    fitted through the slices, in the order they arrived, gets the spacing
+    back and fills in the missing slices.   Without usable times the sweep
+    is laid out from the rpm, ending at end_time.
+    """
+    order = np.arange(slices_in_rotation)
+    known = ~np.isnan(slice_times)
+    if np.count_nonzero(known) >= 2:
+        # the rotation starts with whichever slice arrived first
+        first = order[known][np.argmin(slice_times[known])]
+        order = (order - first) % slices_in_rotation
+        slope, intercept = np.polyfit(order[known], slice_times[known], 1)
+        if slope > 0:
+            return intercept + slope * order
+        end_time = np.nanmax(slice_times)
+
+    period = SECONDS_PER_MINUTE / rpm if rpm > 0 else 0.0
+    end_time = time.time() if end_time is None else end_time
+    return end_time - period * (slices_in_rotation - 1 - order) / slices_in_rotation
+
+
+def heading_times(rotation):
+    """Time each heading (0 to 359) of the rotation was read"""
+    rpm = rotation.rpm() if callable(rotation.rpm) else rotation.rpm
+    fitted = fit_slice_times(rotation_slice_times(rotation), rpm, getattr(rotation, 'timestamp', None))
+    return np.repeat(fitted, readings_per_slice)
+
+
+def deskew_polar(headings, ranges, times, reference_time, speed, turn_rate):
+    """
+    Move readings taken at times into the robot frame at reference_time.
+    The robot drives at speed (inches/second) and turns at turn_rate
+    (degrees/second) the whole time.   Headings are in degrees, and the
+    corrected headings come back as floats in -180 to 180.
+    """
+    dt = np.asarray(times, dtype=float) - reference_time
+    ranges = np.asarray(ranges, dtype=float)
+
+    # how far the robot had turned (to the right) at each reading, relative to the reference
+    turned = np.radians(turn_rate * dt)
+    theta = np.radians(headings) - turned
+
+    # reading in the reference frame (x right, y ahead), from where the robot was
+    x = -ranges * np.sin(theta)
+    y = ranges * np.cos(theta)
+
+    # where the robot was, driving along the average heading of the arc
+    travel = speed * dt
+    x = x + travel * np.sin(turned / 2)
+    y = y + travel * np.cos(turned / 2)
+
+    return np.degrees(np.arctan2(-x, y)), np.hypot(x, y)
+
+
+def deskew_rotation(rotation, speed, turn_rate):
+    """
+    Return (headings, ranges) arrays for the rotation's -90 to 90 view,
+    corrected for the robot's motion during the rotation.   Headings are
+    whole degrees (0 to 359), as ArrayRotation.polar_array() has them.
+    """
+    if hasattr(rotation, 'polar_array'):
+        headings, ranges = rotation.polar_array()
+    else:
+        polar_data = rotation.polar_data()
+        headings = np.array([heading for heading, _ in polar_data], dtype=int) % headings_in_rotation
+        ranges = np.array([distance for _, distance in polar_data], dtype=float)
+
+    if (speed == 0 and turn_rate == 0) or len(headings) == 0:
+        return headings, ranges
+
+    times = heading_times(rotation)
+    moving = ranges < no_range
+    corrected_headings, corrected_ranges = deskew_polar(headings[moving], ranges[moving],
+                                                        times[headings[moving]], times.max(),
+                                                        speed, turn_rate)
+    headings = headings.copy()
+    ranges = np.array(ranges, dtype=float)
+    headings[moving] = np.rint(corrected_headings).astype(int) % headings_in_rotation
+    ranges[moving] = corrected_ranges
+    return headings, ranges
@@ -0,0 +1,105 @@
+"""
+Synthetic benchmark for rotation de-skew, no lidar needed.
+
+The field model is scanned from a robot that drives and turns during the
+rotation: each lidar slice is rendered (FakeRotation) from where the robot
+was when that slice was read.   The smeared scan is then de-skewed and both
+are compared with a scan taken standing still at the end of the rotation.
+Arguments are the speed in inches/second and the turn rate in degrees/second.
+
+    python deskew_benchmark.py 120 90
+"""
+from __future__ import print_function
+import sys
+import time
+import numpy as np
+
+from field_model import FieldModel, Robot, FakeRotation
+from analyzer import Analyzer, HeadingIndex
+from deskew import deskew_polar, slices_in_rotation, readings_per_slice, headings_in_rotation, SECONDS_PER_MINUTE
+
+
+def robot_at(start, speed, turn_rate, elapsed):
+    """Where a robot starting at start is after elapsed seconds of steady motion"""
+    robot = Robot(start.position, start.heading)
+    # drive along the average heading of the arc, then finish the turn
+    robot.turn(turn_rate * elapsed / 2)
+    robot.move(speed * elapsed)
+    robot.turn(turn_rate * elapsed / 2)
+    return robot
+
+
+def fake_polar(rotation):
+    """(headings 0 to 359, ranges) arrays of a FakeRotation"""
+    polar_data = rotation.polar_data()
+    headings = np.array([heading for heading, _ in polar_data], dtype=int) % headings_in_rotation
+    ranges = np.array([distance for _, distance in polar_data], dtype=float)
+    return headings, ranges
+
+
+def skewed_scan(field, start, speed, turn_rate, rpm=300):
+    """
+    Scan the field while moving.  Slices are read in index order over one
+    rotation period, ending at time 0.   Return the headings, the ranges,
+    the time each reading was taken and the robot at the end of the rotation.
+    """
+    period = SECONDS_PER_MINUTE / rpm
+    slice_times = (np.arange(slices_in_rotation) - (slices_in_rotation - 1)) * period / slices_in_rotation
+    robots = [robot_at(start, speed, turn_rate, slice_time - slice_times[0]) for slice_time in slice_times]
+    scan_headings, scan_ranges, scan_times = [], [], []
+    for slice_index, (slice_time, rotation) in enumerate(zip(slice_times, FakeRotation.for_robots(field, robots))):
+        headings, ranges = fake_polar(rotation)
+        in_slice = headings // readings_per_slice == slice_index
+        scan_headings.append(headings[in_slice])
+        scan_ranges.append(ranges[in_slice])
+        scan_times.append(np.full(np.count_nonzero(in_slice), slice_time))
+    end_robot = robot_at(start, speed, turn_rate, -slice_times[0])
+    return np.concatenate(scan_headings), np.concatenate(scan_ranges), np.concatenate(scan_times), end_robot
+
+
+def range_error(headings, ranges, truth_headings, truth_ranges):
+    """Mean absolute range error over the headings both scans have"""
+    truth = HeadingIndex.from_arrays(truth_headings, truth_ranges).ranges
+    scan = HeadingIndex.from_arrays(headings, ranges).ranges
+    both = np.isfinite(truth) & np.isfinite(scan)
+    return np.mean(np.abs(scan[both] - truth[both]))
+
+
+def run_benchmark(speed, turn_rate, start=None, repeat=1000):
+    """
+    Compare skewed and de-skewed scans against the truth.
+    Return (skewed error, de-skewed error, skewed tower range,
+    de-skewed tower range, true tower range, seconds per de-skew).
+    """
+    field = FieldModel()
+    start = Robot() if start is None else start
+    headings, ranges, times, end_robot = skewed_scan(field, start, speed, turn_rate)
+    truth_headings, truth_ranges = fake_polar(FakeRotation(field, end_robot))
+
+    corrected_headings, corrected_ranges = deskew_polar(headings, ranges, times, 0.0, speed, turn_rate)
+    corrected_headings = np.rint(corrected_headings).astype(int) % headings_in_rotation
+
+    began = time.time()
+    for _ in range(repeat):
+        deskew_polar(headings, ranges, times, 0.0, speed, turn_rate)
+    seconds = (time.time() - began) / repeat
+
+    sweep = (Analyzer.start, Analyzer.stop)
+    return (range_error(headings, ranges, truth_headings, truth_ranges),
+            range_error(corrected_headings, corrected_ranges, truth_headings, truth_ranges),
+            HeadingIndex.from_arrays(headings, ranges).range_at_heading(sweep)[1],
+            HeadingIndex.from_arrays(corrected_headings, corrected_ranges).range_at_heading(sweep)[1],
+            HeadingIndex.from_arrays(truth_headings, truth_ranges).range_at_heading(sweep)[1],
+            seconds)
+
+
+if __name__ == '__main__':
+
+    speed = float(sys.argv[1]) if len(sys.argv) > 1 else 120.0
+    turn_rate = float(sys.argv[2]) if len(sys.argv) > 2 else 90.0
+
+    skewed, corrected, skewed_tower, corrected_tower, tower, seconds = run_benchmark(speed, turn_rate)
+    print("speed {:.1f} in/s, turn rate {:.1f} deg/s".format(speed, turn_rate))
+    print("mean range error: {:.2f} in skewed, {:.2f} in de-skewed".format(skewed, corrected))
+    print("tower range: {:.2f} in skewed, {:.2f} in de-skewed, {:.2f} in true".format(skewed_tower, corrected_tower, tower))
+    print("de-skew takes {:.1f} microseconds per rotation".format(seconds * 1e6))
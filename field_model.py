@@ -1,8 +1,91 @@
 import itertools
 import math
+import numpy as np
+import trig
 
 MM_PER_INCH = 25.4
 
+# lidar headings: whole degrees, 0 straight ahead, increasing to the left
+lidar_headings = np.arange(360)
+
+
+def ray_directions(headings, robot_heading):
+    """
+    Unit vectors (x, y) of the rays at lidar headings from a robot with
+    robot_heading (field frame, +y ahead at heading 0).  Whole degree
+    angles come from the trig tables.
+    """
+    # counterclockwise from the field x axis
+    angles = np.asarray(headings) + 90 - np.asarray(robot_heading, dtype=float)
+    if np.all(angles == np.floor(angles)):
+        ndx = angles.astype(int) % trig.table_size
+        return trig.cos_table[ndx], trig.sin_table[ndx]
+    angles = np.radians(angles)
+    return np.cos(angles), np.sin(angles)
+
+
+def ray_ranges(ox, oy, ux, uy, segments):
+    """
+    Distance along each ray (origin ox, oy and unit direction ux, uy, all
+    broadcast together) to the closest of the segments (S x 4 array of
+    x0, y0, x1, y1) that it crosses, inf where it misses them all.
+    """
+    ox, oy, ux, uy = [np.asarray(a, dtype=float)[..., np.newaxis] for a in (ox, oy, ux, uy)]
+    # every ray is tested against every segment: with nine segments a spatial
+    # prefilter (grid cells, bounding boxes) costs as much per pair as the test itself
+    x0, y0, x1, y1 = segments.T
+    length = np.hypot(x1 - x0, y1 - y0)
+    ex, ey = (x1 - x0) / length, (y1 - y0) / length
+
+    # solve origin + t*u == start + s*e
+    wx, wy = x0 - ox, y0 - oy
+    denominator = ux*ey - uy*ex
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = (wx*ey - wy*ex) / denominator
+        s = (wx*uy - wy*ux) / denominator
+        hits = (denominator != 0) & (t > 0) & (s >= 0) & (s <= length)
+    if hits.shape[-1] == 0:
+        return np.full(hits.shape[:-1], np.inf)
+    return np.where(hits, t, np.inf).min(axis=-1)
+
+
+def render_ranges(segments, positions, headings, view_headings=lidar_headings):
+    """
+    Ranges the lidar would read from many robot poses.  positions is a
+    P x 2 array and headings has P entries.   Return a P x len(view_headings)
+    array with the range at each of the view headings, inf where the ray
+    hits nothing.
+    """
+    positions = np.asarray(positions, dtype=float).reshape(-1, 2)
+    headings = np.asarray(headings, dtype=float).reshape(-1, 1)
+    ux, uy = ray_directions(view_headings, headings)
+    return ray_ranges(positions[:, 0:1], positions[:, 1:2], ux, uy, segments)
+
+
+def scan_poses(segments, positions, headings):
+    """
+    Scan the field from many robot poses in one vectorized pass.
+
+    segments is an S x 4 array, positions a P x 2 array and headings has
+    P entries.   A ray is cast at every whole degree lidar heading and the
+    closest segment it crosses gives the range.   Return, for each pose,
+    the (heading, range) tuples of the rays that hit, in descending heading
+    order.  Headings are labelled the way the lidar sees the field: the
+    ray's field angle (counterclockwise from x) is in (-180, 180], so
+    headings run from -270 to 90 plus the robot heading.
+    """
+    ranges = render_ranges(segments, positions, headings)
+    headings = np.asarray(headings, dtype=float).reshape(-1, 1)
+    labels = lidar_headings - 360 * np.ceil((lidar_headings + 90 - headings - 180) / 360.0).astype(int)
+
+    scans = []
+    for pose_labels, pose_ranges in zip(labels, ranges):
+        order = np.argsort(-pose_labels)
+        hit = np.isfinite(pose_ranges[order])
+        scans.append(list(zip(pose_labels[order][hit].tolist(), pose_ranges[order][hit].tolist())))
+    return scans
+
+
 class FakeRotation:
     """
     Like an  authentic lidar data rotation, but with fake data.
@@ -11,41 +94,48 @@ class FakeRotation:
     Use the field model to generate the data from the perspective
     of the robot location and orientation.
     """
-    def __init__(self, field_model, robot=None, rpm=256):
+    # poses rendered per vectorized pass in for_robots()
+    poses_per_pass = 64
+
+    def __init__(self, field_model, robot=None, rpm=256, view_data=None):
         """Create the fake rotation using field model and robot orientation"""
         if robot is None:
             robot = Robot()
-            
-        # translate the field model origin to the robot location
-        new_origin = (FieldModel.translate(x, y, robot.position) for x, y in iter(field_model))
-        # convert to polar data
-        tmp_data = (FieldModel.cart_to_polar(x, y) for x, y in new_origin)
-        # rotate to robot orientation
-        tmp_data = ((theta+robot.heading,radius) for theta,radius in tmp_data)
-        # round the data to whole degrees, and whole inches (4 bits of lidar noise)
-        tmp_data = itertools.starmap(FieldModel.round_degrees, tmp_data)
-        # sort the data by the angle so it is in scan order
-        tmp_data = sorted(tmp_data, key=lambda x: x[0])
-        # then group all of the points by degree measure
-        tmp_data = itertools.groupby(tmp_data, lambda x: int(round(x[0])))
-        # pick the closest one in each group because it shadows the others
-        self.view_data = [min(interval, key=lambda x: x[1]) for _, interval in tmp_data][::-1]
+
+        if view_data is None:
+            view_data = scan_poses(field_model.segment_array, [robot.position], [robot.heading])[0]
+        self.view_data = view_data
         self.origin = robot.position
         self.orientation = robot.heading
         self.rpm = rpm
+        self.cart_data = None
         
-    @staticmethod
-    def polar_to_cart(theta, r):
-        """convert cartesian to polar data"""
-        theta_r = math.radians(theta)
-        return r*math.cos(theta_r), r*math.sin(theta_r)
+    @classmethod
+    def for_robots(cls, field_model, robots, rpm=256):
+        """Fake rotations for many robot poses, rendered a batch of poses at a time"""
+        rotations = []
+        for start in range(0, len(robots), cls.poses_per_pass):
+            batch = robots[start:start + cls.poses_per_pass]
+            scans = scan_poses(field_model.segment_array,
+                               [robot.position for robot in batch],
+                               [robot.heading for robot in batch])
+            rotations.extend(cls(field_model, robot, rpm, view_data) for robot, view_data in zip(batch, scans))
+        return rotations
+
+    # convert polar data to cartesian (whole degrees come from the trig tables)
+    polar_to_cart = staticmethod(trig.polar_to_cart)
+
+    def invalidate(self):
+        """Forget the cached cartesian data (after changing view_data)"""
+        self.cart_data = None
 
     def polar_data(self):
         return self.view_data
 
     def cartesian_data(self):
-        return [FakeRotation.polar_to_cart(theta, radius)
-                for theta, radius in self.polar_data()]
+        if self.cart_data is None:
+            self.cart_data = trig.polar_data_to_cart(self.polar_data())
+        return self.cart_data
 
     def write_to_file(self, file_name):
         LidarViewer.write_to_file(file_name, polar_data)
@@ -89,9 +179,10 @@ class Robot (object):
 class FieldModel (object):
     """
     Fake field cartesian coordinates.
-    Accurate model of field back wall.
-    Scaled up by a factor of ten to build and then scaled down
-    so we have points every 10th of an inch.
+    Accurate model of field back wall, as line segments: the back wall
+    either side of the tower, the posts of the two facet goals, the face
+    of the tower and the wall between the slots.
+    Dimensions are scaled up by a factor of ten, segments are in inches.
     """
     # half width of field in inches * scale
     scale = 10
@@ -115,77 +206,53 @@ class FieldModel (object):
     back_width = 1800
 
     def __init__ (self):
-        """create the cartesian equivalent for the model of the back wall of the field"""
-        # left wall from corner to the left edge of the tower
-        scaled_by_10_data = [(x, FieldModel.field_depth)
-                           for x in xrange(-FieldModel.field_width, -FieldModel.tower_width)]
-
-        # no need for infinity back wall behind the tower
-        #scaled_by_10_data.extend((x, FieldModel.field_depth+FieldModel.back_back)
-        #                         for x in range(-FieldModel.back_width, FieldModel.back_width))
-        #
-        # generate points for the left facet (with 16" opening)  This is 3 points on either
-        # side of the goal, running along a line that is 120 degrees (with a slope of -sqrt(3)
-        #
-        #  Generate the points that form the posts of the left facet goal
-        #  walk along the line and just put out the points that project on the
-        #  first and last 2 inches.
-        left_facet_delta_y = -math.sqrt(3)/2
-        left_facet_delta_x = 0.5
-        x = -FieldModel.tower_width
-        y = FieldModel.field_depth
-        while (x < -(FieldModel.tower_width/2)):
-            # left post for 2 inches of x projection
-            if x <= -FieldModel.tower_width+FieldModel.post_projection:
-                scaled_by_10_data.append((x,y))
-            # right post for 2 inches of x projection
-            if x >= -(FieldModel.tower_width/2)-FieldModel.post_projection:
-                scaled_by_10_data.append((x,y))
-            # next point along the -120 degree line
-            x = x + left_facet_delta_x
-            y = y + left_facet_delta_y
-
-        # generate the points for the face of the tower
-        scaled_by_10_data.extend((x, FieldModel.field_depth-FieldModel.tower_depth)
-                               for x in range(-FieldModel.tower_face, FieldModel.tower_face))
-
-        #
-        # generate points for the left facet (with 16" opening)  This is 3 points on either
-        # side of the goal, running along a line that is 120 degrees (with a slope of -sqrt(3)
-        #
-        #  Generate the points that form the posts of the right facet goal
-        #  walk along the line and just put out the points that project on the
-        #  first and last 2 inches.
-        left_facet_delta_y = -math.sqrt(3)/2
-        left_facet_delta_x = -0.5
-        x = FieldModel.tower_width
-        y = FieldModel.field_depth
-        while (x > FieldModel.tower_width/2):
-            # left post for 2 inches of x projection
-            if x >= FieldModel.tower_width-FieldModel.post_projection:
-                scaled_by_10_data.append((x,y))
-            # right post for 2 inches of x projection
-            if x <= FieldModel.tower_width/2+FieldModel.post_projection:
-                scaled_by_10_data.append((x,y))
-            # next point along the -120 degree line
-            x = x + left_facet_delta_x
-            y = y + left_facet_delta_y
-        
+        """create the line segments for the model of the back wall of the field"""
+        depth = FieldModel.field_depth
+        face_y = FieldModel.field_depth - FieldModel.tower_depth
+
+        def facet(side, start, end):
+            # piece of a facet between x projections start and end from the back wall,
+            # the facets run back from the wall at 120 degrees (a slope of sqrt(3))
+            return ((side * (FieldModel.tower_width - start), depth - math.sqrt(3) * start),
+                    (side * (FieldModel.tower_width - end), depth - math.sqrt(3) * end))
+
+        # the goal between the posts of each facet is open (16" opening)
+        post = FieldModel.post_projection
+        facet_length = FieldModel.tower_width / 2
         slot1_start = FieldModel.tower_width+FieldModel.field_width_right
         slot1_end = slot1_start + FieldModel.slot_width
         slot2_start = slot1_end + FieldModel.slot_space
         slot2_end = slot2_start + FieldModel.slot_width
-        scaled_by_10_data.extend((x, FieldModel.field_depth)
-                               for x in range(FieldModel.tower_width, slot1_start))
-        scaled_by_10_data.extend((x, FieldModel.field_depth)
-                               for x in range(slot1_end, slot2_start))
-        scaled_by_10_data.extend((x, FieldModel.field_depth)
-                               for x in range(slot2_end, slot2_end+12))
+        scaled_by_10_segments = [
+            # left wall from corner to the left edge of the tower
+            ((-FieldModel.field_width, depth), (-FieldModel.tower_width, depth)),
+            facet(-1, 0, post),
+            facet(-1, facet_length - post, facet_length),
+            # face of the tower
+            ((-FieldModel.tower_face, face_y), (FieldModel.tower_face, face_y)),
+            facet(1, facet_length - post, facet_length),
+            facet(1, 0, post),
+            # right wall up to the slots, then between and past them
+            ((FieldModel.tower_width, depth), (slot1_start, depth)),
+            ((slot1_end, depth), (slot2_start, depth)),
+            ((slot2_end, depth), (slot2_end+12, depth)),
+            ]
 
-        self.field_data = [(x/10.0,y/10.0) for x,y in scaled_by_10_data]
+        self.segments = [((x0/float(FieldModel.scale), y0/float(FieldModel.scale)),
+                          (x1/float(FieldModel.scale), y1/float(FieldModel.scale)))
+                         for (x0, y0), (x1, y1) in scaled_by_10_segments]
+        self.segment_array = np.array([start + end for start, end in self.segments])
 
     def __getitem__ (self, index):
-        return self.field_data[index]
+        return self.segments[index]
+
+    def points(self, spacing=0.1):
+        """Points along every segment, spacing inches apart (for plotting)"""
+        points = []
+        for (x0, y0), (x1, y1) in self.segments:
+            count = max(int(math.hypot(x1 - x0, y1 - y0) / spacing), 1)
+            points.extend((x0 + (x1 - x0) * i / count, y0 + (y1 - y0) * i / count) for i in range(count + 1))
+        return points
 
     @staticmethod
     def tower_range_from_origin():
@@ -205,4 +272,3 @@ class FieldModel (object):
     def translate(x, y, origin):
         """translate the data points for the robot origin"""
         return x - origin[0], y - origin[1]
-
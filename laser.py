@@ -19,6 +19,9 @@ import binascii
 import collections
 import itertools
 import math
+import numpy as np
+import time
+import trig
 from time import sleep
 import socket
 from udp_channels import *
@@ -122,14 +125,31 @@ class Packet (object):
         # one time init for how to unpack data and tuplify it
         structure_def = struct.Struct(structure_def_str)
         tuple_def = collections.namedtuple('Packet_tuple', tuple_def_str)                
+
+        # the packet as little-endian words, for checksumming
+        checksum_def = struct.Struct('<11H')
+        checksum_weights = 2 ** np.arange(9, -1, -1, dtype=np.int64)
+
+        # the same layout as a numpy structured dtype, for decoding many packets at once
+        dtype = np.dtype([(name, {'B': 'u1', 'H': '<u2'}[code])
+                          for name, code in zip(tuple_def_str.split(), structure_def_str[1:].replace(' ', ''))])
+
+        # columns handed back by the batch decoder
+        batch_def = collections.namedtuple('Packet_batch',
+                                           'index speed rpm dist0 strength0 dist1 strength1 '
+                                           'dist2 strength2 dist3 strength3 checksum')
         #
         #  Construct useable internal
         #
-        def __init__(self, packed_data):
+        def __init__(self, packed_data, timestamp=None):
                 """Create a packet from the 22byte serial lidar data"""
                 #
                 #  Use the unpacking structure and the tuple def to get it into friendly form
                 #
+                self.raw = packed_data
+
+                # time.time() when the packet was read from the port (None if unknown)
+                self.timestamp = timestamp
                 unpacked_data = Packet.structure_def.unpack(packed_data)
                 packet_tuple = Packet.tuple_def._make(unpacked_data)
 
@@ -155,6 +175,24 @@ class Packet (object):
         def decode_index(index_value):
                 return index_value - Packet.index_offset
 
+        #
+        #  Decode a contiguous run of packets (N x 22 bytes) in one pass.
+        #  Each column is a numpy array with one entry per packet.
+        #
+        @staticmethod
+        def decode_batch(packed_data):
+                """Decode N packets from N*22 bytes into columnar arrays"""
+                count = len(packed_data) // Packet.packet_length
+                packets = np.frombuffer(packed_data, dtype=Packet.dtype, count=count)
+                return Packet.batch_def(index=packets['index'].astype(np.int32) - Packet.index_offset,
+                                        speed=packets['speed'],
+                                        rpm=packets['speed'] // Packet.speed_units_per_rpm,
+                                        dist0=packets['dist0'], strength0=packets['strength0'],
+                                        dist1=packets['dist1'], strength1=packets['strength1'],
+                                        dist2=packets['dist2'], strength2=packets['strength2'],
+                                        dist3=packets['dist3'], strength3=packets['strength3'],
+                                        checksum=packets['checksum'])
+
         #
         #  Decode the rpm value 
         #
@@ -185,29 +223,44 @@ class Packet (object):
                 return str_data                
 
         #
-        # Checksum algorithm applies to the packet
-        # Checksum function does not work.  (we ought to get it work, though)
+        # Checksum algorithm applies to the packet.   The first 20 bytes are
+        # taken as 10 little-endian words and folded into 15 bits.
+        # The result has to match the word in the last two bytes.
         #
-        def checksum(self,data):
-                """Return True if the checksum is correct and False otherwise"""
-                # group the data by word, little-endian
-                data_list = []
-                for t in range(10):
-                        data_list.append( data[2*t] + (data[2*t+1]<<8) )
-                        
-                # compute the checksum on 32 bits
+        @staticmethod
+        def compute_checksum(packed_data):
+                """Return the XV11 checksum for the first 20 bytes of a raw packet"""
                 chk32 = 0
+                for word in Packet.checksum_def.unpack_from(packed_data)[:-1]:
+                        chk32 = (chk32 << 1) + word
 
-                for d in data_list:
-                        chk32 = (chk32 << 1) + d
-                        
-                # return a value wrapped around on 15bits, and truncated to still fit into 15 bits
-                checksum = (chk32 & 0x7FFF) + ( chk32 >> 15 ) # wrap around to fit into 15 bits
-                checksum = checksum & 0x7FFF # truncate to 15 bits
-                if (checksum == data_list[9]):
-                        print("{:d} passes checksum check".format(data_list[1]))
+                # wrap around to fit into 15 bits, and truncate to still fit into 15 bits
+                checksum = (chk32 & 0x7FFF) + (chk32 >> 15)
+                return checksum & 0x7FFF
 
-                return int( checksum )
+        @staticmethod
+        def checksum_ok(packed_data):
+                """Return True if the checksum of a raw packet is correct"""
+                return Packet.compute_checksum(packed_data) == Packet.checksum_def.unpack_from(packed_data)[-1]
+
+        #
+        #  Batch form of the checksum check over N packets (N x 22 bytes).
+        #  Shifting the running sum left once per word is the same as
+        #  weighting word t by 2**(9-t), so the whole thing is a dot product.
+        #
+        @staticmethod
+        def checksums_ok(packed_data):
+                """Return a boolean array, True for each packet with a correct checksum"""
+                count = len(packed_data) // Packet.packet_length
+                words = np.frombuffer(packed_data, dtype='<u2', count=count*Packet.packet_length//2)
+                words = words.reshape(count, Packet.packet_length//2).astype(np.int64)
+                chk32 = words[:, :-1].dot(Packet.checksum_weights)
+                checksum = ((chk32 & 0x7FFF) + (chk32 >> 15)) & 0x7FFF
+                return checksum == words[:, -1]
+
+        def checksum(self):
+                """Return True if the checksum is correct and False otherwise"""
+                return Packet.checksum_ok(self.raw)
 
         def __getitem__(self, ndx):
                 return self.readings[ndx]
@@ -221,11 +274,31 @@ class Laser (object):
 	mapnames = []
 	cmdmode = 0
 
-	def __init__(self,sd,calibration_compensation=6):
+        # bytes requested from the serial port per bulk read in streaming mode
+        read_chunk_size = 256
+
+        # start marker as a searchable buffer
+        packet_start_marker = bytearray([Packet.packet_start])
+
+	def __init__(self,sd,calibration_compensation=6,streaming=False):
                 """setup internal variables and associate the laser with open serial port"""
 		self.results=0
 		self.haslaser=0
 		self.laserport=sd
+                self.streaming=streaming
+
+                # bytes read from the port, but not yet framed into packets
+                self.stream_buffer=bytearray()
+
+                # packet acquisition counters
+                self.packets_read=0
+                self.checksum_errors=0
+
+                # when the latest chunk and packet were read, and when each
+                # slice of the last rotation gathered arrived (nan if missing)
+                self.chunk_time=None
+                self.packet_time=None
+                self.slice_times=np.full(Packet.slices_in_rotation, np.nan)
         
 
         #
@@ -252,30 +325,157 @@ class Laser (object):
 
                 #
                 # print("Looking for packet with index {:d}\n".format(slice_index))
-		while insync == 0:
+                while insync == 0:
                         scanba[0] = ord(self.laserport.read(1))
-			if scanba[0] == Packet.packet_start:
-                                scanba[1] = ord(self.laserport.read(1))
-				if scanba[1] == packet_index:
-					insync=1
-                #
-                # We got a marker value and a matching slice value
-                # Read the remaining bytes and do the checksum calculation
-                #
-		if insync == 1:
-		        try:
+                        if scanba[0] != Packet.packet_start:
+                                continue
+                        scanba[1] = ord(self.laserport.read(1))
+                        if scanba[1] != packet_index:
+                                continue
+                        #
+                        # We got a marker value and a matching slice value
+                        # Read the remaining bytes and do the checksum calculation
+                        #
+                        try:
                                 # read the final Packet.payload_length bytes
                                 charbuffer = self.laserport.read(Packet.payload_length)
-                                if len(charbuffer) == Packet.payload_length:
-                                        scanba[2:2+Packet.payload_length] = map(ord,charbuffer)
-                                # unpack the data conformant with the structure def
-                                slice_pkt = Packet(scanba)
-                                        
-			except IOError,e:
-				print("Failed trying to read scanline {:x}".format(scanhdr))
+                                if len(charbuffer) != Packet.payload_length:
+                                        raise IOError("Short read on the lidar port")
+                                scanba[2:2+Packet.payload_length] = charbuffer
+                        except IOError,e:
+                                print("Failed trying to read scanline {:x}".format(packet_index))
+                                raise
+
+                        self.packets_read = self.packets_read + 1
+                        if Packet.checksum_ok(scanba):
+                                insync = 1
+                        else:
+                                self.checksum_errors = self.checksum_errors + 1
+
+                # unpack the data conformant with the structure def
+                slice_pkt = Packet(scanba, time.time())
 		return slice_pkt
 
 
+        def stats(self):
+                """Counters describing the health of packet acquisition"""
+                return {'packets': self.packets_read,
+                        'checksum_errors': self.checksum_errors}
+
+        #
+        #  Read a chunk of bytes from the port.   Take everything that is
+        #  already waiting, but at least read_chunk_size bytes (or whatever
+        #  shows up before the port times out).
+        #
+        def read_chunk(self):
+                """Read a bulk chunk of bytes from the lidar serial port"""
+                waiting = getattr(self.laserport, 'in_waiting', 0)
+                chunk = self.laserport.read(max(waiting, Laser.read_chunk_size))
+                if not chunk:
+                        raise IOError("Timed out reading from the lidar port")
+                self.chunk_time = time.time()
+                return chunk
+
+        #
+        #  Streaming framer.   Scan the buffered bytes for the start marker
+        #  and hand out every packet in the order that it arrives.
+        #  Consumed bytes are removed from the buffer before the packet is
+        #  yielded, so the generator can be abandoned at any time without
+        #  losing the bytes that follow.
+        #
+        def raw_packets(self):
+                """Generate raw 22 byte lidar packets in arrival order, whatever their index"""
+                buffer = self.stream_buffer
+                while True:
+                        start = buffer.find(Laser.packet_start_marker)
+                        if start < 0:
+                                # nothing that looks like a packet, toss it all
+                                del buffer[:]
+                                buffer.extend(self.read_chunk())
+                                continue
+
+                        end = start + Packet.packet_length
+                        if len(buffer) < end:
+                                # drop the junk ahead of the marker and wait for the rest
+                                del buffer[:start]
+                                buffer.extend(self.read_chunk())
+                                continue
+
+                        slice_index = Packet.decode_index(buffer[start+1])
+                        if not 0 <= slice_index < Packet.slices_in_rotation:
+                                # marker byte was just data, resync on the next one
+                                del buffer[:start+1]
+                                continue
+
+                        raw = buffer[start:end]
+                        self.packets_read = self.packets_read + 1
+                        if not Packet.checksum_ok(raw):
+                                # garbage (or a false marker), resync on the next one
+                                self.checksum_errors = self.checksum_errors + 1
+                                del buffer[:start+1]
+                                continue
+
+                        # the packet's last byte came in with the latest chunk
+                        del buffer[:end]
+                        self.packet_time = self.chunk_time
+                        yield raw
+
+        def packets(self):
+                """Generate lidar packets in arrival order, whatever their index"""
+                for raw in self.raw_packets():
+                        yield Packet(raw)
+
+        #
+        #  Collect packets as they arrive until every slice index has been
+        #  seen.   Give up after a couple of rotations worth of packets so a
+        #  slice that never shows up cannot stall the caller forever.
+        #
+        def gather_raw_slices(self):
+                """Read a rotation with the streaming framer, return raw packets ordered by slice index"""
+                slices = [None] * Packet.slices_in_rotation
+                slice_times = np.full(Packet.slices_in_rotation, np.nan)
+                missing = Packet.slices_in_rotation
+                packet_limit = 2 * Packet.slices_in_rotation
+
+                for count, raw in enumerate(self.raw_packets()):
+                        slice_index = Packet.decode_index(raw[1])
+                        if slices[slice_index] is None:
+                                missing = missing - 1
+                        slices[slice_index] = raw
+                        slice_times[slice_index] = self.packet_time
+                        if missing == 0 or count >= packet_limit:
+                                break
+
+                self.slice_times = slice_times
+
+                if missing:
+                        logger.warning("Rotation is missing {:d} slices".format(missing))
+
+                return [raw for raw in slices if raw is not None]
+
+        def gather_streaming_rotation(self,reverse_data=True):
+                """
+                Read a rotation of lidar data with the streaming framer and return
+                it as a collection of packets ordered by slice index
+                """
+                rotation = [Packet(raw, self.slice_times[Packet.decode_index(raw[1])])
+                            for raw in self.gather_raw_slices()]
+                if reverse_data:
+                        return rotation[::-1]
+                else:
+                        return rotation
+
+        #
+        #  Raw rotation is the undecoded packets back to back (N x 22 bytes),
+        #  ready for ArrayRotation to decode in one go.
+        #
+        def gather_raw_rotation(self):
+                """Read a rotation of lidar data and return the raw packet bytes"""
+                if self.streaming and self.laserport is not None:
+                        return bytearray().join(self.gather_raw_slices())
+                else:
+                        return bytearray().join(packet.raw for packet in self.gather_full_rotation(reverse_data=False))
+
         #
         # Collect a complete set of packets and concatenate them into
         #
@@ -283,6 +483,9 @@ class Laser (object):
                 """
                 Read a rotation of lidar data and return it as a collection of packets
                 """
+                if self.streaming and self.laserport is not None:
+                        return self.gather_streaming_rotation(reverse_data)
+
                 rotation = []
                 slice_index = 0
 
@@ -301,6 +504,11 @@ class Laser (object):
                         except Exception as e:
                                 print("Unable to get packet for data slice with index {:d}.".format(slice_index))
 
+                self.slice_times = np.full(Packet.slices_in_rotation, np.nan)
+                for packet in rotation:
+                        if packet.timestamp is not None:
+                                self.slice_times[packet.index] = packet.timestamp
+
                 #
                 # If generating synthetic data, slow down for a bit
                 # Sleep is related to the rotation speed in the synthetic packet.
@@ -372,18 +580,59 @@ class Rotation(object):
                 
                 self.view_data  = [(r.heading, r.range_in_inches) for r in view_readings]
 
+                # when each slice of the rotation was read (nan if unknown)
+                self.slice_times = Rotation.packet_slice_times(self.packets)
+
         @staticmethod
-        def polar_to_cart(theta, r):
-                """convert cartesian to polar data"""
-                theta_r = math.radians(theta)
-                return r*math.cos(theta_r), r*math.sin(theta_r)
+        def packet_slice_times(packets):
+                """Arrival time of each slice, from the packet timestamps (nan where unknown)"""
+                slice_times = np.full(Packet.slices_in_rotation, np.nan)
+                for packet in packets:
+                        if packet.timestamp is not None and 0 <= packet.index < Packet.slices_in_rotation:
+                                slice_times[packet.index] = packet.timestamp
+                return slice_times
+
+        @property
+        def first_packet_time(self):
+                """When the first packet of the rotation was read, None if unknown"""
+                known = self.slice_times[~np.isnan(self.slice_times)]
+                return float(known.min()) if len(known) else None
+
+        @property
+        def last_packet_time(self):
+                """When the last packet of the rotation was read, None if unknown"""
+                known = self.slice_times[~np.isnan(self.slice_times)]
+                return float(known.max()) if len(known) else None
+
+        # convert polar data to cartesian (whole degrees come from the trig tables)
+        polar_to_cart = staticmethod(trig.polar_to_cart)
+
+        #
+        #  The cartesian view is computed the first time it is asked for and
+        #  kept until the view data is replaced.   Call invalidate() after
+        #  changing the view data in place.
+        #
+        @property
+        def view_data(self):
+                return self._view_data
+
+        @view_data.setter
+        def view_data(self, view_data):
+                self._view_data = view_data
+                self._cartesian_data = None
+
+        def invalidate(self):
+                """Forget the cached cartesian view"""
+                self._cartesian_data = None
 
         def polar_data(self):
                 return self.view_data
         
         def cartesian_data(self):
                 """Return an array of clean cartesian data points (left to right)"""
-                return [Rotation.polar_to_cart(theta, r) for theta, r in self.view_data]
+                if self._cartesian_data is None:
+                        self._cartesian_data = trig.polar_data_to_cart(self.view_data)
+                return self._cartesian_data
         
         def rpm(self):
                 """report an rpm value collected in this rotation"""
@@ -396,3 +645,137 @@ class Rotation(object):
         def __getitem__(self, ndx):
                 return self.view_data[ndx]
 
+
+
+#
+#  A single rotation of lidar data, stored as arrays
+#
+class ArrayRotation(object):
+        """
+        ArrayRotation is an alternate Rotation that skips the Packet and
+        Reading objects.   The raw 22 byte packets are decoded straight
+        into fixed 360 element arrays addressed by heading (degrees).
+
+        polar_data(), cartesian_data(), rpm() and indexing behave just
+        like Rotation.   Vectorized clients can use the arrays directly.
+        """
+        headings_in_rotation = 4 * Packet.slices_in_rotation
+        readings_per_packet = 4
+
+        # heading slots for the -90 to 90 view, in the order Rotation reports them
+        view_slots = np.arange(*Rotation.right_to_left) % headings_in_rotation
+
+        def __init__(self, rotation_data):
+                """Create a rotation from a list of Packets or from raw packet bytes (N x 22)"""
+                if isinstance(rotation_data, (bytes, bytearray)):
+                        raw_data = rotation_data
+                        self.slice_times = np.full(Packet.slices_in_rotation, np.nan)
+                else:
+                        raw_data = bytearray().join(packet.raw for packet in rotation_data)
+                        self.slice_times = Rotation.packet_slice_times(rotation_data)
+
+                packets = Packet.decode_batch(raw_data)
+                if len(packets.index) != Rotation.full_rotation_packets:
+                        print("Not playing with a full rotation of data, dude!")
+
+                in_range = (packets.index >= 0) & (packets.index < Packet.slices_in_rotation)
+                slice_index = packets.index[in_range]
+                headings = (ArrayRotation.readings_per_packet * slice_index[:, np.newaxis] +
+                            np.arange(ArrayRotation.readings_per_packet))
+
+                self.heading = np.arange(ArrayRotation.headings_in_rotation)
+                self.raw_distance = np.zeros(ArrayRotation.headings_in_rotation, dtype=np.uint16)
+                self.strength = np.zeros(ArrayRotation.headings_in_rotation, dtype=np.uint16)
+                self.present = np.zeros(ArrayRotation.headings_in_rotation, dtype=bool)
+
+                self.raw_distance[headings] = np.column_stack((packets.dist0, packets.dist1,
+                                                               packets.dist2, packets.dist3))[in_range]
+                self.strength[headings] = np.column_stack((packets.strength0, packets.strength1,
+                                                           packets.strength2, packets.strength3))[in_range]
+                self.present[headings] = True
+
+                self.speed = int(packets.speed[0]) if len(packets.speed) else 0
+
+                self._view_data = None
+                self._cartesian_data = None
+
+        @classmethod
+        def from_arrays(cls, raw_distance, strength, present, rpm):
+                """Create a rotation around existing 360 element arrays (no copies)"""
+                rotation = cls.__new__(cls)
+                rotation.heading = np.arange(ArrayRotation.headings_in_rotation)
+                rotation.raw_distance = raw_distance
+                rotation.strength = strength
+                rotation.present = present
+                rotation.speed = int(rpm) * Packet.speed_units_per_rpm
+                rotation.slice_times = np.full(Packet.slices_in_rotation, np.nan)
+                rotation._view_data = None
+                rotation._cartesian_data = None
+                return rotation
+
+        # raw bytes carry no arrival times, the reader fills in slice_times
+        first_packet_time = Rotation.first_packet_time
+        last_packet_time = Rotation.last_packet_time
+
+        @property
+        def error(self):
+                return (self.raw_distance & Reading.error_mask) != 0
+
+        @property
+        def warning(self):
+                return (self.raw_distance & Reading.warning_mask) != 0
+
+        @property
+        def valid(self):
+                """Mask of headings with a reading that is neither in error nor warning"""
+                return self.present & ~(self.error | self.warning)
+
+        @property
+        def range(self):
+                return self.raw_distance & ~(Reading.error_mask | Reading.warning_mask)
+
+        @property
+        def range_in_inches(self):
+                """Distance in inches for every heading.  777 if there is an error or warning."""
+                inches = self.range / Reading.MM_PER_INCH
+                inches[self.error | self.warning] = 777
+                return inches
+
+        def polar_array(self):
+                """Return (headings, ranges in inches) arrays for the -90 to 90 view"""
+                slots = ArrayRotation.view_slots
+                slots = slots[self.present[slots] & ~self.error[slots]]
+                return slots, self.range_in_inches[slots]
+
+        def cartesian_array(self):
+                """Return (x, y) arrays for the -90 to 90 view"""
+                return trig.polar_array_to_cart(*self.polar_array())
+
+        #
+        #  Both list views are built on first use and cached.   Call
+        #  invalidate() after changing the arrays in place.
+        #
+        def invalidate(self):
+                """Forget the cached polar and cartesian views"""
+                self._view_data = None
+                self._cartesian_data = None
+
+        def polar_data(self):
+                if self._view_data is None:
+                        headings, ranges = self.polar_array()
+                        self._view_data = list(zip(headings.tolist(), ranges.tolist()))
+                return self._view_data
+
+        def cartesian_data(self):
+                """Return an array of clean cartesian data points (left to right)"""
+                if self._cartesian_data is None:
+                        x, y = self.cartesian_array()
+                        self._cartesian_data = list(zip(x.tolist(), y.tolist()))
+                return self._cartesian_data
+
+        def rpm(self):
+                """report an rpm value collected in this rotation"""
+                return int(round(self.speed // Packet.speed_units_per_rpm))
+
+        def __getitem__(self, ndx):
+                return self.polar_data()[ndx]
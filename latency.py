@@ -0,0 +1,103 @@
+"""
+Rolling latency statistics for the stages of the lidar pipeline.
+
+Every stage keeps its most recent samples in a fixed size ring, and the
+percentiles are taken over the ring, so they follow what the pipeline is
+doing now rather than since it started.   The stages are:
+
+    read      waiting for and framing a rotation of packets
+    decode    turning the packets into a rotation
+    analyze   range at heading, wall, ...
+    encode    building the messages for the robot
+    send      handing the messages to the channel
+    age       from the last packet of the rotation arriving to its results being sent
+
+    latency = LatencyStats()
+    with latency.timing('analyze'):
+        ...
+    latency.record('age', time.time() - rotation.last_packet_time)
+    p50, p95, p99 = latency.percentiles('analyze')
+
+Samples are in seconds.   Times come from time.time(), which is also
+what the packet timestamps use (Python 2 has no monotonic clock).
+"""
+import collections
+import contextlib
+import json
+import threading
+import time
+import numpy as np
+
+stages = ('read', 'decode', 'analyze', 'encode', 'send', 'age')
+
+percentile_points = (50, 95, 99)
+
+
+class LatencyWindow(object):
+    """The last window samples of one stage"""
+    def __init__(self, window=512):
+        self.samples = np.zeros(window)
+        self.count = 0
+
+    def record(self, seconds):
+        self.samples[self.count % len(self.samples)] = seconds
+        self.count = self.count + 1
+
+    def percentiles(self):
+        """(p50, p95, p99) over the window, zeros before the first sample"""
+        filled = min(self.count, len(self.samples))
+        if filled == 0:
+            return (0.0,) * len(percentile_points)
+        return tuple(float(p) for p in np.percentile(self.samples[:filled], percentile_points))
+
+
+class LatencyStats(object):
+    """
+    Latency windows for every stage.   The reader thread and the main
+    loop both record into it, so recording and reading take a lock.
+    """
+    def __init__(self, window=512):
+        self.window = window
+        self.lock = threading.Lock()
+        self.windows = collections.OrderedDict((stage, LatencyWindow(window)) for stage in stages)
+
+    def record(self, stage, seconds):
+        """Add a sample to a stage, a new stage name gets its own window"""
+        with self.lock:
+            if stage not in self.windows:
+                self.windows[stage] = LatencyWindow(self.window)
+            self.windows[stage].record(seconds)
+
+    @contextlib.contextmanager
+    def timing(self, stage):
+        """Record how long the body of the with statement takes"""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.record(stage, time.time() - start)
+
+    def percentiles(self, stage):
+        """(p50, p95, p99) of a stage in seconds"""
+        with self.lock:
+            return self.windows[stage].percentiles()
+
+    def milliseconds(self, stage):
+        """(p50, p95, p99) of a stage in whole milliseconds, clipped to fit the wire (uint16)"""
+        return tuple(int(min(round(p * 1000.0), 0xffff)) for p in self.percentiles(stage))
+
+    def summary(self):
+        """{stage: {'count', 'p50', 'p95', 'p99'}} with the percentiles in milliseconds"""
+        with self.lock:
+            summary = collections.OrderedDict()
+            for stage, window in self.windows.items():
+                stage_summary = collections.OrderedDict([('count', window.count)])
+                for point, p in zip(percentile_points, window.percentiles()):
+                    stage_summary['p{:d}'.format(point)] = round(p * 1000.0, 3)
+                summary[stage] = stage_summary
+            return summary
+
+    def dump(self, file_name):
+        """Write the summary to a JSON file"""
+        with open(file_name, 'w') as f:
+            json.dump(self.summary(), f, indent=2)
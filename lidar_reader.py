@@ -0,0 +1,145 @@
+"""
+Background reader for the lidar.
+
+A dedicated thread pulls rotations off the serial port and keeps the
+most recent ones in a bounded ring.  Analysis and output consume from
+the ring at their own pace, so a slow consumer (like a snapshot file
+write) never lets the XV11 UART buffer overflow.
+"""
+import collections
+import threading
+import logging
+import time
+from time import sleep
+
+from laser import Rotation
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+
+class RotationReader(threading.Thread):
+    """
+    Producer side of the lidar pipeline.
+
+    reader = RotationReader(Laser(port, streaming=True), capacity=4)
+    reader.start()
+    while True:
+        rotation = reader.get_rotation(timeout=1.0)
+
+    When the ring is full, the drop policy decides which rotation
+    is thrown away: the oldest one in the ring (the default, keeps
+    the consumer looking at fresh data) or the newest one read.
+
+    With raw=True the rotation factory is handed the undecoded packet
+    bytes, which is what ArrayRotation wants.   Given a LatencyStats,
+    the reader records the read and decode time of every rotation.
+    """
+    drop_oldest = 'oldest'
+    drop_newest = 'newest'
+
+    # seconds to wait before retrying after a failed read
+    error_backoff = 0.1
+
+    def __init__(self, laser, capacity=4, drop_policy=drop_oldest,
+                 reverse_data=True, rotation_factory=Rotation, raw=False, latency=None):
+        super(RotationReader, self).__init__(name='lidar-reader')
+        self.daemon = True
+
+        if drop_policy not in (RotationReader.drop_oldest, RotationReader.drop_newest):
+            raise ValueError("Unknown drop policy: {}".format(drop_policy))
+
+        self.laser = laser
+        self.capacity = capacity
+        self.drop_policy = drop_policy
+        self.reverse_data = reverse_data
+        self.rotation_factory = rotation_factory
+        self.raw = raw
+        self.latency = latency
+
+        self.rotations = collections.deque()
+        self.condition = threading.Condition()
+        self.stopping = threading.Event()
+        self.pending_error = None
+
+        # counters
+        self.rotations_read = 0
+        self.dropped_rotations = 0
+        self.read_errors = 0
+
+    def run(self):
+        """Read rotations until stopped"""
+        while not self.stopping.is_set():
+            try:
+                read_start = time.time()
+                if self.raw:
+                    packets = self.laser.gather_raw_rotation()
+                else:
+                    packets = self.laser.gather_full_rotation(reverse_data=self.reverse_data)
+                decode_start = time.time()
+                rotation = self.rotation_factory(packets)
+                rotation.timestamp = time.time()
+
+                # when each slice arrived (raw packets do not carry it)
+                slice_times = getattr(self.laser, 'slice_times', None)
+                if slice_times is not None:
+                    rotation.slice_times = slice_times
+
+                if self.latency is not None:
+                    self.latency.record('read', decode_start - read_start)
+                    self.latency.record('decode', rotation.timestamp - decode_start)
+            except IOError as e:
+                with self.condition:
+                    self.read_errors = self.read_errors + 1
+                    self.pending_error = e
+                    self.condition.notify()
+                logger.error("Failed to gather a full rotation of data.")
+                sleep(RotationReader.error_backoff)
+                continue
+            self.put(rotation)
+
+    def stop(self):
+        """Ask the reader to finish after the rotation in progress"""
+        self.stopping.set()
+
+    def put(self, rotation):
+        """
+        Add a completed rotation to the ring, applying the drop policy.
+        Each rotation is numbered as it is read, so gaps show the drops.
+        """
+        with self.condition:
+            self.rotations_read = self.rotations_read + 1
+            rotation.sequence = self.rotations_read
+            if len(self.rotations) >= self.capacity:
+                self.dropped_rotations = self.dropped_rotations + 1
+                if self.drop_policy == RotationReader.drop_newest:
+                    return
+                self.rotations.popleft()
+            self.rotations.append(rotation)
+            self.condition.notify()
+
+    def get_rotation(self, timeout=None):
+        """
+        Return the next rotation from the ring (oldest first).
+        Raise IOError if the reader failed or nothing arrives in time.
+        """
+        with self.condition:
+            if not self.rotations and self.pending_error is None:
+                self.condition.wait(timeout)
+
+            if self.rotations:
+                return self.rotations.popleft()
+
+            error = self.pending_error
+            self.pending_error = None
+            if error is not None:
+                raise error
+            raise IOError("No rotation available from the lidar reader")
+
+    def stats(self):
+        """Counters describing how well the consumer is keeping up"""
+        with self.condition:
+            return {'read': self.rotations_read,
+                    'dropped': self.dropped_rotations,
+                    'errors': self.read_errors,
+                    'queued': len(self.rotations)}
@@ -0,0 +1,162 @@
+"""
+Robot pose on the field from a lidar rotation.
+
+The rotation is matched against the ranges FieldModel says the lidar
+would read from candidate poses.   The search is coarse to fine: a small
+grid of positions and headings around the last pose is scored, the best
+one becomes the center of a finer grid, and so on.   Each level is one
+vectorized render of every candidate, and the search stops refining when
+the next level would not fit in the time budget (a rotation period,
+unless told otherwise), so a pose is always ready before the next
+rotation arrives.
+
+Without a pose to start from (at startup, or after losing track) the
+search starts from the best matches in a PoseTable instead, if there is
+one.
+
+Poses follow Robot: x and y in inches from the origin, heading in
+degrees, positive clockwise.
+
+    localizer = Localizer(FieldModel())
+    pose = localizer.localize(rotation)
+    pose.x, pose.y, pose.heading, pose.error
+"""
+import collections
+import time
+import numpy as np
+
+from analyzer import HeadingIndex
+from deskew import no_range, SECONDS_PER_MINUTE
+from field_model import Robot, render_ranges
+
+# error is the mean range error (inches) of the match
+Pose = collections.namedtuple('Pose', 'x y heading error')
+
+
+def observed_ranges(rotation):
+    """Ranges of a rotation by heading (0 to 359), inf where there is no good reading"""
+    if hasattr(rotation, 'polar_array'):
+        index = HeadingIndex.from_arrays(*rotation.polar_array())
+    else:
+        index = HeadingIndex(rotation.polar_data())
+    ranges = index.ranges.copy()
+    ranges[ranges >= no_range] = np.inf
+    return ranges
+
+
+class Localizer(object):
+    """
+    Coarse to fine pose search seeded from the last pose.
+    A match with a mean range error over lost_error inches does not
+    move the seed, so one bad rotation does not throw the search off;
+    with a table the next search starts from the table's matches, without
+    one it starts from the last good pose again.
+    """
+    # (position step in inches, heading step in degrees) of each level
+    levels = ((12.0, 8.0), (4.0, 3.0), (1.5, 1.0), (0.5, 0.3))
+    # candidates either side of the center, along each axis
+    steps = 2
+    # range errors are clipped to this, so a few stray readings do not swamp the match
+    outlier_range = 24.0
+    lost_error = 6.0
+    # table matches the search starts from when it is not tracking
+    warm_start_poses = 5
+
+    def __init__(self, field_model, pose=None, budget=None, table=None):
+        self.segments = field_model.segment_array
+        self.pose = Robot() if pose is None else pose
+        self.budget = budget
+        self.table = table
+        # tracking means the last pose is good enough to start from
+        self.tracking = pose is not None or table is None
+
+        offsets = np.arange(-Localizer.steps, Localizer.steps + 1, dtype=float)
+        grid = np.meshgrid(offsets, offsets, offsets, indexing='ij')
+        self.offsets = np.column_stack([axis.ravel() for axis in grid])
+
+        # counters
+        self.runs = 0
+        self.levels_run = 0
+        self.budget_stops = 0
+        self.lost = 0
+        self.warm_starts = 0
+        self.elapsed = 0.0
+
+    def reset(self, pose=None):
+        """Seed the next search from pose (a Robot), or the origin (or the table if there is one)"""
+        self.pose = Robot() if pose is None else pose
+        self.tracking = pose is not None or self.table is None
+
+    def rotation_budget(self, rotation):
+        """Seconds the search may take: the budget if set, else one rotation period"""
+        if self.budget is not None:
+            return self.budget
+        rpm = rotation.rpm() if callable(rotation.rpm) else rotation.rpm
+        return SECONDS_PER_MINUTE / rpm if rpm > 0 else 0.2
+
+    def match_errors(self, observed, view_headings, positions, headings):
+        """Mean clipped range error of each candidate pose against the observed ranges"""
+        expected = render_ranges(self.segments, positions, headings, view_headings)
+        errors = np.minimum(np.abs(expected - observed), Localizer.outlier_range)
+        return errors.mean(axis=1)
+
+    def localize(self, rotation, budget=None):
+        """Search for the pose that best explains the rotation and return it as a Pose"""
+        start = time.time()
+        budget = self.rotation_budget(rotation) if budget is None else budget
+        self.runs = self.runs + 1
+
+        observed = observed_ranges(rotation)
+        view_headings = np.flatnonzero(np.isfinite(observed))
+        if len(view_headings) == 0:
+            self.lost = self.lost + 1
+            return None
+        observed = observed[view_headings]
+
+        x, y = self.pose.position
+        centers = np.array([(x, y, float(self.pose.heading))])
+        if not self.tracking:
+            warm_start = self.table.best_poses(rotation, Localizer.warm_start_poses)
+            if warm_start:
+                centers = np.array([(pose.x, pose.y, pose.heading) for pose in warm_start])
+                self.warm_starts = self.warm_starts + 1
+
+        error = np.inf
+        level_time = 0.0
+        for position_step, heading_step in Localizer.levels:
+            # the first level always runs, the others only if they fit
+            level_start = time.time()
+            if level_time > 0 and level_start - start + level_time > budget:
+                self.budget_stops = self.budget_stops + 1
+                break
+
+            steps = self.offsets * (position_step, position_step, heading_step)
+            candidates = (steps + centers[:, np.newaxis]).reshape(-1, 3)
+            errors = self.match_errors(observed, view_headings, candidates[:, 0:2], candidates[:, 2])
+            best = int(errors.argmin())
+            if errors[best] <= error:
+                centers = candidates[best:best + 1]
+                error = float(errors[best])
+
+            self.levels_run = self.levels_run + 1
+            level_time = time.time() - level_start
+
+        x, y, heading = centers[0].tolist()
+        if error > Localizer.lost_error:
+            self.lost = self.lost + 1
+            # without a table the only place to start from is the last good pose
+            self.tracking = self.table is None
+        else:
+            self.pose = Robot((x, y), heading)
+            self.tracking = True
+        self.elapsed = time.time() - start
+        return Pose(x, y, heading, error)
+
+    def stats(self):
+        """Counters of the searches so far"""
+        return collections.OrderedDict([('runs', self.runs),
+                                        ('levels', self.levels_run),
+                                        ('budget_stops', self.budget_stops),
+                                        ('lost', self.lost),
+                                        ('warm_starts', self.warm_starts),
+                                        ('last_ms', round(self.elapsed * 1000.0, 3))])
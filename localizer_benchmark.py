@@ -0,0 +1,76 @@
+"""
+Synthetic benchmark for the localizer, no lidar needed.
+
+Robots are put at random poses in front of the back wall and the field
+model is scanned from each one (FakeRotation).   The localizer is seeded
+with the true pose knocked off by up to the given position (inches) and
+heading (degrees) error, as if the last pose were that stale, and the
+pose it finds is compared with the truth.
+
+    python localizer_benchmark.py 200 6 5
+"""
+from __future__ import print_function
+import sys
+import time
+import numpy as np
+
+from field_model import FieldModel, Robot, FakeRotation
+from localizer import Localizer
+
+
+def random_robots(count, generator):
+    """Robots spread over the working area, facing the back wall give or take 45 degrees"""
+    return [Robot((generator.uniform(-60, 60), generator.uniform(0, 80)), generator.uniform(-45, 45))
+            for _ in range(count)]
+
+
+def run_benchmark(count=200, position_noise=6.0, heading_noise=5.0, budget=None, seed=1):
+    """
+    Localize count fake rotations.  Return (median position error in inches,
+    median heading error in degrees, fraction within 1 inch and 1 degree,
+    milliseconds per rotation, rotations with no pose at all).
+    """
+    generator = np.random.RandomState(seed)
+    field = FieldModel()
+    robots = random_robots(count, generator)
+    rotations = FakeRotation.for_robots(field, robots, rpm=300)
+
+    position_errors, heading_errors = [], []
+    failures = 0
+    seconds = 0.0
+    for robot, rotation in zip(robots, rotations):
+        x, y = robot.position
+        seed_pose = Robot((x + generator.uniform(-position_noise, position_noise),
+                           y + generator.uniform(-position_noise, position_noise)),
+                          robot.heading + generator.uniform(-heading_noise, heading_noise))
+        localizer = Localizer(field, seed_pose, budget)
+
+        began = time.time()
+        pose = localizer.localize(rotation)
+        seconds = seconds + time.time() - began
+
+        if pose is None:
+            failures = failures + 1
+            continue
+        position_errors.append(np.hypot(pose.x - x, pose.y - y))
+        heading_errors.append(abs(pose.heading - robot.heading))
+
+    position_errors = np.array(position_errors)
+    heading_errors = np.array(heading_errors)
+    close = np.count_nonzero((position_errors < 1.0) & (heading_errors < 1.0)) / float(count)
+    if len(position_errors) == 0:
+        return np.nan, np.nan, close, seconds / count * 1000.0, failures
+    return np.median(position_errors), np.median(heading_errors), close, seconds / count * 1000.0, failures
+
+
+if __name__ == '__main__':
+
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    position_noise = float(sys.argv[2]) if len(sys.argv) > 2 else 6.0
+    heading_noise = float(sys.argv[3]) if len(sys.argv) > 3 else 5.0
+
+    position_error, heading_error, close, milliseconds, failures = run_benchmark(count, position_noise, heading_noise)
+    print("{:d} poses, seeded within {:.1f} in and {:.1f} deg".format(count, position_noise, heading_noise))
+    print("median error: {:.2f} in, {:.2f} deg".format(position_error, heading_error))
+    print("{:.0f}% within 1 in and 1 deg, {:d} with no pose".format(close * 100, failures))
+    print("localize takes {:.1f} ms per rotation".format(milliseconds))
@@ -18,14 +18,26 @@ import struct
 import binascii
 import collections
 import itertools
+import json
 import math
+import time
 from time import sleep
 import socket
 from udp_channels import *
 from sensor_message import *
-from analyzer import Analyzer, find_wall_midpoint
-from lidar_logger import LidarLogger
-from laser import Laser, Reading, Packet, Rotation
+from analyzer import Analyzer
+from rotation_log import RotationLogWriter, RotationLogError, rotation_record
+from serial_capture import CaptureSerial, ReplaySerial
+from laser import Laser, Reading, Packet, Rotation, ArrayRotation
+from lidar_reader import RotationReader
+from deskew import Odometry
+from latency import LatencyStats
+from rotation_fusion import RotationFusion
+from pipeline import standard_pipeline
+from field_model import FieldModel
+from localizer import Localizer
+from pose_table import PoseTable
+from scan_matcher import ScanMatcher
 
 import logging
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -41,22 +53,80 @@ if __name__ == '__main__':
 
         robot_name = '10.10.76.2'
         
-        channel = UDPChannel(remote_ip=robot_name, remote_port=5880,
-                              local_ip='0.0.0.0', local_port=52954)
+        channel = AsyncUDPChannel(remote_ip=robot_name, remote_port=5880,
+                                  local_ip='0.0.0.0', local_port=52954)
+
+        #
+        # revised instructions from the robot arrive on the channel thread
+        #
+        def update_sweep(message_from_robot, robot_address):
+                if message_from_robot.sender == 'robot':
+                        Analyzer.start = message_from_robot.start
+                        Analyzer.stop = message_from_robot.stop
+                        logger.info("robot asked for sweep ({:d}, {:d})".format(Analyzer.start, Analyzer.stop))
+
+        def update_wire_format(message_from_robot, robot_address):
+                negotiate_wire_format(message_from_robot)
+                logger.info("robot asked for {} messages".format(SensorMessage.wire_format))
+
+        channel.on_message('sweep', update_sweep)
+        channel.on_message('format', update_wire_format)
+
+        # the robot reports how it is moving, so rotations can be de-skewed
+        odometry = Odometry()
+        channel.on_message('odometry', odometry.update)
+
+        # how long each stage takes, and how stale the results are when sent
+        latency = LatencyStats()
+
+        #
+        # the analyses run over every rotation (see pipeline.py), switched on
+        # and off by lidar_pipeline.json, if there is one, and by the robot
+        #
+        # build the table of expected scans with: python pose_table.py data/pose_table.npy
+        pose_table_name = 'data/pose_table.npy'
+        pose_table = PoseTable.load(pose_table_name) if os.path.isfile(pose_table_name) else None
+        localizer = Localizer(FieldModel(), table=pose_table)
+        # the lidar's own estimate of how the robot moves, rotation to rotation
+        matcher = ScanMatcher(budget=0.02)
+        pipeline = standard_pipeline(odometry, RotationFusion(depth=5), latency, localizer, matcher)
+        pipeline_config_name = 'lidar_pipeline.json'
+        if os.path.isfile(pipeline_config_name):
+                pipeline.load_config(pipeline_config_name)
+        channel.on_message('pipeline', pipeline.update_from_robot)
+        channel.start()
+
         range_at_heading_message = LidarRangeAtHeadingMessage()
         periodic_message = LidarPeriodicMessage()
         wall_message = LidarWallMessage()
+        rotation_result_message = LidarRotationResultMessage()
+        pose_message = LidarPoseMessage()
+        odometry_message = LidarOdometryMessage()
         #lidar_logger = LidarLogger(logger)
 
         file_index = 1
-        rotation_time = 0
-        current_time = 0
+        last_output_time = time.time()
         seconds_per_output = 1
         SECONDS_PER_MINUTE = 60.0
         
         calibrated_zero = 6
         lp = None
         lasr = None
+        reader = None
+
+        # completed rotations buffered between the serial reader and the analysis
+        rotation_queue_size = 4
+
+        # send one rotation result datagram per rotation instead of one per analysis
+        bundle_results = True
+
+        # tee the raw serial bytes to a capture file (replay it by passing the
+        # capture file name in place of the serial port name)
+        capture_serial = False
+
+        # (ip, port) pairs that also get every full rotation, fragmented
+        # across datagrams (a driver station display or a logger, say)
+        telemetry_destinations = []
 
         if len(sys.argv) > 1:
                 serial_port_name = sys.argv[1]
@@ -83,6 +153,22 @@ if __name__ == '__main__':
                 suppress_robot_comm = True
         else:
                 suppress_robot_comm = False
+
+        # captures, rotation logs and latency dumps all go in data/
+        data_dir = 'data'
+        if not os.path.isdir(data_dir):
+                try:
+                        os.makedirs(data_dir)
+                except OSError:
+                        logger.error('Unable to create {}, nothing will be logged'.format(data_dir))
+
+        # every rotation goes into the binary rotation log, if it can be opened
+        rotation_log_name = os.path.join(data_dir, "lidar_rotations_{:d}.log".format(file_index))
+        try:
+                rotation_log = RotationLogWriter(rotation_log_name)
+        except (IOError, OSError, RotationLogError) as e:
+                logger.error('Unable to open rotation log {}: {}'.format(rotation_log_name, e))
+                rotation_log = None
         
 	while 1: 
                 if lp is None:
@@ -91,8 +177,18 @@ if __name__ == '__main__':
 		                #lp = serial.Serial('/dev/ttyUSB0',115200,timeout=1)
 		                #lp = serial.Serial('/dev/tty.usbserial',115200,timeout=1)
 		                #lp = serial.Serial('/dev/tty.wchusbserial1420',115200,timeout=1)
-                                lp = serial.Serial(serial_port_name, 115200, timeout=1)
-                                lasr = Laser(lp)
+                                if os.path.isfile(serial_port_name):
+                                        lp = ReplaySerial(serial_port_name, speed=1.0)
+                                else:
+                                        lp = serial.Serial(serial_port_name, 115200, timeout=1)
+                                if capture_serial:
+                                        lp = CaptureSerial(lp, os.path.join(data_dir, "lidar_capture_{:d}.cap".format(file_index)))
+                                lasr = Laser(lp, streaming=True)
+                                reader = RotationReader(lasr, capacity=rotation_queue_size,
+                                                        drop_policy=RotationReader.drop_oldest,
+                                                        rotation_factory=ArrayRotation, raw=True,
+                                                        latency=latency)
+                                reader.start()
                         except: 
                                 logger.critical('Unable to open lidar port: {}'.format(serial_port_name))
                                 logger.critical('Try /dev/ttyUSB0, or maybe /dev/tty.wchusbserial1420, or maybe /dev/tty.usbserial')
@@ -101,38 +197,39 @@ if __name__ == '__main__':
                                 if not suppress_robot_comm:
                                         channel.send_to(periodic_message.encode_message())
                                 logger.error('Lidar port could not be opened.')
+                                # try again in a moment, from the start
+                                lp = None
+                                sleep(1)
 
-                if lasr is not None:
+                if reader is not None:
                         try:
-                                # NOTE: because lidar is upside down, this needs to be reversed?
-                                rotation = Rotation(lasr.gather_full_rotation(reverse_data=True))
+                                # NOTE: because lidar is upside down, the reader reverses the data
+                                rotation = reader.get_rotation(timeout=1.0)
+                                analyze_start = time.time()
+                                results = pipeline.run(rotation)
                                 
                                 #
-                                # For now, we just output a lidar data snapshot every 10 seconds
-                                # We will want this for debugging (maybe every second instead)
-                                # change the "seconds_per_output" to tune that.
+                                # closest hit in the sweep the robot asked for
                                 #
-                                tgt_heading, tgt_range = Analyzer.range_at_heading(rotation.polar_data(), (Analyzer.start, Analyzer.stop))
-                                logger.info("{:d} points yields {:.2f} inches at {:2d} degrees)".format(len(rotation.polar_data()),tgt_range, tgt_heading))
+                                if results['range_at_heading'] is not None:
+                                        tgt_heading, tgt_range = results['range_at_heading']
+                                        logger.info("{:d} points yields {:.2f} inches at {:2d} degrees)".format(len(rotation.polar_data()),tgt_range, tgt_heading))
                         
-                                # push the newly calculated data into the message
-                                range_at_heading_message.heading = tgt_heading
-                                range_at_heading_message.range = tgt_range
-                                if not suppress_robot_comm:
-                                        channel.send_to(range_at_heading_message.encode_message())
+                                        # push the newly calculated data into the message
+                                        range_at_heading_message.heading = tgt_heading
+                                        range_at_heading_message.range = tgt_range
                                 
-                                # push periodic message to the bot
+                                # periodic message for the bot
                                 periodic_message.status = 'ok'
                                 periodic_message.rpm = rotation.rpm()
-                                if not suppress_robot_comm:
-                                        channel.send_to(periodic_message.encode_message())
                                 logger.info("reported rpm is {:d}".format(rotation.rpm()))
 
                                 #
-                                # send out the wall heading and distance report  (disabled)
+                                # wall heading and distance report
                                 #
-                                if 0:
-                                        (wall_heading, wall_distance, wall_orientation) = find_wall_midpoint(rotation.cartesian_data())
+                                report_wall = results['wall'] is not None
+                                if report_wall:
+                                        (wall_heading, wall_distance, wall_orientation) = results['wall']
                                         logger.info("find_wall_midpoint => heading {:.1f}, range {:.1f}, orientation {:.1f})".format(wall_heading, wall_distance, wall_orientation))
                                         if (wall_heading, wall_distance, wall_orientation) == (0, 0, 0):
                                                 wall_message.status = 'error'
@@ -141,8 +238,63 @@ if __name__ == '__main__':
                                                 wall_message.range = wall_distance
                                                 wall_message.heading = wall_heading
                                                 wall_message.orientation = wall_orientation
-                                                if not suppress_robot_comm:
-                                                        channel.send_to(wall_message.encode_message())
+
+                                #
+                                # where the robot is on the field
+                                #
+                                report_pose = results.get('localize') is not None
+                                if report_pose:
+                                        pose = results['localize']
+                                        pose_message.status = 'ok' if pose.error <= Localizer.lost_error else 'error'
+                                        pose_message.x, pose_message.y = pose.x, pose.y
+                                        pose_message.heading, pose_message.error = pose.heading, pose.error
+
+                                #
+                                # how far the robot moved since the last rotation, when the
+                                # scans matched this rotation (not skipped, failed or off)
+                                #
+                                report_odometry = results.get('scan_match') is not None
+                                if report_odometry:
+                                        odometry_message.fill(results['scan_match'])
+
+                                latency.record('analyze', time.time() - analyze_start)
+
+                                #
+                                # send the results, all in one datagram when bundling
+                                #
+                                if not suppress_robot_comm:
+                                        with latency.timing('encode'):
+                                                if bundle_results:
+                                                        rotation_result_message.collect(rotation.sequence, rotation.timestamp,
+                                                                                        range_at_heading_message, periodic_message,
+                                                                                        wall_message if report_wall else None,
+                                                                                        pose_message if report_pose else None,
+                                                                                        odometry_message if report_odometry else None)
+                                                        outgoing = [rotation_result_message.encode_message()]
+                                                else:
+                                                        outgoing = [range_at_heading_message.encode_message(),
+                                                                    periodic_message.encode_message()]
+                                                        if report_wall and wall_message.status == 'ok':
+                                                                outgoing.append(wall_message.encode_message())
+                                                        if report_pose:
+                                                                outgoing.append(pose_message.encode_message())
+                                                        if report_odometry:
+                                                                outgoing.append(odometry_message.encode_message())
+                                        with latency.timing('send'):
+                                                for message in outgoing:
+                                                        channel.send_to(message)
+                                        if rotation.last_packet_time is not None:
+                                                latency.record('age', time.time() - rotation.last_packet_time)
+
+                                if telemetry_destinations:
+                                        channel.send_fragmented(rotation_record(rotation, rotation.timestamp),
+                                                                telemetry_destinations)
+
+                                #
+                                # every rotation goes into the binary rotation log
+                                #
+                                if rotation_log is not None:
+                                        rotation_log.append(rotation)
                                 
                                 
  		        except IOError,e:
@@ -153,24 +305,24 @@ if __name__ == '__main__':
                                 logger.error("Failed to gather a full rotation of data.")
 
                         #
-                        # get revised instructions from robot
+                        # every so often, report stats locally and the latency to the robot
                         #
-                        if 0:
-                                robot_data, robot_address = channel.receive_from()
-                                message_from_robot = RobotMessage(robot_data)
-                                if ((message_from_robot.sender == 'robot') and
-                                    (message_from_robot.message == 'sweep')):
-                                        Analyzer.start = message_from_robot.start
-                                        Analyzer.stop = message_from_robot.stop
-                        #except socket.timeout:
-                        #        logger.info("No message received from robot")
-
-                        elapsed_time = (SECONDS_PER_MINUTE/float(rotation.rpm()))
-                        rotation_time = rotation_time + elapsed_time
-                        logger.info("rotation time is: {:.1f}".format(rotation_time))
-                        current_time = current_time + elapsed_time
-                        if rotation_time > seconds_per_output:
-                                fname = "data/lidar_snapshot_{:d}.dat".format(file_index)
-                                LidarLogger.write_to_file(fname, rotation.polar_data())
-                                file_index = file_index + 1
-                                rotation_time = 0
+                        current_time = time.time()
+                        if current_time - last_output_time > seconds_per_output:
+                                logger.info("reader stats: {}".format(reader.stats()))
+                                logger.info("laser stats: {}".format(lasr.stats()))
+                                logger.info("latency (ms): {}".format(json.dumps(latency.summary())))
+                                logger.info("pipeline: {}".format(json.dumps(pipeline.stats())))
+                                logger.info("localizer: {}".format(json.dumps(localizer.stats())))
+                                logger.info("scan matcher: {}".format(json.dumps(matcher.stats())))
+                                latency_name = os.path.join(data_dir, "lidar_latency_{:d}.json".format(file_index))
+                                try:
+                                        latency.dump(latency_name)
+                                except IOError as e:
+                                        logger.error('Unable to write latency to {}: {}'.format(latency_name, e))
+                                (periodic_message.latency_p50, periodic_message.latency_p95,
+                                 periodic_message.latency_p99) = latency.milliseconds('age')
+                                periodic_message.stage_latency = latency.summary()
+                                if not suppress_robot_comm:
+                                        channel.send_to(periodic_message.encode_message())
+                                last_output_time = current_time
@@ -23,7 +23,8 @@ from time import sleep
 import socket
 from udp_channels import *
 from sensor_message import *
-from analyzer import Analyzer, aggregate_distance
+from analyzer import Analyzer
+from rotation_fusion import RotationFusion
 from lidar_viewer import LidarLogger, LidarViewer
 from laser import Laser, Reading, Packet, Rotation
 import statistics
@@ -70,12 +71,11 @@ if __name__ == '__main__':
         current_time = 0
         seconds_per_output = 1
         SECONDS_PER_MINUTE = 60.0
-        rotations = []
+        fusion = RotationFusion(depth=5)
 	while 1: 
 		try:
                         rotation = Rotation(lasr.gather_full_rotation())
-                        rotations = rotations[-4:]
-                        rotations.append(rotation)
+                        fusion.add(rotation)
                         # rotation = OldRotation(lasr.gather_full_rotation())
                         #
                         # For now, we just output a lidar data snapshot every 10 seconds
@@ -119,14 +119,11 @@ if __name__ == '__main__':
                 rotation_time = rotation_time + elapsed_time
                 current_time = current_time + elapsed_time
                 if rotation_time > seconds_per_output:
-                        sorted_rot = sorted(list(itertools.chain(*rotations)), key = lambda(theta,_): theta)
-                        grouped_by = itertools.groupby(sorted_rot, lambda x: x[0])
-                        groups = [(key, list(items)) for key, items in grouped_by]
-                        polar_data = [(angle, aggregate_distance(ranges)) for angle, ranges in groups]
+                        polar_data = fusion.polar_data('mean')
                         lidar_viewer.plot_polar(polar_data)
                         lidar_viewer.plot_cartesian(rotation.cartesian_data())
                         lidar_logger.log_data(rotation.polar_data())
                         pdb.set_trace()
                         file_index = file_index + 1
                         rotation_time = 0
-                        rotations = []
+                        fusion.clear()
@@ -0,0 +1,252 @@
+"""
+Pluggable analysis pipeline for lidar rotations.
+
+Analyses are registered as named stages and run in order over each
+rotation.   A stage is a function of (rotation, results) where results
+holds what the earlier stages returned this rotation, by stage name.
+Every run of a stage is timed into the pipeline's LatencyStats.
+
+Each stage has a time budget.   Running over it is counted (overruns).
+A stage marked skip_over_budget is not run when the time already spent
+on the rotation plus its budget would take the pipeline over its own
+budget (the rest of the rotation period, say), so optional analyses give
+way when the rotation is running late.
+
+A stage that raises is logged and counted (failures), its result is
+None, and the stages after it still run, so one broken analysis does
+not stop the lidar reporting.
+
+Stages are switched on and off, and budgets changed, with configure(),
+from a JSON file or from a robot message:
+
+    {"sender": "robot", "message": "pipeline",
+     "budget": 0.15,
+     "stages": {"wall": {"enabled": false},
+                "fusion": {"enabled": true, "budget": 0.01, "skip_over_budget": true}}}
+"""
+import collections
+import json
+import logging
+import numbers
+import threading
+import time
+
+from analyzer import Analyzer, HeadingIndex, find_wall_midpoint
+from deskew import deskew_rotation
+from latency import LatencyStats
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+
+class Stage(object):
+    """One registered analysis and its settings and counters"""
+    settings = ('enabled', 'budget', 'skip_over_budget')
+
+    def __init__(self, name, analyze, budget=None, enabled=True, skip_over_budget=False):
+        self.name = name
+        self.analyze = analyze
+        self.budget = budget
+        self.enabled = enabled
+        self.skip_over_budget = skip_over_budget
+
+        # counters
+        self.runs = 0
+        self.skipped = 0
+        self.overruns = 0
+        self.failures = 0
+
+
+def check_setting(name, setting, value):
+    """Raise ValueError unless value suits the setting: a bool, or a budget that is None or seconds >= 0"""
+    if setting == 'budget':
+        if value is None:
+            return
+        if isinstance(value, numbers.Real) and not isinstance(value, bool) and value >= 0:
+            return
+        raise ValueError("Budget for {} must be null or seconds >= 0, not {!r}".format(name, value))
+    if not isinstance(value, bool):
+        raise ValueError("Setting {} for stage {} must be true or false, not {!r}".format(setting, name, value))
+
+
+class AnalysisPipeline(object):
+    """
+    pipeline = AnalysisPipeline(budget=0.15)
+    pipeline.register('range_at_heading', range_at_heading_stage, budget=0.005)
+    results = pipeline.run(rotation)
+    results['range_at_heading']     None if the stage is disabled or was skipped
+    """
+    def __init__(self, budget=None, latency=None):
+        self.budget = budget
+        self.latency = LatencyStats() if latency is None else latency
+        self.stages = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def register(self, name, analyze, budget=None, enabled=True, skip_over_budget=False):
+        """Add a stage after the ones already registered"""
+        with self.lock:
+            self.stages[name] = Stage(name, analyze, budget, enabled, skip_over_budget)
+        return self.stages[name]
+
+    def configure(self, config):
+        """
+        Apply a configuration dictionary: an optional pipeline "budget" and
+        per stage "enabled", "budget" and "skip_over_budget" under "stages".
+        Raise ValueError for unknown stages or settings, or for a value of
+        the wrong kind, before changing anything.
+        """
+        if not isinstance(config, dict):
+            raise ValueError("Pipeline configuration is not an object")
+        if 'budget' in config:
+            check_setting('pipeline', 'budget', config['budget'])
+        stage_configs = config.get('stages', {})
+        if not isinstance(stage_configs, dict):
+            raise ValueError("Pipeline stages are not an object")
+        for name, stage_config in stage_configs.items():
+            if name not in self.stages:
+                raise ValueError("Unknown analysis stage: {}".format(name))
+            if not isinstance(stage_config, dict):
+                raise ValueError("Settings for stage {} are not an object".format(name))
+            for setting, value in stage_config.items():
+                if setting not in Stage.settings:
+                    raise ValueError("Unknown setting for stage {}: {}".format(name, setting))
+                check_setting(name, setting, value)
+
+        with self.lock:
+            if 'budget' in config:
+                self.budget = config['budget']
+            for name, stage_config in stage_configs.items():
+                for setting, value in stage_config.items():
+                    setattr(self.stages[name], setting, value)
+
+    def load_config(self, file_name):
+        """Configure the pipeline from a JSON file"""
+        with open(file_name) as f:
+            self.configure(json.load(f))
+
+    def update_from_robot(self, message, address=None):
+        """Channel callback for 'pipeline' messages from the robot"""
+        try:
+            self.configure(message.contents)
+        except (ValueError, AttributeError, TypeError) as e:
+            logger.error("Bad pipeline configuration from the robot: {}".format(e))
+
+    def run(self, rotation):
+        """Run the enabled stages over the rotation and return their results by name"""
+        with self.lock:
+            stages = list(self.stages.values())
+            budget = self.budget
+
+        results = collections.OrderedDict()
+        start = time.time()
+        for stage in stages:
+            results[stage.name] = None
+            if not stage.enabled:
+                continue
+
+            stage_start = time.time()
+            if (stage.skip_over_budget and budget is not None and
+                    stage_start - start + (stage.budget or 0.0) > budget):
+                stage.skipped = stage.skipped + 1
+                continue
+
+            try:
+                results[stage.name] = stage.analyze(rotation, results)
+            except Exception:
+                logger.exception("Analysis stage {} failed".format(stage.name))
+                stage.failures = stage.failures + 1
+            elapsed = time.time() - stage_start
+            stage.runs = stage.runs + 1
+            self.latency.record(stage.name, elapsed)
+            if stage.budget is not None and elapsed > stage.budget:
+                stage.overruns = stage.overruns + 1
+        return results
+
+    def stats(self):
+        """Settings, counters and latency (milliseconds) of every stage"""
+        summary = self.latency.summary()
+        with self.lock:
+            stats = collections.OrderedDict()
+            for name, stage in self.stages.items():
+                stats[name] = collections.OrderedDict([('enabled', stage.enabled),
+                                                       ('budget', stage.budget),
+                                                       ('skip_over_budget', stage.skip_over_budget),
+                                                       ('runs', stage.runs),
+                                                       ('skipped', stage.skipped),
+                                                       ('overruns', stage.overruns),
+                                                       ('failures', stage.failures)])
+                stats[name].update(summary.get(name, {}))
+            return stats
+
+
+#
+#  The standard stages.   Each one takes the rotation and the results so far.
+#
+def deskew_stage(odometry):
+    """Stage that corrects the -90 to 90 view for the robot's motion: (headings, ranges)"""
+    def deskew(rotation, results):
+        return deskew_rotation(rotation, *odometry.motion())
+    return deskew
+
+
+def range_at_heading_stage(rotation, results):
+    """Closest hit in the sweep the robot asked for: (heading, range)"""
+    polar = results.get('deskew')
+    if polar is not None:
+        heading_index = HeadingIndex.from_arrays(*polar)
+    elif hasattr(rotation, 'polar_array'):
+        heading_index = HeadingIndex.from_arrays(*rotation.polar_array())
+    else:
+        heading_index = HeadingIndex(rotation.polar_data())
+    return heading_index.range_at_heading((Analyzer.start, Analyzer.stop))
+
+
+def wall_midpoint_stage(rotation, results):
+    """Heading and range to the middle of the wall, and the turn to be parallel to it"""
+    return find_wall_midpoint(rotation.cartesian_data())
+
+
+def fusion_stage(fusion):
+    """Stage that adds each rotation to a RotationFusion and returns the fused statistics"""
+    def fuse(rotation, results):
+        fusion.add(rotation)
+        return fusion.fused()
+    return fuse
+
+
+def localize_stage(localizer, stage=None):
+    """
+    Stage that finds the robot's pose on the field: a localizer Pose.
+    Given its Stage, the search keeps to the stage's budget.
+    """
+    def localize(rotation, results):
+        return localizer.localize(rotation, stage.budget if stage is not None else None)
+    return localize
+
+
+def scan_match_stage(matcher):
+    """Stage that matches each rotation against the one before: a ScanMotion, or None"""
+    def scan_match(rotation, results):
+        return matcher.update(rotation)
+    return scan_match
+
+
+def standard_pipeline(odometry=None, fusion=None, latency=None, localizer=None, matcher=None):
+    """
+    The lidar's usual analyses: de-skew (with odometry), range at heading,
+    wall midpoint, (disabled until asked for) fusion, localization and
+    scan matching.
+    """
+    pipeline = AnalysisPipeline(latency=latency)
+    if odometry is not None:
+        pipeline.register('deskew', deskew_stage(odometry), budget=0.002)
+    pipeline.register('range_at_heading', range_at_heading_stage, budget=0.002)
+    pipeline.register('wall', wall_midpoint_stage, budget=0.02, skip_over_budget=True)
+    if fusion is not None:
+        pipeline.register('fusion', fusion_stage(fusion), budget=0.005, enabled=False, skip_over_budget=True)
+    if localizer is not None:
+        stage = pipeline.register('localize', None, budget=0.05, skip_over_budget=True)
+        stage.analyze = localize_stage(localizer, stage)
+    if matcher is not None:
+        pipeline.register('scan_match', scan_match_stage(matcher), budget=matcher.budget)
+    return pipeline
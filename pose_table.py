@@ -0,0 +1,128 @@
+"""
+Precomputed table of the scans the lidar would see from a grid of poses.
+
+Built offline from the field model, saved as a single .npy file and
+memory-mapped at startup, so a global search for the robot's pose is a
+vectorized scan down the table rather than a render per candidate.
+It gives the Localizer somewhere to start when it has no idea (at
+startup, or after it has lost track).
+
+Each row is one pose and its 360 expected ranges, by lidar heading, in
+tenths of an inch (uint16), no_hit where the ray misses the field.
+Headings are whole degrees: the scan at heading h is the heading 0 scan
+turned by h, so only the positions are rendered.
+
+    python pose_table.py data/pose_table.npy
+
+    table = PoseTable.load('data/pose_table.npy')
+    poses = table.best_poses(rotation, k=5)
+"""
+from __future__ import print_function
+import sys
+import time
+import numpy as np
+
+from field_model import FieldModel, FakeRotation, Robot, lidar_headings, render_ranges
+from localizer import Localizer, Pose, observed_ranges
+
+range_scale = 10.0
+no_hit = 0xffff
+
+table_dtype = np.dtype([('x', '<f4'), ('y', '<f4'), ('heading', '<f4'), ('ranges', '<u2', (len(lidar_headings),))])
+
+# default grid: the working area in front of the back wall, every 6 inches and 5 degrees
+default_xs = np.arange(-72, 73, 6)
+default_ys = np.arange(0, 109, 6)
+default_headings = np.arange(-180, 180, 5)
+
+
+def quantize(ranges):
+    """Ranges in inches to tenths of an inch (uint16), no_hit for inf"""
+    ranges = np.asarray(ranges, dtype=float)
+    finite = np.isfinite(ranges)
+    quantized = np.full(ranges.shape, no_hit, dtype=np.uint16)
+    quantized[finite] = np.minimum(np.rint(ranges[finite] * range_scale), no_hit - 1)
+    return quantized
+
+
+def build_pose_table(field_model, xs=default_xs, ys=default_ys, headings=default_headings):
+    """Render the expected scans for every combination of x, y and (whole degree) heading"""
+    x, y = [axis.ravel() for axis in np.meshgrid(np.asarray(xs, dtype=float), np.asarray(ys, dtype=float),
+                                                    indexing='ij')]
+    straight_ahead = quantize(render_ranges(field_model.segment_array, np.column_stack((x, y)), np.zeros(len(x))))
+
+    headings = np.asarray(headings, dtype=int)
+    table = np.zeros(len(x) * len(headings), dtype=table_dtype)
+    for ndx, heading in enumerate(headings.tolist()):
+        rows = slice(ndx * len(x), (ndx + 1) * len(x))
+        table['x'][rows] = x
+        table['y'][rows] = y
+        table['heading'][rows] = heading
+        # turning the robot right by heading moves what it sees left by heading
+        table['ranges'][rows] = straight_ahead[:, (lidar_headings - heading) % len(lidar_headings)]
+    return PoseTable(table)
+
+
+class PoseTable(object):
+    """
+    The expected scans, searchable by how well they match a rotation.
+    Ranges are compared the way the Localizer does it: mean range error,
+    each heading's error clipped to Localizer.outlier_range.
+    """
+    # compare every stride-th observed heading (neighbouring headings say much the same thing)
+    stride = 3
+
+    def __init__(self, table):
+        self.table = table
+
+    def __len__(self):
+        return len(self.table)
+
+    def save(self, file_name):
+        np.save(file_name, self.table)
+
+    @classmethod
+    def load(cls, file_name, mmap_mode='r'):
+        """Open a saved table, memory-mapped unless mmap_mode is None"""
+        return cls(np.load(file_name, mmap_mode=mmap_mode))
+
+    def pose(self, row, error=0.0):
+        entry = self.table[row]
+        return Pose(float(entry['x']), float(entry['y']), float(entry['heading']), error)
+
+    def best_poses(self, rotation, k=5):
+        """The k poses whose scans best match the rotation, best first, as localizer Poses"""
+        observed = observed_ranges(rotation)
+        view_headings = np.flatnonzero(np.isfinite(observed))[::PoseTable.stride]
+        if len(view_headings) == 0:
+            return []
+
+        expected = self.table['ranges'][:, view_headings] / np.float32(range_scale)
+        errors = np.minimum(np.abs(expected - observed[view_headings].astype(np.float32)), Localizer.outlier_range)
+        errors = errors.mean(axis=1)
+
+        k = min(k, len(errors))
+        best = np.argpartition(errors, k - 1)[:k]
+        best = best[np.argsort(errors[best])]
+        return [self.pose(row, float(errors[row])) for row in best.tolist()]
+
+
+if __name__ == '__main__':
+
+    file_name = sys.argv[1] if len(sys.argv) > 1 else 'data/pose_table.npy'
+
+    began = time.time()
+    field = FieldModel()
+    build_pose_table(field).save(file_name)
+    print("built {} in {:.1f} s".format(file_name, time.time() - began))
+
+    table = PoseTable.load(file_name)
+    robot = Robot((10.0, 40.0), 20.0)
+    rotation = FakeRotation(field, robot)
+    began = time.time()
+    poses = table.best_poses(rotation)
+    print("{:d} poses, {:.1f} MB".format(len(table), table.table.nbytes / 1e6))
+    print("query takes {:.1f} ms".format((time.time() - began) * 1000))
+    print("robot at {}, best matches:".format((robot.position, robot.heading)))
+    for pose in poses:
+        print("    {}".format(pose))
@@ -0,0 +1,46 @@
+"""
+Benchmark the ingest -> analyze path on a raw serial capture, no lidar needed.
+Arguments are the capture file name and the replay speed (omit it, or use 0,
+to replay as fast as possible).
+
+    python replay_benchmark.py data/lidar_capture_5000.cap
+"""
+from __future__ import print_function
+import sys
+import time
+
+from laser import Laser, ArrayRotation
+from analyzer import Analyzer, HeadingIndex, find_wall_midpoint
+from serial_capture import ReplaySerial
+
+
+def run_benchmark(capture_file_name, speed=None):
+    """Replay the capture through Laser and the analysis, return (rotations, seconds)"""
+    lasr = Laser(ReplaySerial(capture_file_name, speed=speed), streaming=True)
+    rotations = 0
+    start = time.time()
+    while True:
+        try:
+            rotation = ArrayRotation(lasr.gather_raw_rotation())
+        except IOError:
+            break
+        heading_index = HeadingIndex.from_arrays(*rotation.polar_array())
+        heading_index.range_at_heading((Analyzer.start, Analyzer.stop))
+        find_wall_midpoint(rotation.cartesian_data())
+        rotations = rotations + 1
+    return rotations, time.time() - start
+
+
+if __name__ == '__main__':
+
+    if len(sys.argv) < 2:
+        print("Usage: python replay_benchmark.py <capture file> [speed]")
+        sys.exit(1)
+
+    speed = None
+    if len(sys.argv) > 2 and float(sys.argv[2]) > 0:
+        speed = float(sys.argv[2])
+
+    rotations, seconds = run_benchmark(sys.argv[1], speed)
+    print("{:d} rotations in {:.2f} seconds ({:.1f} rotations/second)".format(
+        rotations, seconds, rotations / seconds if seconds > 0 else 0))
@@ -2,15 +2,27 @@
 This plays back display of lidar snapshot logs.
 Arguments are the name of the data folder, the start file index number, and the number of seconds
 per frame of data.   (it is a sleep time after each plot)
+The first argument can also be a binary rotation log, in which case the start index is the
+rotation number in the log.
 """
 
 from lidar_viewer import LidarViewer
+from rotation_log import RotationLog
 import numpy as np
+import os
 import sys
 import time
 import pdb
 
 
+def replay_rotation_log(lidar_viewer, log_name, start_index, seconds_per_plot):
+        """Plot the rotations in a binary rotation log, starting at rotation start_index"""
+        rotation_log = RotationLog(log_name)
+        for k in range(start_index, len(rotation_log)):
+                lidar_viewer.plot_polar(rotation_log.rotation(k).polar_data())
+                time.sleep(seconds_per_plot)
+
+
 #
 #   Open up the serial port, get lidar data and write it to a file
 #   every few seconds.
@@ -30,6 +42,10 @@ if __name__ == '__main__':
 
         lidar_viewer = LidarViewer()
 
+        if os.path.isfile(image_directory):
+                replay_rotation_log(lidar_viewer, image_directory, start_index, seconds_per_plot)
+                sys.exit(0)
+
         file_index = start_index
 
         while 1:
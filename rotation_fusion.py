@@ -0,0 +1,116 @@
+"""
+Temporal fusion of the last few lidar rotations.
+
+The ranges of the last K rotations are kept in a K x 360 ring (one row
+per rotation, one column per heading, nan where a heading had no valid
+reading).   Adding a rotation overwrites the oldest row and updates the
+running per heading sums and counts, so the cost of an update does not
+depend on K.   fused() then reduces the ring down the columns to get the
+per heading median, mean, min and count in one go.
+
+    fusion = RotationFusion(depth=5)
+    fusion.add(rotation)
+    fused = fusion.fused()
+    fused.median[heading], fused.count[heading]
+"""
+import collections
+import numpy as np
+
+from laser import ArrayRotation
+
+headings_in_rotation = ArrayRotation.headings_in_rotation
+
+# per heading statistics over the rotations in the ring, nan where a heading has no readings
+FusedRotation = collections.namedtuple('FusedRotation', 'median mean min count')
+
+
+class RotationFusion(object):
+    """
+    Ring of the last depth rotations, fused heading by heading.
+    Takes either Rotation or ArrayRotation objects.
+    """
+    statistics = FusedRotation._fields
+
+    def __init__(self, depth=5):
+        if depth < 1:
+            raise ValueError("Fusion depth must be at least one rotation")
+        self.depth = depth
+        self.columns = np.arange(headings_in_rotation)
+        self.clear()
+
+    def clear(self):
+        """Forget every rotation in the ring"""
+        self.ranges = np.full((self.depth, headings_in_rotation), np.nan)
+        self.sums = np.zeros(headings_in_rotation)
+        self.counts = np.zeros(headings_in_rotation, dtype=int)
+        self.next_row = 0
+        self.rotations_added = 0
+
+    def __len__(self):
+        """Number of rotations in the ring"""
+        return min(self.rotations_added, self.depth)
+
+    @staticmethod
+    def rotation_ranges(rotation):
+        """360 ranges in inches for a rotation, nan where the reading is missing, in error or in warning"""
+        ranges = np.full(headings_in_rotation, np.nan)
+        if hasattr(rotation, 'valid'):
+            valid = rotation.valid
+            ranges[valid] = rotation.range_in_inches[valid]
+        else:
+            for reading in rotation.all_readings:
+                if not reading.discard:
+                    ranges[reading.heading % headings_in_rotation] = reading.range_in_inches
+        return ranges
+
+    def add(self, rotation):
+        """Add a rotation, pushing the oldest one out of a full ring"""
+        self.add_ranges(RotationFusion.rotation_ranges(rotation))
+
+    def add_ranges(self, ranges):
+        """Add 360 ranges (nan for no reading) as the newest row of the ring"""
+        row = self.next_row
+        old = self.ranges[row]
+        old_valid = ~np.isnan(old)
+        self.sums[old_valid] -= old[old_valid]
+        self.counts -= old_valid
+
+        new_valid = ~np.isnan(ranges)
+        self.ranges[row] = ranges
+        self.sums[new_valid] += self.ranges[row, new_valid]
+        self.counts += new_valid
+
+        self.next_row = (row + 1) % self.depth
+        self.rotations_added = self.rotations_added + 1
+
+    def fused(self):
+        """Return the FusedRotation for the rotations in the ring"""
+        counts = self.counts.copy()
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = np.where(counts > 0, self.sums / counts, np.nan)
+
+        # fmin skips nan unless every value is nan
+        minimum = np.fmin.reduce(self.ranges, axis=0)
+
+        # nan sorts last, so the valid readings of a column are its first count rows
+        ordered = np.sort(self.ranges, axis=0)
+        low = np.maximum((counts - 1) // 2, 0)
+        high = counts // 2
+        median = (ordered[low, self.columns] + ordered[np.minimum(high, self.depth - 1), self.columns]) / 2.0
+        median[counts == 0] = np.nan
+
+        return FusedRotation(median, mean, minimum, counts)
+
+    def polar_array(self, statistic='median'):
+        """Return (headings, fused ranges) arrays for the -90 to 90 view, like ArrayRotation.polar_array"""
+        if statistic not in RotationFusion.statistics:
+            raise ValueError("Unknown fusion statistic: {}".format(statistic))
+        ranges = getattr(self.fused(), statistic)
+        slots = ArrayRotation.view_slots
+        slots = slots[~np.isnan(ranges[slots])]
+        return slots, ranges[slots]
+
+    def polar_data(self, statistic='median'):
+        """Fused (heading, range) tuples for the -90 to 90 view"""
+        headings, ranges = self.polar_array(statistic)
+        return list(zip(headings.tolist(), ranges.tolist()))
@@ -0,0 +1,202 @@
+"""
+Append-only binary log of lidar rotations.
+
+The log is a fixed size header followed by one fixed size record per
+rotation:
+
+    timestamp   float64        seconds (time.time()) the rotation was logged
+    rpm         uint16
+    distance    uint16 x 360   raw distance by heading (error/warning bits included)
+    strength    uint16 x 360   raw signal strength by heading
+    flags       uint8  x 360   per heading flags (present, error, warning)
+
+Since every record is the same size, rotation k lives at a known offset
+and the reader just memory maps the records.   The timestamp column of
+the mapped records is the index: use RotationLog.find() to look up the
+rotation logged at a given time.
+
+To convert old text snapshots:
+
+    python rotation_log.py <log file> data/lidar_snapshot_*.dat
+"""
+import os
+import sys
+import struct
+import time
+import numpy as np
+
+from laser import Reading, ArrayRotation
+
+headings_in_rotation = ArrayRotation.headings_in_rotation
+
+# per heading flag bits
+FLAG_PRESENT = 0x1
+FLAG_ERROR = 0x2
+FLAG_WARNING = 0x4
+
+record_dtype = np.dtype([('timestamp', '<f8'),
+                         ('rpm', '<u2'),
+                         ('distance', '<u2', (headings_in_rotation,)),
+                         ('strength', '<u2', (headings_in_rotation,)),
+                         ('flags', 'u1', (headings_in_rotation,))])
+
+# magic, version, headings per record, record size, padded out to header_size
+header_def = struct.Struct('<8sHHI')
+header_size = 64
+magic = b'LIDARLOG'
+version = 1
+
+
+class RotationLogError(Exception):
+    """The file is not a rotation log this code understands"""
+    pass
+
+
+def pack_header():
+    header = header_def.pack(magic, version, headings_in_rotation, record_dtype.itemsize)
+    return header + b'\0' * (header_size - len(header))
+
+
+def check_header(header):
+    if len(header) < header_size:
+        raise RotationLogError("Rotation log header is truncated")
+    file_magic, file_version, headings, record_size = header_def.unpack_from(header)
+    if file_magic != magic:
+        raise RotationLogError("Not a rotation log")
+    if (file_version, headings, record_size) != (version, headings_in_rotation, record_dtype.itemsize):
+        raise RotationLogError("Unsupported rotation log version {:d}".format(file_version))
+
+
+def rotation_flags(rotation):
+    """Per heading flags for an ArrayRotation"""
+    return (np.where(rotation.present, FLAG_PRESENT, 0) |
+            np.where(rotation.error, FLAG_ERROR, 0) |
+            np.where(rotation.warning, FLAG_WARNING, 0))
+
+
+def pack_record(distance, strength, flags, rpm, timestamp=None):
+    """Pack one record from raw 360 element arrays.  Also used to send whole rotations."""
+    record = np.zeros(1, dtype=record_dtype)
+    record['timestamp'] = time.time() if timestamp is None else timestamp
+    record['rpm'] = rpm
+    record['distance'] = distance
+    record['strength'] = strength
+    record['flags'] = flags
+    return record.tobytes()
+
+
+def rotation_record(rotation, timestamp=None):
+    """Pack an ArrayRotation as one record"""
+    return pack_record(rotation.raw_distance, rotation.strength, rotation_flags(rotation),
+                       rotation.rpm(), timestamp)
+
+
+class RotationLogWriter(object):
+    """
+    Append rotations to a binary log.
+
+    log = RotationLogWriter('data/lidar_rotations.log')
+    log.append(rotation)
+    log.close()
+
+    Appending to an existing log checks its header first.
+    """
+    def __init__(self, file_name):
+        self.file_name = file_name
+
+        if os.path.exists(file_name) and os.path.getsize(file_name) > 0:
+            with open(file_name, 'rb') as f:
+                check_header(f.read(header_size))
+            self.file = open(file_name, 'ab')
+        else:
+            self.file = open(file_name, 'wb')
+            self.file.write(pack_header())
+            self.file.flush()
+
+    def append(self, rotation, timestamp=None):
+        """Append an ArrayRotation as the next record"""
+        self.file.write(rotation_record(rotation, timestamp))
+        self.file.flush()
+
+    def append_arrays(self, distance, strength, flags, rpm, timestamp=None):
+        """Append a record built from raw 360 element arrays"""
+        self.file.write(pack_record(distance, strength, flags, rpm, timestamp))
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class RotationLog(object):
+    """
+    Memory mapped, read-only view of a rotation log.
+
+    log = RotationLog('data/lidar_rotations.log')
+    log[k]              record k (a zero-copy view into the file)
+    log.rotation(k)     record k as an ArrayRotation
+    log.find(t)         index of the first rotation logged at or after t
+    """
+    def __init__(self, file_name):
+        self.file_name = file_name
+        with open(file_name, 'rb') as f:
+            check_header(f.read(header_size))
+
+        count = (os.path.getsize(file_name) - header_size) // record_dtype.itemsize
+        if count > 0:
+            self.records = np.memmap(file_name, dtype=record_dtype, mode='r',
+                                     offset=header_size, shape=(count,))
+        else:
+            self.records = np.zeros(0, dtype=record_dtype)
+
+    def __len__(self):
+        return len(self.records)
+
+    def __getitem__(self, k):
+        return self.records[k]
+
+    @property
+    def timestamps(self):
+        return self.records['timestamp']
+
+    def find(self, timestamp):
+        """Index of the first rotation logged at or after the timestamp"""
+        return int(np.searchsorted(self.timestamps, timestamp))
+
+    def rotation(self, k):
+        """Rotation k as an ArrayRotation over the mapped arrays"""
+        record = self.records[k]
+        return ArrayRotation.from_arrays(record['distance'], record['strength'],
+                                         (record['flags'] & FLAG_PRESENT) != 0,
+                                         record['rpm'])
+
+
+def convert_snapshots(log_name, snapshot_names):
+    """
+    Convert text snapshots (LidarLogger.write_to_file format) into a rotation log.
+    Snapshots only have the heading and range in inches, so the raw distance is
+    rebuilt from inches and the strength is zero.  777 inches marks a warning.
+    """
+    writer = RotationLogWriter(log_name)
+    for snapshot_name in snapshot_names:
+        snapshot = np.loadtxt(snapshot_name, delimiter=",", ndmin=2)
+        distance = np.zeros(headings_in_rotation, dtype=np.uint16)
+        flags = np.zeros(headings_in_rotation, dtype=np.uint8)
+        if len(snapshot) > 0:
+            slots = np.round(snapshot[:, 0]).astype(int) % headings_in_rotation
+            inches = snapshot[:, 1]
+            warning = inches >= 777
+            distance[slots] = np.where(warning, Reading.warning_mask,
+                                       np.round(inches * Reading.MM_PER_INCH))
+            flags[slots] = np.where(warning, FLAG_PRESENT | FLAG_WARNING, FLAG_PRESENT)
+        writer.append_arrays(distance, np.zeros(headings_in_rotation, dtype=np.uint16), flags,
+                             0, os.path.getmtime(snapshot_name))
+    writer.close()
+
+
+if __name__ == '__main__':
+
+    if len(sys.argv) < 3:
+        print("Usage: python rotation_log.py <log file> <snapshot files>")
+        sys.exit(1)
+
+    convert_snapshots(sys.argv[1], sys.argv[2:])
@@ -0,0 +1,240 @@
+"""
+Robot motion between rotations, from the rotations themselves.
+
+Each rotation is matched against the one before it with point-to-line
+ICP: every point of the new scan is paired with the nearest point of the
+previous scan, and the rigid transform that best lines the new points up
+with the lines through their partners is solved for, over and over until
+it stops changing, runs out of iterations or runs out of time.
+
+The previous scan's points go into a PointGrid when the scan arrives,
+and every ICP iteration (and the next rotation's match) reuses it.
+
+Scan points are in the lidar frame: x straight ahead, y to the left.
+The motion comes back the way Robot moves: inches forward and to the left
+of where the robot was, and degrees turned (+ for a right turn).
+
+    matcher = ScanMatcher()
+    motion = matcher.update(rotation)      # None for the first rotation
+    motion.forward / motion.interval       # inches per second
+"""
+import collections
+import time
+import numpy as np
+
+from deskew import SECONDS_PER_MINUTE
+
+ScanMotion = collections.namedtuple('ScanMotion', 'forward left turn interval iterations converged')
+
+
+def rotation_points(rotation):
+    """N x 2 array of a rotation's cartesian points"""
+    if hasattr(rotation, 'cartesian_array'):
+        return np.column_stack(rotation.cartesian_array())
+    return np.array(rotation.cartesian_data(), dtype=float).reshape(-1, 2)
+
+
+def scan_normals(points, max_gap):
+    """
+    Unit normals of the scan at each point, from its neighbours in scan
+    order, nan where neither neighbour is within max_gap (a lone point).
+    """
+    steps = np.diff(points, axis=0)
+    close = np.hypot(steps[:, 0], steps[:, 1]) <= max_gap
+    steps[~close] = 0
+    tangents = np.zeros_like(points)
+    tangents[1:] += steps
+    tangents[:-1] += steps
+    length = np.hypot(tangents[:, 0], tangents[:, 1])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        normals = np.column_stack((-tangents[:, 1], tangents[:, 0])) / length[:, np.newaxis]
+    normals[length == 0] = np.nan
+    return normals
+
+
+class PointGrid(object):
+    """
+    Nearest neighbour index over a scan: a dense grid of cells, each
+    holding up to capacity point indices (-1 for an empty slot).   The
+    nearest point within cell_size of a query is always in the 3 x 3
+    block of cells around it, so one gather answers every query.
+    """
+    def __init__(self, points, cell_size):
+        self.points = np.asarray(points, dtype=float).reshape(-1, 2)
+        self.cell_size = cell_size
+        # a border of empty cells, so every point has all its neighbouring cells
+        self.origin = self.points.min(axis=0) - cell_size if len(self.points) else np.zeros(2)
+        cells = ((self.points - self.origin) // cell_size).astype(int)
+        self.shape = cells.max(axis=0) + 2 if len(self.points) else np.array([1, 1])
+
+        flat = cells[:, 0] * self.shape[1] + cells[:, 1]
+        order = np.argsort(flat, kind='mergesort')
+        counts = np.bincount(flat, minlength=self.shape[0] * self.shape[1])
+        starts = np.cumsum(counts) - counts
+        self.slots = np.full((self.shape[0] * self.shape[1], max(counts.max(), 1)), -1, dtype=int)
+        self.slots[flat[order], np.arange(len(order)) - starts[flat[order]]] = order
+
+    def nearest(self, queries):
+        """(index, distance) arrays of the nearest point to each query, -1 and inf past cell_size"""
+        queries = np.asarray(queries, dtype=float).reshape(-1, 2)
+        if len(self.points) == 0:
+            return np.full(len(queries), -1, dtype=int), np.full(len(queries), np.inf)
+        cells = ((queries - self.origin) // self.cell_size).astype(int)
+        candidates = []
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                column = np.clip(cells[:, 0] + dx, 0, self.shape[0] - 1)
+                row = np.clip(cells[:, 1] + dy, 0, self.shape[1] - 1)
+                candidates.append(self.slots[column * self.shape[1] + row])
+        candidates = np.concatenate(candidates, axis=1)
+
+        offsets = self.points[candidates] - queries[:, np.newaxis]
+        distances = np.hypot(offsets[..., 0], offsets[..., 1])
+        distances[candidates < 0] = np.inf
+        best = distances.argmin(axis=1)
+        picked = np.arange(len(queries))
+        index, distance = candidates[picked, best], distances[picked, best]
+        far = distance > self.cell_size
+        index[far] = -1
+        distance[far] = np.inf
+        return index, distance
+
+
+class ScanMatcher(object):
+    """
+    Point-to-line ICP between consecutive rotations.   Each match starts
+    from the last motion (the robot keeps doing what it was doing) and
+    stops when an iteration moves the estimate less than the convergence
+    thresholds, after max_iterations, or when the time budget is spent.
+    """
+    max_iterations = 20
+    # points further than this from the previous scan are not paired (inches),
+    # which is also the size of the grid cells
+    max_distance = 12.0
+    # neighbours further apart than this are not on the same line (inches)
+    max_gap = 8.0
+    # fewer pairs than this and there is no match
+    min_pairs = 20
+    converged_translation = 0.01
+    converged_rotation = 0.01
+
+    def __init__(self, budget=0.02):
+        self.budget = budget
+        self.reference = None
+        self.grid = None
+        self.normals = None
+        self.reference_time = None
+        self.guess = (0.0, 0.0, 0.0)
+
+        # counters
+        self.runs = 0
+        self.iterations = 0
+        self.last_iterations = 0
+        self.converged = 0
+        self.budget_stops = 0
+        self.failures = 0
+        self.elapsed = 0.0
+
+    def set_reference(self, points, timestamp=None):
+        """Make points the scan the next one is matched against, and index it"""
+        self.reference = points
+        self.grid = PointGrid(points, ScanMatcher.max_distance)
+        self.normals = scan_normals(points, ScanMatcher.max_gap)
+        self.reference_time = timestamp
+
+    def match(self, points, guess=(0.0, 0.0, 0.0), budget=None):
+        """
+        Transform (tx, ty, theta in radians, counterclockwise) that moves
+        points onto the reference scan.   Return (transform, iterations,
+        converged), transform None if too few points could be paired.
+        """
+        # a blocked or spinning up lidar leaves too few points to match
+        if len(self.reference) < ScanMatcher.min_pairs or len(points) < ScanMatcher.min_pairs:
+            return None, 0, False
+
+        start = time.time()
+        budget = self.budget if budget is None else budget
+        tx, ty, theta = guess
+        iterations = 0
+        converged = False
+        while iterations < ScanMatcher.max_iterations:
+            if iterations > 0 and time.time() - start > budget:
+                self.budget_stops = self.budget_stops + 1
+                break
+            iterations = iterations + 1
+
+            cos_theta, sin_theta = np.cos(theta), np.sin(theta)
+            moved = np.column_stack((cos_theta * points[:, 0] - sin_theta * points[:, 1] + tx,
+                                     sin_theta * points[:, 0] + cos_theta * points[:, 1] + ty))
+            index, _ = self.grid.nearest(moved)
+            paired = index >= 0
+            normals = self.normals[index[paired]]
+            on_line = ~np.isnan(normals[:, 0])
+            if np.count_nonzero(on_line) < ScanMatcher.min_pairs:
+                return None, iterations, False
+            moved = moved[paired][on_line]
+            normals = normals[on_line]
+            partners = self.reference[index[paired][on_line]]
+
+            # linearized: residual + J (dx, dy, dtheta) == 0, solved in the least squares sense
+            residuals = np.sum((moved - partners) * normals, axis=1)
+            jacobian = np.column_stack((normals[:, 0], normals[:, 1],
+                                        moved[:, 0] * normals[:, 1] - moved[:, 1] * normals[:, 0]))
+            dx, dy, dtheta = np.linalg.lstsq(jacobian, -residuals, rcond=None)[0]
+
+            # apply the step after the current estimate
+            cos_step, sin_step = np.cos(dtheta), np.sin(dtheta)
+            tx, ty = cos_step * tx - sin_step * ty + dx, sin_step * tx + cos_step * ty + dy
+            theta = theta + dtheta
+
+            if (np.hypot(dx, dy) < ScanMatcher.converged_translation and
+                    abs(np.degrees(dtheta)) < ScanMatcher.converged_rotation):
+                converged = True
+                break
+        return (float(tx), float(ty), float(theta)), iterations, converged
+
+    def update(self, rotation):
+        """
+        Match the rotation against the previous one and make it the new
+        reference.   Return the ScanMotion between them, None for the
+        first rotation or when the scans could not be matched.
+        """
+        start = time.time()
+        points = rotation_points(rotation)
+        timestamp = getattr(rotation, 'timestamp', None)
+        reference_time = self.reference_time
+        if self.reference is None:
+            self.set_reference(points, timestamp)
+            return None
+
+        self.runs = self.runs + 1
+        transform, iterations, converged = self.match(points, self.guess)
+        self.iterations = self.iterations + iterations
+        self.last_iterations = iterations
+        self.set_reference(points, timestamp)
+        self.elapsed = time.time() - start
+        if transform is None:
+            self.failures = self.failures + 1
+            self.guess = (0.0, 0.0, 0.0)
+            return None
+        if converged:
+            self.converged = self.converged + 1
+        self.guess = transform
+
+        if timestamp is not None and reference_time is not None and timestamp > reference_time:
+            interval = timestamp - reference_time
+        else:
+            rpm = rotation.rpm() if callable(rotation.rpm) else rotation.rpm
+            interval = SECONDS_PER_MINUTE / rpm if rpm > 0 else 0.0
+        tx, ty, theta = transform
+        return ScanMotion(tx, ty, -np.degrees(theta), interval, iterations, converged)
+
+    def stats(self):
+        """Counters of the matches so far"""
+        return collections.OrderedDict([('runs', self.runs),
+                                        ('iterations', self.iterations),
+                                        ('last_iterations', self.last_iterations),
+                                        ('converged', self.converged),
+                                        ('budget_stops', self.budget_stops),
+                                        ('failures', self.failures),
+                                        ('last_ms', round(self.elapsed * 1000.0, 3))])
@@ -1,4 +1,30 @@
 import json
+import struct
+import itertools
+
+#
+#  Binary wire format.   A binary message is a fixed layout: the common
+#  header, then the fields of the message type, all little-endian.
+#
+#    magic (1 byte) version (1 byte) type tag (1 byte) sequence number (4 bytes)
+#
+#  JSON stays the default and the fallback.  SensorMessage.wire_format
+#  picks what encode_message() produces; the robot negotiates it by
+#  sending a 'format' message (see negotiate_wire_format).
+#
+JSON = 'json'
+BINARY = 'binary'
+
+wire_magic = 0xa5
+wire_version = 4
+wire_header = struct.Struct('<BBBI')
+
+# status strings travel as small codes
+status_codes = ['ok', 'error', 'down', 'badarg', 'off']
+
+# type tag => message class, filled in below the message classes
+message_types = {}
+
 
 class SensorMessage(object):
     """
@@ -6,13 +32,47 @@ class SensorMessage(object):
     Provides the default initialization for the common
     elements.
     """
+    # what encode_message() puts on the wire (JSON or BINARY)
+    wire_format = JSON
+
+    # binary layout: type tag, body structure, and the attributes packed into it
+    wire_type = None
+    wire_body = None
+    wire_fields = ()
+
+    # shared by every message sent in binary
+    sequence_numbers = itertools.count(1)
+
     def __init__(self, sender, message):
         self.sender = sender
         self.message = message
 
     def encode_message(self):
+        if SensorMessage.wire_format == BINARY and self.wire_type is not None:
+            return self.encode_binary()
         return json.dumps(self.__dict__)
 
+    def encode_binary(self, sequence=None):
+        """Pack the message in the fixed binary layout"""
+        if sequence is None:
+            sequence = next(SensorMessage.sequence_numbers) & 0xffffffff
+        values = [getattr(self, name) for name in self.wire_fields]
+        for ndx, name in enumerate(self.wire_fields):
+            if name.endswith('status'):
+                values[ndx] = status_codes.index(values[ndx] if values[ndx] in status_codes else 'error')
+        return wire_header.pack(wire_magic, wire_version, self.wire_type, sequence) + self.wire_body.pack(*values)
+
+    @classmethod
+    def from_wire(cls, sequence, values):
+        """Create a message from the unpacked binary fields"""
+        message = cls()
+        for name, value in zip(cls.wire_fields, values):
+            if name.endswith('status'):
+                value = status_codes[value] if value < len(status_codes) else 'error'
+            setattr(message, name, value)
+        message.sequence = sequence
+        return message
+
     @classmethod
     def create_from_message(cls, message_as_string):
         contents = json.loads(message_as_string)
@@ -37,6 +97,10 @@ class LidarRangeAtHeadingMessage(SensorMessage):
 
     channel_to_rio.send_to(range_at_heading.encode_message())
     """
+    wire_type = 1
+    wire_body = struct.Struct('<hf')
+    wire_fields = ('heading', 'range')
+
     def __init__(self, sender="lidar", message="range at heading"):
         super(LidarRangeAtHeadingMessage,self).__init__(sender, message)
         if message != 'range at heading':
@@ -55,11 +119,24 @@ class LidarPeriodicMessage(SensorMessage):
     periodic.rpm = <rpm>
 
     channel_to_rio.send_to(range_at_heading.encode_message())
+
+    The latency fields are the p50/p95/p99 age of the results, in
+    milliseconds from the last packet of a rotation arriving to its
+    results being sent (see LatencyStats).   In JSON, stage_latency
+    has the same breakdown for every stage of the pipeline.
     """
+    wire_type = 2
+    wire_body = struct.Struct('<HBHHH')
+    wire_fields = ('rpm', 'status', 'latency_p50', 'latency_p95', 'latency_p99')
+
     def __init__(self, name="lidar", message="periodic"):
         super(LidarPeriodicMessage,self).__init__(name, message)
         self.rpm = 0
         self.status = 'ok'
+        self.latency_p50 = 0
+        self.latency_p95 = 0
+        self.latency_p99 = 0
+        self.stage_latency = {}
 
 class LidarWallMessage(SensorMessage):
     """
@@ -75,6 +152,10 @@ class LidarWallMessage(SensorMessage):
 
     channel_to_rio.send_to(wall_message.encode_message())
     """
+    wire_type = 3
+    wire_body = struct.Struct('<Bfff')
+    wire_fields = ('status', 'heading', 'range', 'orientation')
+
     def __init__(self, name="lidar", message="wall"):
         super(LidarWallMessage,self).__init__(name, message)
         self.orientation = 0
@@ -82,13 +163,271 @@ class LidarWallMessage(SensorMessage):
         self.heading = 0
         self.range = 0
 
+class LidarRotationResultMessage(SensorMessage):
+    """
+    Every analysis result for one rotation, bundled in a single message.
+    rotation is the rotation sequence number (gaps mean dropped rotations)
+    and timestamp is when the rotation was captured, so the robot can tell
+    which results belong together and how stale they are.
+
+    result = LidarRotationResultMessage()
+    result.collect(rotation.sequence, rotation.timestamp,
+                   range_at_heading_message, periodic_message, wall_message,
+                   pose_message, odometry_message)
+
+    channel_to_rio.send_to(result.encode_message())
+
+    The wall and pose fields are those of LidarWallMessage and
+    LidarPoseMessage, prefixed wall_ and pose_, and the odometry fields
+    those of LidarOdometryMessage (its status is odometry_status).
+    """
+    wire_type = 5
+    wire_body = struct.Struct('<IdHBhfBfffBffffBfffff')
+    wire_fields = ('rotation', 'timestamp', 'rpm', 'status', 'heading', 'range',
+                   'wall_status', 'wall_heading', 'wall_range', 'wall_orientation',
+                   'pose_status', 'pose_x', 'pose_y', 'pose_heading', 'pose_error',
+                   'odometry_status', 'speed', 'turn_rate', 'forward', 'left', 'turn')
+
+    def __init__(self, name="lidar", message="rotation result"):
+        super(LidarRotationResultMessage,self).__init__(name, message)
+        self.rotation = 0
+        self.timestamp = 0.0
+        self.rpm = 0
+        self.status = 'ok'
+        self.heading = 0
+        self.range = 0
+        self.wall_status = 'off'
+        self.wall_heading = 0
+        self.wall_range = 0
+        self.wall_orientation = 0
+        self.pose_status = 'off'
+        self.pose_x = 0
+        self.pose_y = 0
+        self.pose_heading = 0
+        self.pose_error = 0
+        self.odometry_status = 'off'
+        self.speed = 0
+        self.turn_rate = 0
+        self.forward = 0
+        self.left = 0
+        self.turn = 0
+
+    def collect(self, rotation, timestamp, range_at_heading, periodic, wall=None, pose=None, odometry=None):
+        """Copy the results out of the individual messages.  No wall, pose or odometry means it is 'off'."""
+        self.rotation = rotation
+        self.timestamp = timestamp
+        self.rpm = periodic.rpm
+        self.status = periodic.status
+        self.heading = range_at_heading.heading
+        self.range = range_at_heading.range
+        if wall is None:
+            self.wall_status = 'off'
+        else:
+            self.wall_status = wall.status
+            self.wall_heading = wall.heading
+            self.wall_range = wall.range
+            self.wall_orientation = wall.orientation
+        if pose is None:
+            self.pose_status = 'off'
+        else:
+            self.pose_status = pose.status
+            self.pose_x, self.pose_y = pose.x, pose.y
+            self.pose_heading, self.pose_error = pose.heading, pose.error
+        if odometry is None:
+            self.odometry_status = 'off'
+            self.speed = self.turn_rate = 0
+            self.forward = self.left = self.turn = 0
+        else:
+            self.odometry_status = odometry.status
+            self.speed, self.turn_rate = odometry.speed, odometry.turn_rate
+            self.forward, self.left, self.turn = odometry.forward, odometry.left, odometry.turn
+
+
+class LidarPoseMessage(SensorMessage):
+    """
+    Where the lidar thinks the robot is on the field (see localizer.py).
+
+    pose_message = LidarPoseMessage()
+    pose_message.status = 'ok'
+    pose_message.x = <inches right of the origin>
+    pose_message.y = <inches toward the back wall>
+    pose_message.heading = <degrees, + clockwise like Robot>
+    pose_message.error = <mean range error of the match in inches>
+
+    channel_to_rio.send_to(pose_message.encode_message())
+    """
+    wire_type = 7
+    wire_body = struct.Struct('<Bffff')
+    wire_fields = ('status', 'x', 'y', 'heading', 'error')
+
+    def __init__(self, name="lidar", message="pose"):
+        super(LidarPoseMessage,self).__init__(name, message)
+        self.status = 'ok'
+        self.x = 0
+        self.y = 0
+        self.heading = 0
+        self.error = 0
+
+
+class LidarOdometryMessage(SensorMessage):
+    """
+    How the robot moved since the last rotation, from matching the two
+    rotations (see scan_matcher.py).   Sent for every rotation that matched.
+
+    odometry_message = LidarOdometryMessage()
+    odometry_message.fill(scan_motion)
+
+    channel_to_rio.send_to(odometry_message.encode_message())
+
+    speed (inches/second) and turn_rate (degrees/second, + for a right
+    turn) are what RobotOdometryMessage carries the other way; forward,
+    left and turn are the motion over the last rotation.
+    """
+    wire_type = 8
+    wire_body = struct.Struct('<Bfffff')
+    wire_fields = ('status', 'speed', 'turn_rate', 'forward', 'left', 'turn')
+
+    def __init__(self, name="lidar", message="odometry"):
+        super(LidarOdometryMessage,self).__init__(name, message)
+        self.status = 'ok'
+        self.speed = 0
+        self.turn_rate = 0
+        self.forward = 0
+        self.left = 0
+        self.turn = 0
+
+    def fill(self, motion):
+        """
+        Copy a ScanMotion in.  No motion (the scans did not match) is an
+        'error', with the motion zeroed so last rotation's does not pass for this one.
+        """
+        if motion is None or motion.interval <= 0:
+            self.status = 'error'
+            self.speed = self.turn_rate = 0
+            self.forward = self.left = self.turn = 0
+            return
+        self.status = 'ok'
+        self.forward, self.left, self.turn = motion.forward, motion.left, motion.turn
+        self.speed = motion.forward / motion.interval
+        self.turn_rate = motion.turn / motion.interval
+
+
 class RobotMessage(object):
     """
     Convenience class for receiving and cracking messages from
-    the robot.
+    the robot.   The contents are available as attributes
+    (message_from_robot.start) or items (message_from_robot['start']).
+    Binary and JSON messages are both understood.
     """
+    wire_type = 4
+    wire_body = struct.Struct('<Bhh')
+    robot_messages = ['sweep']
+
     def __init__(self, message_as_string):
-        self.contents = json.loads(message_as_string)
-    
-    def __get_item__(self, item):
+        if bytearray(message_as_string[:1]) == bytearray([wire_magic]):
+            self.contents = decode_messages(message_as_string)[0].contents
+        else:
+            self.contents = json.loads(message_as_string)
+        if not isinstance(self.contents, dict):
+            raise ValueError("Robot message is not an object: {!r}".format(self.contents))
+
+    @classmethod
+    def from_contents(cls, contents):
+        message = cls.__new__(cls)
+        message.contents = contents
+        return message
+
+    @classmethod
+    def from_wire(cls, sequence, values):
+        code, start, stop = values
+        return cls.from_contents({'sender': 'robot',
+                                  'message': cls.robot_messages[code],
+                                  'start': start,
+                                  'stop': stop,
+                                  'sequence': sequence})
+
+    def encode_message(self, wire_format=JSON, sequence=0):
+        """Encode the message (robot side, and for testing)"""
+        if wire_format == BINARY:
+            return (wire_header.pack(wire_magic, wire_version, RobotMessage.wire_type, sequence) +
+                    RobotMessage.wire_body.pack(RobotMessage.robot_messages.index(self.message),
+                                                self.start, self.stop))
+        return json.dumps(self.contents)
+
+    def __getitem__(self, item):
         return self.contents[item]
+
+    def __getattr__(self, item):
+        contents = self.__dict__.get('contents', {})
+        if item in contents:
+            return contents[item]
+        raise AttributeError(item)
+
+
+class RobotOdometryMessage(RobotMessage):
+    """
+    How the robot is moving: forward speed in inches per second and turn
+    rate in degrees per second (+ for a right turn, like Robot.turn()).
+    As JSON: {"sender": "robot", "message": "odometry", "speed": 60.0, "turn_rate": -30.0}
+    """
+    wire_type = 6
+    wire_body = struct.Struct('<ff')
+
+    @classmethod
+    def from_wire(cls, sequence, values):
+        speed, turn_rate = values
+        return cls.from_contents({'sender': 'robot',
+                                  'message': 'odometry',
+                                  'speed': speed,
+                                  'turn_rate': turn_rate,
+                                  'sequence': sequence})
+
+    def encode_message(self, wire_format=JSON, sequence=0):
+        """Encode the message (robot side, and for testing)"""
+        if wire_format == BINARY:
+            return (wire_header.pack(wire_magic, wire_version, RobotOdometryMessage.wire_type, sequence) +
+                    RobotOdometryMessage.wire_body.pack(self.speed, self.turn_rate))
+        return json.dumps(self.contents)
+
+
+for message_class in (LidarRangeAtHeadingMessage, LidarPeriodicMessage, LidarWallMessage,
+                      LidarRotationResultMessage, LidarPoseMessage, LidarOdometryMessage,
+                      RobotMessage, RobotOdometryMessage):
+    message_types[message_class.wire_type] = message_class
+
+
+def decode_messages(buffer):
+    """
+    Decode every binary message packed back to back in the buffer.
+    A JSON buffer holds a single message, which comes back as a RobotMessage.
+    """
+    if bytearray(buffer[:1]) != bytearray([wire_magic]):
+        return [RobotMessage.from_contents(json.loads(buffer))]
+
+    messages = []
+    offset = 0
+    while offset < len(buffer):
+        if len(buffer) - offset < wire_header.size:
+            raise ValueError("Truncated message header at offset {:d}".format(offset))
+        magic, version, tag, sequence = wire_header.unpack_from(buffer, offset)
+        if magic != wire_magic or version != wire_version or tag not in message_types:
+            raise ValueError("Unknown message at offset {:d}".format(offset))
+        message_class = message_types[tag]
+        offset = offset + wire_header.size
+        values = message_class.wire_body.unpack_from(buffer, offset)
+        offset = offset + message_class.wire_body.size
+        messages.append(message_class.from_wire(sequence, values))
+    return messages
+
+
+def negotiate_wire_format(robot_message):
+    """
+    Switch what encode_message() produces when the robot asks for it with
+    {"sender": "robot", "message": "format", "format": "binary"}.
+    Return True if the message was a format request.
+    """
+    if robot_message.contents.get('message') != 'format':
+        return False
+    if robot_message.contents.get('format') in (JSON, BINARY):
+        SensorMessage.wire_format = robot_message.contents['format']
+    return True
@@ -0,0 +1,130 @@
+"""
+Raw serial capture and replay for the lidar.
+
+CaptureSerial wraps the real serial port and tees every chunk it reads,
+with the time it was read, into a capture file.   ReplaySerial stands in
+for the serial port and plays a capture file back to Laser, either at
+the recorded pace (optionally scaled) or as fast as it can be consumed.
+
+    lp = CaptureSerial(serial.Serial('/dev/ttyUSB0', 115200, timeout=1), 'match.cap')
+    lasr = Laser(ReplaySerial('match.cap', speed=None), streaming=True)
+
+A capture file is just a sequence of chunks:
+
+    timestamp   float64   time.time() when the chunk was read
+    length      uint32    number of bytes in the chunk
+    data        length bytes
+"""
+import bisect
+import struct
+import time
+
+chunk_def = struct.Struct('<dI')
+
+
+class CaptureSerial(object):
+    """Serial port wrapper that records everything read from the port"""
+    def __init__(self, port, capture_file_name):
+        self.port = port
+        self.capture_file = open(capture_file_name, 'wb')
+
+    def read(self, size=1):
+        data = self.port.read(size)
+        if data:
+            self.capture_file.write(chunk_def.pack(time.time(), len(data)))
+            self.capture_file.write(data)
+        return data
+
+    @property
+    def in_waiting(self):
+        return getattr(self.port, 'in_waiting', 0)
+
+    def close(self):
+        self.capture_file.close()
+        if hasattr(self.port, 'close'):
+            self.port.close()
+
+    def __getattr__(self, name):
+        # anything else (flushInput, baudrate, ...) goes to the real port
+        return getattr(self.port, name)
+
+
+def read_capture(capture_file_name):
+    """Return the (timestamp, data) chunks of a capture file"""
+    chunks = []
+    with open(capture_file_name, 'rb') as f:
+        while True:
+            header = f.read(chunk_def.size)
+            if len(header) < chunk_def.size:
+                break
+            timestamp, length = chunk_def.unpack(header)
+            data = f.read(length)
+            if len(data) < length:
+                break
+            chunks.append((timestamp, data))
+    return chunks
+
+
+class ReplaySerial(object):
+    """
+    Serial port stand-in that plays back a capture file.
+
+    speed=1.0 replays in real time, speed=10.0 ten times faster, and
+    speed=None hands out bytes as fast as they are read.   A read blocks
+    until the capture clock says the bytes have arrived.   When the
+    capture runs out, read() returns nothing, just like a serial timeout.
+    """
+    def __init__(self, capture_file_name, speed=1.0):
+        chunks = read_capture(capture_file_name)
+        self.data = b''.join(data for _, data in chunks)
+        self.times = [timestamp for timestamp, _ in chunks]
+
+        # ends[k] is the number of bytes captured up to the end of chunk k
+        self.ends = []
+        total = 0
+        for _, data in chunks:
+            total = total + len(data)
+            self.ends.append(total)
+
+        self.speed = speed
+        self.position = 0
+        self.start_time = None
+
+    def capture_time(self):
+        """Seconds into the capture, according to the replay clock"""
+        if self.start_time is None:
+            self.start_time = time.time()
+        return (time.time() - self.start_time) * self.speed
+
+    def arrived(self):
+        """Number of bytes the capture had received by now"""
+        if not self.speed:
+            return len(self.data)
+        k = bisect.bisect_right(self.times, self.times[0] + self.capture_time())
+        return self.ends[k-1] if k > 0 else 0
+
+    def read(self, size=1):
+        wanted = min(self.position + size, len(self.data))
+        if wanted <= self.position:
+            return b''
+
+        if self.speed:
+            # wait for the chunk holding the last wanted byte to "arrive"
+            arrival = self.times[bisect.bisect_left(self.ends, wanted)] - self.times[0]
+            delay = (arrival - self.capture_time()) / self.speed
+            if delay > 0:
+                time.sleep(delay)
+
+        data = self.data[self.position:wanted]
+        self.position = wanted
+        return data
+
+    @property
+    def in_waiting(self):
+        # at full speed everything has "arrived", so let the reader pick its chunk size
+        if not self.speed:
+            return 0
+        return max(self.arrived() - self.position, 0)
+
+    def close(self):
+        pass
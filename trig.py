@@ -0,0 +1,49 @@
+"""
+Precomputed cosines and sines for whole degree headings.
+
+Lidar headings are whole degrees, so polar to cartesian conversion only
+ever needs a few hundred distinct cosines and sines.   The tables cover
+-360 to 359 degrees (FakeRotation headings run negative) and hold exactly
+what math.cos(math.radians(theta)) gives, so using them does not change
+any result.
+
+The tables are laid out so the heading is the index: 0 to 359 first,
+then -360 to -1, which Python and numpy negative indexing reach directly.
+Any other whole degree heading lands on the same angle modulo table_size.
+"""
+import math
+import numpy as np
+
+table_size = 720
+table_headings = list(range(0, table_size // 2)) + list(range(-table_size // 2, 0))
+
+# as lists for per point use, and as arrays for numpy
+cos_list = [math.cos(math.radians(theta)) for theta in table_headings]
+sin_list = [math.sin(math.radians(theta)) for theta in table_headings]
+cos_table = np.array(cos_list)
+sin_table = np.array(sin_list)
+
+
+def polar_to_cart(theta, r):
+    """convert polar data (theta in degrees) to cartesian"""
+    if int(theta) == theta:
+        ndx = int(theta) % table_size
+        return r*cos_list[ndx], r*sin_list[ndx]
+    theta_r = math.radians(theta)
+    return r*math.cos(theta_r), r*math.sin(theta_r)
+
+
+def polar_data_to_cart(polar_data):
+    """Convert a list of (heading, range) tuples, any heading"""
+    try:
+        return [(r*cos_list[theta % table_size], r*sin_list[theta % table_size]) for theta, r in polar_data]
+    except TypeError:
+        # float headings can not index the lists, take them one at a time
+        return [polar_to_cart(theta, r) for theta, r in polar_data]
+
+
+def polar_array_to_cart(headings, ranges):
+    """Return (x, y) arrays for arrays of whole degree headings and ranges"""
+    ndx = np.asarray(headings, dtype=int) % table_size
+    ranges = np.asarray(ranges, dtype=float)
+    return ranges*cos_table[ndx], ranges*sin_table[ndx]
@@ -1,5 +1,74 @@
 import socket
 import logging
+import collections
+import errno
+import fcntl
+import itertools
+import os
+import select
+import struct
+import threading
+from sensor_message import RobotMessage
+
+#
+#  Payloads too big for one datagram (like a full rotation) travel as
+#  fragments.   Each fragment starts with a small header:
+#    magic (1 byte), message id (2 bytes), fragment index (2 bytes), fragment count (2 bytes)
+#
+fragment_magic = 0xf7
+fragment_def = struct.Struct('<BHHH')
+max_fragment_payload = 1400
+
+# what a batched send or receive did
+BatchStats = collections.namedtuple('BatchStats', 'datagrams bytes drops')
+
+
+def fragment_payload(payload, message_id):
+        """Split a payload into datagrams that each fit in max_fragment_payload bytes"""
+        count = max(1, (len(payload) + max_fragment_payload - 1) // max_fragment_payload)
+        return [fragment_def.pack(fragment_magic, message_id & 0xffff, index, count) +
+                payload[index*max_fragment_payload:(index+1)*max_fragment_payload]
+                for index in range(count)]
+
+
+class Reassembler(object):
+        """
+        Put fragmented payloads back together.   Feed it every datagram
+        received; add() returns the payload once its last fragment is in.
+        Only max_pending partial payloads are kept; when a new one starts
+        beyond that, the oldest partial payload is dropped and counted.
+        """
+        def __init__(self, max_pending=8):
+                self.max_pending = max_pending
+                self.pending = collections.OrderedDict()
+                self.dropped = 0
+
+        def add(self, datagram, address=None):
+                """Return the complete payload, or None while fragments are still missing"""
+                if len(datagram) < fragment_def.size:
+                        return None
+                magic, message_id, index, count = fragment_def.unpack_from(datagram)
+                if magic != fragment_magic or index >= count:
+                        return None
+                if count == 1:
+                        return datagram[fragment_def.size:]
+
+                key = (address, message_id)
+                if key not in self.pending:
+                        if len(self.pending) >= self.max_pending:
+                                self.pending.popitem(last=False)
+                                self.dropped = self.dropped + 1
+                        self.pending[key] = [None] * count
+                fragments = self.pending[key]
+                if len(fragments) != count:
+                        return None
+                fragments[index] = datagram[fragment_def.size:]
+                if any(fragment is None for fragment in fragments):
+                        return None
+                del self.pending[key]
+                return b''.join(fragments)
+
+
 #
 #  Create the infra for two-way communication channel using UDP
 #  Set receive from timeout to .001 seconds to avoid blocking for
@@ -26,6 +95,9 @@ class UDPChannel:
                 self.remote_ip = remote_ip
                 self.remote_port = remote_port
 
+                # batched sends fan out to every destination (the remote, plus any added)
+                self.destinations = [(remote_ip, remote_port)]
+                self.message_ids = itertools.count()
 
                 # create the receive socket
                 self.receive_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
@@ -56,3 +128,204 @@ class UDPChannel:
                 self.receive_socket.settimeout(self.timeout_in_seconds)
                 return self.receive_socket.recvfrom(self.receive_buffer_size)
 
+        def add_destination(self, ip, port):
+                """Also send batches to (ip, port), like a driver station or a logger"""
+                self.destinations.append((ip, port))
+
+        def send_batch(self, messages, destinations=None):
+                """Send every message to every destination in one tight loop.  Return BatchStats."""
+                if destinations is None:
+                        destinations = self.destinations
+                datagrams = sent_bytes = drops = 0
+                sendto = self.send_socket.sendto
+                for address in destinations:
+                        for message in messages:
+                                try:
+                                        sendto(message, address)
+                                        datagrams = datagrams + 1
+                                        sent_bytes = sent_bytes + len(message)
+                                except IOError:
+                                        drops = drops + 1
+                if drops:
+                        UDPChannel.logger.error("Dropped {:d} datagrams in batch".format(drops))
+                return BatchStats(datagrams, sent_bytes, drops)
+
+        def send_fragmented(self, payload, destinations=None):
+                """Send a payload of any size as fragments.  Return BatchStats."""
+                return self.send_batch(fragment_payload(payload, next(self.message_ids)), destinations)
+
+        def receive_batch(self, max_count=64):
+                """
+                Return up to max_count waiting datagrams as (data, address) pairs,
+                without blocking, along with BatchStats for the batch.
+                """
+                datagrams = []
+                received_bytes = 0
+                self.receive_socket.settimeout(0.0)
+                while len(datagrams) < max_count:
+                        try:
+                                data, address = self.receive_socket.recvfrom(self.receive_buffer_size)
+                        except socket.error:
+                                break
+                        datagrams.append((data, address))
+                        received_bytes = received_bytes + len(data)
+                return datagrams, BatchStats(len(datagrams), received_bytes, 0)
+
+
+#
+#  Non-blocking flavor of the channel.   Python 2 has no asyncio, so a
+#  select() loop on its own thread plays the part of the event loop:
+#  sends are queued and flushed by the loop, and inbound robot messages
+#  are cracked and handed to callbacks registered by message name.
+#  The lidar loop never waits on the network.
+#
+class AsyncUDPChannel(UDPChannel):
+        """
+        channel = AsyncUDPChannel(remote_ip=robot_name, remote_port=5880)
+        channel.on_message('sweep', lambda message, address: ...)
+        channel.start()
+        channel.send_to(message)     # queued, returns right away
+        """
+        def __init__(self, max_queued=64, **kwargs):
+                """Create the channel.  At most max_queued sends wait; beyond that the oldest is dropped."""
+                UDPChannel.__init__(self, **kwargs)
+                self.receive_socket.setblocking(False)
+                self.send_socket.setblocking(False)
+
+                self.outbound = collections.deque(maxlen=max_queued)
+                self.handlers = {}
+                self.dropped_sends = 0
+                self.bad_messages = 0
+
+                # writing to the pipe wakes the loop up when there is something to send;
+                # neither end blocks, so a full pipe (the loop is already due to wake) is no wait
+                self.wakeup_read, self.wakeup_write = os.pipe()
+                for end in (self.wakeup_read, self.wakeup_write):
+                        fcntl.fcntl(end, fcntl.F_SETFL, fcntl.fcntl(end, fcntl.F_GETFL) | os.O_NONBLOCK)
+                self.running = threading.Event()
+                self.thread = threading.Thread(target=self.run, name='udp-channel')
+                self.thread.daemon = True
+
+        def start(self):
+                self.running.set()
+                self.thread.start()
+
+        def stop(self):
+                self.running.clear()
+                self.wakeup()
+                self.thread.join()
+
+        def wakeup(self):
+                """Nudge the loop.  A full pipe already has a wakeup waiting, so that is fine."""
+                try:
+                        os.write(self.wakeup_write, b'x')
+                except OSError as e:
+                        if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                                raise
+
+        def close(self):
+                """Stop the loop (if it is running) and release the sockets"""
+                if self.thread.is_alive():
+                        self.stop()
+                self.receive_socket.close()
+                self.send_socket.close()
+                os.close(self.wakeup_read)
+                os.close(self.wakeup_write)
+
+        def on_message(self, message_name, callback):
+                """Call callback(robot_message, address) for each inbound message with this name"""
+                self.handlers.setdefault(message_name, []).append(callback)
+
+        def send_to(self, message):
+                self.queue(message, (self.remote_ip, self.remote_port))
+
+        def reply_to(self, message, address):
+                self.queue(message, address)
+
+        def queue(self, message, address):
+                if len(self.outbound) == self.outbound.maxlen:
+                        self.dropped_sends = self.dropped_sends + 1
+                self.outbound.append((message, address))
+                self.wakeup()
+
+        def send_batch(self, messages, destinations=None):
+                """Queue every message for every destination with a single wakeup.  Return BatchStats."""
+                if destinations is None:
+                        destinations = self.destinations
+                dropped_before = self.dropped_sends
+                datagrams = queued_bytes = 0
+                for address in destinations:
+                        for message in messages:
+                                if len(self.outbound) == self.outbound.maxlen:
+                                        self.dropped_sends = self.dropped_sends + 1
+                                self.outbound.append((message, address))
+                                datagrams = datagrams + 1
+                                queued_bytes = queued_bytes + len(message)
+                self.wakeup()
+                return BatchStats(datagrams, queued_bytes, self.dropped_sends - dropped_before)
+
+        def run(self):
+                """
+                The event loop.  Runs on the channel thread until stopped.
+                Nothing that goes wrong in one pass ends the loop, or every
+                send after it would be silently dropped.
+                """
+                while self.running.is_set():
+                        try:
+                                writers = [self.send_socket] if self.outbound else []
+                                readable, writable, _ = select.select([self.receive_socket, self.wakeup_read],
+                                                                      writers, [], 1.0)
+                                if self.wakeup_read in readable:
+                                        self.drain_wakeups()
+                                if self.receive_socket in readable:
+                                        self.receive_all()
+                                if self.outbound:
+                                        self.flush()
+                        except Exception:
+                                UDPChannel.logger.exception("UDP channel loop failed, carrying on")
+
+        def drain_wakeups(self):
+                try:
+                        while os.read(self.wakeup_read, 4096):
+                                pass
+                except OSError as e:
+                        if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                                raise
+
+        def flush(self):
+                """Send queued messages until the socket would block"""
+                while self.outbound:
+                        message, address = self.outbound[0]
+                        try:
+                                self.send_socket.sendto(message, address)
+                        except socket.error as e:
+                                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                                        return
+                                UDPChannel.logger.error("Unable to send to: {}".format(address[0]))
+                        self.outbound.popleft()
+
+        def receive_all(self):
+                """Crack and dispatch every datagram that is waiting"""
+                while True:
+                        try:
+                                data, address = self.receive_socket.recvfrom(self.receive_buffer_size)
+                        except socket.error as e:
+                                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                                        return
+                                raise
+                        try:
+                                message = RobotMessage(data)
+                                message_name = message.contents.get('message')
+                        except (ValueError, IndexError, struct.error):
+                                self.bad_messages = self.bad_messages + 1
+                                UDPChannel.logger.error("Unreadable message from: {}".format(address[0]))
+                                continue
+                        except Exception:
+                                self.bad_messages = self.bad_messages + 1
+                                UDPChannel.logger.exception("Unreadable message from: {}".format(address[0]))
+                                continue
+                        for callback in self.handlers.get(message_name, []):
+                                try:
+                                        callback(message, address)
+                                except Exception:
+                                        UDPChannel.logger.exception("Handler failed for message from: {}".format(address[0]))
@@ -1,13 +1,42 @@
 from __future__ import print_function
 from laser import *
 import binascii
+import io
+import json
+import itertools
+import struct
+import threading
+import time
 import pdb
-from udp_channels import UDPChannel
+import pytest
+from udp_channels import UDPChannel, AsyncUDPChannel, BatchStats, Reassembler, fragment_def, fragment_payload
+from lidar_reader import RotationReader
+from lidar_logger import LidarLogger
+import serial_capture
+from serial_capture import CaptureSerial, ReplaySerial
+from rotation_log import RotationLog, RotationLogWriter, convert_snapshots
+from rotation_fusion import RotationFusion
+from deskew import Odometry, fit_slice_times, deskew_polar
+from latency import LatencyStats
+from pipeline import AnalysisPipeline, standard_pipeline
+import trig
+from deskew_benchmark import skewed_scan, fake_polar, range_error
 from field_model import FieldModel, Robot, FakeRotation
+from localizer import Localizer
+from localizer_benchmark import run_benchmark
+from pose_table import PoseTable, build_pose_table, no_hit
+from scan_matcher import ScanMatcher, PointGrid, ScanMotion
 from laser import *
-from analyzer import Analyzer, r_squared, find_wall
+from analyzer import Analyzer, HeadingIndex, r_squared, sliding_r_squared, find_wall, find_wall_midpoint, wall_segments
+from analyzer import closest_point_and_magnitude
 import math
 
+def packet_bytes(slice_index, payload="0040fe002200fc014400f803660077808800"):
+    """Raw lidar packet for the slice, with a correct checksum"""
+    data = bytearray(binascii.unhexlify("fa{:02x}{}0000".format(slice_index+Packet.index_offset, payload)))
+    data[20:22] = struct.pack('<H', Packet.compute_checksum(data))
+    return bytes(data)
+
 def test_reading():
     """unit test of the reading object to make sure it continues to work"""
     r1 = Reading(90, 2540, 0x2000)
@@ -36,6 +65,163 @@ def test_packet():
     assert p1.as_data() == "20,10.00\n21,20.00\n22,40.00\n23,777.00\n"
 
 
+def test_packet_checksum():
+    """Checksums are verified one packet at a time and in batches"""
+    good = packet_bytes(7)
+    assert Packet(good).checksum()
+    assert not Packet(binascii.unhexlify("fba50040fe002200fc014400f803660077808800abcd")).checksum()
+
+    corrupt = bytearray(good)
+    corrupt[9] ^= 0x10
+    assert not Packet.checksum_ok(corrupt)
+
+    data = b"".join([good, bytes(corrupt), packet_bytes(8, "1234" * 9)])
+    assert Packet.checksums_ok(data).tolist() == [True, False, True]
+
+    # the framer drops the corrupt packet and counts it
+    laser = Laser(io.BytesIO(data), streaming=True)
+    assert [p.index for p in itertools.islice(laser.packets(), 2)] == [7, 8]
+    assert laser.stats() == {'packets': 3, 'checksum_errors': 1}
+
+    # so does the slice at a time reader
+    laser = Laser(io.BytesIO(bytes(corrupt) + good))
+    assert laser.packet_for_slice(7).checksum()
+    assert laser.stats() == {'packets': 2, 'checksum_errors': 1}
+
+
+def test_packet_decode_batch():
+    """Batch decoding agrees with decoding packets one at a time"""
+    data = b"".join(binascii.unhexlify("fa{:02x}0040fe002200fc014400f803660077808800abcd".format(i+Packet.index_offset))
+                    for i in range(90))
+    batch = Packet.decode_batch(data + b"\xfa\xa0")
+    assert len(batch.index) == 90
+    assert batch.index.tolist() == list(range(90))
+    assert (batch.rpm == Packet(data[:22]).rpm).all()
+    assert batch.dist1[5] == Packet(data[110:132])[1].raw_distance
+    assert batch.strength3[5] == 0x88
+    assert batch.checksum[5] == 0xcdab
+    assert len(Packet.decode_batch(b"").index) == 0
+
+
+def test_streaming_framer():
+    """Packets are framed in arrival order, starting mid-rotation and after junk bytes"""
+    stream = b"\x01\xfa\x02\x03" + b"".join(packet_bytes(i) for i in range(45, 90))
+    stream = stream + b"".join(packet_bytes(i) for i in range(90))
+    laser = Laser(io.BytesIO(stream), streaming=True)
+
+    packets = laser.gather_full_rotation(reverse_data=False)
+    assert len(packets) == Packet.slices_in_rotation
+    assert [p.index for p in packets] == list(range(90))
+    assert str(packets[5]) == "5 256 10.00 20.00 40.00 777.00"
+
+    # the framer stopped as soon as the rotation was complete
+    assert next(laser.packets()).index == 45
+
+
+def test_rotation_reader():
+    """Reader thread keeps only the newest rotations when the consumer falls behind"""
+    rotation_bytes = b"".join(packet_bytes(i) for i in range(90))
+    reader = RotationReader(Laser(io.BytesIO(rotation_bytes * 5), streaming=True), capacity=2)
+    reader.start()
+
+    # the port runs dry after five rotations and the reader reports a read error
+    try:
+        deadline = time.time() + 5.0
+        while reader.stats()['errors'] == 0 and time.time() < deadline:
+            time.sleep(0.01)
+    finally:
+        reader.stop()
+        reader.join()
+
+    assert reader.stats()['read'] == 5
+    assert reader.stats()['dropped'] == 3
+    newest = [reader.get_rotation(), reader.get_rotation()]
+    assert newest[0].rpm() == 256
+    assert [r.sequence for r in newest] == [4, 5]
+    assert newest[0].timestamp <= newest[1].timestamp
+    try:
+        reader.get_rotation(timeout=0.01)
+        assert False, "Should have reported the read error, but did not."
+    except IOError:
+        pass
+
+
+def test_array_rotation():
+    """ArrayRotation reports the same data as Rotation for the same packets"""
+    packets = [Packet(binascii.unhexlify("fa{:02x}{:04x}fe002200fc014400{:04x}660077808800abcd".format(
+                i+Packet.index_offset, 0x4000+i, 0x03f8+i))) for i in range(90)]
+    rotation = Rotation(packets[::-1])
+    array_rotation = ArrayRotation(bytearray().join(p.raw for p in packets))
+
+    assert array_rotation.polar_data() == rotation.polar_data()
+    assert array_rotation[10] == rotation[10]
+    assert array_rotation.rpm() == Packet(packets[0].raw).rpm
+    assert ArrayRotation(packets).polar_data() == rotation.polar_data()
+    for (x1, y1), (x2, y2) in zip(array_rotation.cartesian_data(), rotation.cartesian_data()):
+        assert abs(x1-x2) < 1e-9 and abs(y1-y2) < 1e-9
+
+    # per heading arrays agree with the Reading objects
+    assert array_rotation.error.sum() == sum(1 for r in rotation.all_readings if r.error)
+    assert array_rotation.valid.sum() == sum(1 for r in rotation.all_readings if not r.discard)
+    assert [r.range_in_inches for r in rotation.all_readings] == array_rotation.range_in_inches.tolist()
+
+
+def test_rotation_log(tmpdir):
+    """Rotations survive a round trip through the binary log, and old snapshots convert"""
+    rotations = [ArrayRotation(b"".join(packet_bytes(i, "{:04x}fe00220000{:02x}4400f803660077808800".format(rpm, i)) for i in range(90)))
+                 for rpm in (0x4000, 0x4100, 0x4200)]
+    log_name = str(tmpdir.join("rotations.log"))
+    writer = RotationLogWriter(log_name)
+    for t, rotation in enumerate(rotations[:2]):
+        writer.append(rotation, timestamp=100.0 + t)
+    writer.close()
+
+    # appending to an existing log keeps what is already there
+    writer = RotationLogWriter(log_name)
+    writer.append(rotations[2], timestamp=102.0)
+    writer.close()
+
+    log = RotationLog(log_name)
+    assert len(log) == 3
+    assert log.find(101.0) == 1
+    for k, rotation in enumerate(rotations):
+        assert log[k]['rpm'] == rotation.rpm()
+        assert log.rotation(k).polar_data() == rotation.polar_data()
+        assert log.rotation(k).rpm() == rotation.rpm()
+
+    snapshot_name = str(tmpdir.join("lidar_snapshot_1.dat"))
+    LidarLogger.write_to_file(snapshot_name, rotations[0].polar_data())
+    converted_name = str(tmpdir.join("converted.log"))
+    convert_snapshots(converted_name, [snapshot_name])
+    converted = RotationLog(converted_name).rotation(0)
+    assert [h for h, _ in converted.polar_data()] == [h for h, _ in rotations[0].polar_data()]
+    assert all(abs(a - b) < 0.05 for (_, a), (_, b) in zip(converted.polar_data(), rotations[0].polar_data()))
+
+
+def test_serial_capture_and_replay(tmpdir):
+    """A captured stream replays into the same rotations, at full speed or on the recorded clock"""
+    stream = b"".join(packet_bytes(i) for i in range(90)) * 2
+    capture_name = str(tmpdir.join("lidar.cap"))
+    port = CaptureSerial(io.BytesIO(stream), capture_name)
+    captured = Laser(port, streaming=True).gather_raw_rotation()
+    port.close()
+
+    replayed = Laser(ReplaySerial(capture_name, speed=None), streaming=True).gather_raw_rotation()
+    assert replayed == captured
+    assert ArrayRotation(replayed).polar_data() == ArrayRotation(captured).polar_data()
+
+    # two chunks captured half a second apart take a twentieth of a second at 10x
+    with open(capture_name, 'wb') as f:
+        for timestamp, data in ((10.0, stream[:22]), (10.5, stream[22:44])):
+            f.write(serial_capture.chunk_def.pack(timestamp, len(data)) + data)
+    replay = ReplaySerial(capture_name, speed=10.0)
+    start = time.time()
+    assert replay.read(22) == stream[:22]
+    assert replay.read(22) == stream[22:44]
+    assert 0.04 < time.time() - start < 0.5
+    assert replay.read(22) == b""
+
+
 def test_udp_channel():
     """Create a simple two-way communication channel and make sure it sends and receives"""
     local  = UDPChannel()
@@ -60,6 +246,445 @@ def test_udp_channel():
     except:
         print("local.receive_from() timed out")
 
+def test_async_udp_channel():
+    """Sends are queued without blocking, and robot messages go to their callbacks"""
+    lidar = AsyncUDPChannel(local_port=5377, remote_port=5388)
+    robot = UDPChannel(local_port=5388, remote_port=5377, timeout_in_seconds=2.0)
+    sweeps = []
+    got_sweep = threading.Event()
+
+    def update_sweep(message, address):
+        sweeps.append((message.start, message.stop))
+        got_sweep.set()
+
+    lidar.on_message('sweep', update_sweep)
+    lidar.start()
+    try:
+        lidar.send_to("range at heading")
+        data, address = robot.receive_from()
+        assert data == "range at heading"
+
+        robot.send_to("not a message")
+        # JSON, but not an object: counted, and the loop keeps going
+        robot.send_to("42")
+        robot.send_to("[1, 2]")
+        robot.send_to(RobotMessage('{"sender": "robot", "message": "sweep", "start": -5, "stop": 6}').encode_message(BINARY))
+        assert got_sweep.wait(2.0)
+        assert sweeps == [(-5, 6)]
+        assert lidar.bad_messages == 3 and lidar.thread.is_alive()
+        lidar.send_to("still sending")
+        data, address = robot.receive_from()
+        assert data == "still sending"
+    finally:
+        lidar.close()
+        robot.receive_socket.close()
+        robot.send_socket.close()
+
+    with pytest.raises(ValueError):
+        RobotMessage("42")
+
+    # with no loop to drain the wakeup pipe, sends still never block
+    idle = AsyncUDPChannel(local_port=5377, remote_port=5388, max_queued=4)
+    try:
+        for _ in range(70000):
+            idle.send_to("range at heading")
+        assert len(idle.outbound) == 4 and idle.dropped_sends == 70000 - 4
+    finally:
+        idle.close()
+
+
+def test_batched_fragmented_udp():
+    """A full rotation fans out to every destination in fragments and is reassembled"""
+    lidar = UDPChannel(local_port=5399, remote_port=5411)
+    lidar.add_destination('127.0.0.1', 5412)
+    stations = [UDPChannel(local_port=port, remote_port=5399) for port in (5411, 5412)]
+    payload = bytes(bytearray(range(256))) * 20
+    try:
+        stats = lidar.send_fragmented(payload)
+        fragments = len(fragment_payload(payload, 0))
+        assert fragments == 4
+        assert stats == BatchStats(2 * fragments, 2 * (len(payload) + fragments * fragment_def.size), 0)
+
+        for station in stations:
+            time.sleep(0.05)
+            datagrams, received = station.receive_batch()
+            assert received.datagrams == fragments
+            reassembler = Reassembler()
+            complete = [reassembler.add(data, address) for data, address in reversed(datagrams)]
+            assert complete[:-1] == [None] * (fragments - 1)
+            assert complete[-1] == payload
+            assert station.receive_batch()[1].datagrams == 0
+    finally:
+        for channel in [lidar] + stations:
+            channel.receive_socket.close()
+            channel.send_socket.close()
+
+    reassembler = Reassembler(max_pending=1)
+    reassembler.add(fragment_payload(payload, 1)[0])
+    reassembler.add(fragment_payload(payload, 2)[0])
+    assert reassembler.dropped == 1
+
+
+def test_rotation_fusion():
+    """The ring keeps the last few rotations and fuses them heading by heading"""
+    def rotation(mm, error_headings=()):
+        distance = np.full(360, mm, dtype=np.uint16)
+        distance[list(error_headings)] |= Reading.error_mask
+        return ArrayRotation.from_arrays(distance, np.zeros(360, dtype=np.uint16),
+                                         np.ones(360, dtype=bool), 300)
+
+    fusion = RotationFusion(depth=3)
+    fusion.add(rotation(254, error_headings=[5]))
+    fusion.add(rotation(508))
+    fusion.add(rotation(1524, error_headings=[5, 6]))
+    fused = fusion.fused()
+    assert fused.count[0] == 3 and fused.count[5] == 1 and fused.count[6] == 2
+    assert fused.median[0] == 20 and fused.mean[0] == 30 and fused.min[0] == 10
+    assert fused.median[5] == 20 and fused.median[6] == 15
+
+    # a fourth rotation pushes out the first
+    fusion.add(rotation(508))
+    fused = fusion.fused()
+    assert len(fusion) == 3
+    assert fused.median[0] == 20 and fused.min[0] == 20 and abs(fused.mean[0] - 100.0/3) < 1e-9
+    assert fused.count[5] == 2
+
+    # Rotation and ArrayRotation fuse the same way
+    raw = bytearray().join(packet_bytes(i) for i in range(90))
+    by_packets = RotationFusion.rotation_ranges(Rotation([Packet(packet_bytes(i)) for i in range(90)]))
+    by_arrays = RotationFusion.rotation_ranges(ArrayRotation(raw))
+    assert np.array_equal(np.isnan(by_packets), np.isnan(by_arrays))
+    assert np.allclose(by_packets[~np.isnan(by_packets)], by_arrays[~np.isnan(by_arrays)])
+
+    headings, ranges = fusion.polar_array()
+    assert headings[0] == 270 and len(headings) == 181
+    fusion.clear()
+    assert fusion.polar_data() == []
+
+
+def test_deskew():
+    """Readings taken while the robot moves are corrected to where it ends up"""
+    # slices are stamped per read, ten at a time, starting mid-rotation
+    laser = Laser(io.BytesIO(b"".join(packet_bytes(i) for i in list(range(40, 90)) + list(range(40)))),
+                  streaming=True)
+    packets = laser.gather_full_rotation(reverse_data=False)
+    assert all(p.timestamp == laser.slice_times[p.index] for p in packets)
+    slice_times = np.repeat(np.arange(9) * 0.02, 10)
+    slice_times = np.roll(slice_times + 0.02, 40)
+    fitted = fit_slice_times(slice_times)
+    assert np.argmin(fitted) == 40 and np.argmax(fitted) == 39
+    assert np.allclose(np.diff(np.roll(fitted, -40)), 0.002, atol=1e-4)
+
+    # steady drive and turn over a rotation of the field model
+    field = FieldModel()
+    headings, ranges, times, end_robot = skewed_scan(field, Robot(), 120.0, 60.0)
+    truth_headings, truth_ranges = fake_polar(FakeRotation(field, end_robot))
+    corrected_headings, corrected_ranges = deskew_polar(headings, ranges, times, 0.0, 120.0, 60.0)
+    corrected_headings = np.rint(corrected_headings).astype(int) % 360
+    assert range_error(headings, ranges, truth_headings, truth_ranges) > 10
+    assert range_error(corrected_headings, corrected_ranges, truth_headings, truth_ranges) < 1
+
+    # the robot reports its motion, and old reports are ignored
+    odometry = Odometry()
+    assert odometry.motion() == (0.0, 0.0)
+    message = RobotOdometryMessage('{"sender": "robot", "message": "odometry", "speed": 60.0, "turn_rate": -30.0}')
+    odometry.update(RobotMessage(message.encode_message(BINARY, sequence=3)))
+    assert odometry.motion() == (60.0, -30.0)
+    assert odometry.motion(time.time() + 1.0) == (0.0, 0.0)
+
+
+def test_latency_instrumentation(tmpdir):
+    """Packet arrival times ride along with the rotation, and stage latencies roll"""
+    latency = LatencyStats(window=10)
+    for ms in range(1, 21):
+        latency.record('analyze', ms / 1000.0)
+    assert latency.percentiles('analyze')[0] == 0.0155
+    assert latency.milliseconds('analyze') == (16, 20, 20)
+    assert latency.percentiles('send') == (0.0, 0.0, 0.0)
+    with latency.timing('encode'):
+        time.sleep(0.01)
+    assert latency.percentiles('encode')[0] >= 0.01
+
+    reader = RotationReader(Laser(io.BytesIO(b"".join(packet_bytes(i) for i in range(90))), streaming=True),
+                            rotation_factory=ArrayRotation, raw=True, latency=latency)
+    reader.start()
+    try:
+        rotation = reader.get_rotation(timeout=2.0)
+    finally:
+        reader.stop()
+    assert rotation.first_packet_time <= rotation.last_packet_time <= rotation.timestamp
+    summary = latency.summary()
+    assert summary['read']['count'] >= 1 and summary['decode']['count'] >= 1
+    assert Rotation([Packet(packet_bytes(i), 100.0 + i) for i in range(90)]).last_packet_time == 189.0
+    assert ArrayRotation(b"".join(packet_bytes(i) for i in range(90))).last_packet_time is None
+
+    periodic = LidarPeriodicMessage()
+    periodic.latency_p50, periodic.latency_p95, periodic.latency_p99 = latency.milliseconds('analyze')
+    decoded = decode_messages(periodic.encode_binary())[0]
+    assert (decoded.latency_p50, decoded.latency_p95, decoded.latency_p99) == (16, 20, 20)
+
+    dump = tmpdir.join('latency.json')
+    latency.dump(str(dump))
+    assert json.loads(dump.read())['analyze'] == {'count': 20, 'p50': 15.5, 'p95': 19.55, 'p99': 19.91}
+
+
+def test_analysis_pipeline(tmpdir):
+    """Stages run in order, get profiled, and can be switched off or skipped when late"""
+    pipeline = AnalysisPipeline(budget=0.05)
+    pipeline.register('first', lambda rotation, results: rotation * 2, budget=0.001)
+    pipeline.register('slow', lambda rotation, results: time.sleep(0.03) or results['first'] + 1, budget=0.01)
+    pipeline.register('optional', lambda rotation, results: 'ran', budget=0.03, skip_over_budget=True)
+
+    results = pipeline.run(5)
+    assert list(results.items()) == [('first', 10), ('slow', 11), ('optional', None)]
+    stats = pipeline.stats()
+    assert stats['slow']['overruns'] == 1 and stats['slow']['p50'] >= 30
+    assert stats['optional']['skipped'] == 1 and stats['optional']['runs'] == 0
+
+    # the robot turns the slow stage off, and then there is time for the optional one
+    pipeline.update_from_robot(RobotMessage('{"sender": "robot", "message": "pipeline", '
+                                            '"stages": {"slow": {"enabled": false}}}'))
+    assert pipeline.run(5) == {'first': 10, 'slow': None, 'optional': 'ran'}
+
+    config = tmpdir.join('pipeline.json')
+    config.write('{"budget": null, "stages": {"slow": {"enabled": true}, "optional": {"enabled": false}}}')
+    pipeline.load_config(str(config))
+    assert pipeline.run(1) == {'first': 2, 'slow': 3, 'optional': None}
+    with pytest.raises(ValueError):
+        pipeline.configure({'stages': {'first': {'enabled': False}, 'missing': {'enabled': False}}})
+    assert pipeline.stages['first'].enabled
+    # values of the wrong kind are refused too, and nothing of the config is applied
+    for config in ({'budget': 0.15, 'stages': {'first': {'budget': '0.02'}}},
+                   {'stages': {'first': {'enabled': 'false'}}},
+                   {'budget': 0.01, 'stages': {'first': {'enabled': False, 'skip_over_budget': 1}}},
+                   {'budget': -1},
+                   {'stages': {'first': {'budget': True}}}):
+        with pytest.raises(ValueError):
+            pipeline.configure(config)
+        assert pipeline.budget is None and pipeline.stages['first'].enabled
+        assert pipeline.stages['first'].budget == 0.001
+    pipeline.update_from_robot(RobotMessage('{"sender": "robot", "message": "pipeline", '
+                                            '"budget": 0.15, "stages": {"first": {"budget": "0.02"}}}'))
+    assert pipeline.run(1) == {'first': 2, 'slow': 3, 'optional': None}
+
+    # a stage that raises gives None, is counted, and the stages after it still run
+    pipeline.register('broken', lambda rotation, results: 1 // 0)
+    pipeline.register('last', lambda rotation, results: 'ran')
+    results = pipeline.run(1)
+    assert results['broken'] is None and results['last'] == 'ran'
+    assert pipeline.stats()['broken']['failures'] == 1 and pipeline.stats()['last']['failures'] == 0
+
+    # the standard stages find the same range the analyzer does
+    field = FieldModel()
+    rotation = FakeRotation(field, Robot())
+    results = standard_pipeline().run(rotation)
+    assert results['range_at_heading'] == Analyzer.range_at_heading(rotation.polar_data(), (Analyzer.start, Analyzer.stop))
+    assert results['wall'] == find_wall_midpoint(rotation.cartesian_data())
+
+
+def test_trig_tables_and_cached_cartesian():
+    """Whole degree conversions come from the tables, and the cartesian view is built once"""
+    for theta in (-360, -91, -1, 0, 45, 271, 359):
+        assert trig.polar_to_cart(theta, 10.0) == (10.0*math.cos(math.radians(theta)), 10.0*math.sin(math.radians(theta)))
+    assert trig.polar_to_cart(725, 2.0) == trig.polar_to_cart(5, 2.0)
+    assert trig.polar_to_cart(0.5, 2.0) == (2.0*math.cos(math.radians(0.5)), 2.0*math.sin(math.radians(0.5)))
+    # any heading, whole or not, a robot that has turned round and round included
+    polar_data = [(725, 2.0), (-700, 3.0), (-1, 1.0)]
+    assert trig.polar_data_to_cart(polar_data) == [trig.polar_to_cart(theta, r) for theta, r in polar_data]
+    assert trig.polar_data_to_cart([(0.5, 2.0), (90.0, 1.0)]) == [trig.polar_to_cart(0.5, 2.0), trig.polar_to_cart(90.0, 1.0)]
+    spun = FakeRotation(FieldModel(), Robot((0, 0), 700)).cartesian_data()
+    assert np.allclose(spun, FakeRotation(FieldModel(), Robot((0, 0), -20)).cartesian_data())
+
+    packets = [Packet(packet_bytes(i)) for i in range(90)]
+    rotation = Rotation(packets)
+    cart_data = rotation.cartesian_data()
+    assert rotation.cartesian_data() is cart_data
+    assert cart_data == [(r*math.cos(math.radians(theta)), r*math.sin(math.radians(theta)))
+                         for theta, r in rotation.polar_data()]
+    assert ArrayRotation(packets).cartesian_data() == cart_data
+
+    # replacing the view data drops the cached cartesian view
+    rotation.view_data = rotation.view_data[:10]
+    assert len(rotation.cartesian_data()) == 10
+
+    array_rotation = ArrayRotation(packets)
+    before = array_rotation.cartesian_data()
+    array_rotation.raw_distance[:] = 254
+    assert array_rotation.cartesian_data() is before
+    array_rotation.invalidate()
+    assert array_rotation.cartesian_data()[0] == trig.polar_to_cart(270, 10.0)
+
+    fake = FakeRotation(FieldModel(), Robot())
+    assert fake.cartesian_data() is fake.cartesian_data()
+
+
+def test_fake_rotation_batch():
+    """Vectorized scans match ray by ray intersection with the segments, one pose or many"""
+    field = FieldModel()
+    robots = [Robot((0, 0), 0), Robot((12.5, -30), 33), Robot((-40, 60), -95.5), Robot((0, 100), 180)]
+    for robot, rotation in zip(robots, FakeRotation.for_robots(field, robots)):
+        # the closest segment along each whole degree heading, done the slow way
+        closest = {}
+        for heading in range(360):
+            angle = math.radians(heading + 90 - robot.heading)
+            ux, uy = math.cos(angle), math.sin(angle)
+            for (x0, y0), (x1, y1) in field.segments:
+                ex, ey = x1 - x0, y1 - y0
+                wx, wy = x0 - robot.position[0], y0 - robot.position[1]
+                denominator = ux*ey - uy*ex
+                if denominator == 0:
+                    continue
+                t = (wx*ey - wy*ex) / denominator
+                s = (wx*uy - wy*ux) / denominator
+                if t > 0 and 0 <= s <= 1:
+                    # label the heading the way the lidar sees the field
+                    field_angle = math.degrees(math.atan2(uy, ux))
+                    label = int(round(field_angle - 90 + robot.heading))
+                    closest[label] = min(closest.get(label, t), t)
+        expected = sorted(closest.items(), reverse=True)
+        for view_data in (rotation.polar_data(), FakeRotation(field, robot).polar_data()):
+            assert [heading for heading, _ in view_data] == [heading for heading, _ in expected]
+            assert np.allclose([distance for _, distance in view_data], [distance for _, distance in expected])
+    assert FakeRotation.for_robots(field, []) == []
+
+    # the field is a handful of segments, and a scan sees them exactly
+    assert len(field.segments) == 9
+    heading, distance = Analyzer.range_at_heading(FakeRotation(field, Robot((30, 0), 0)).polar_data(), (-1, 1))
+    assert distance == 144.0
+
+
+def test_localizer(monkeypatch):
+    """A stale seed pose is pulled back to the true pose, and a short budget stops the refining"""
+    field = FieldModel()
+    robot = Robot((20.0, 35.0), 12.0)
+    rotation = FakeRotation(field, robot, rpm=300)
+    localizer = Localizer(field, Robot((26.0, 30.0), 16.0))
+    pose = localizer.localize(rotation)
+    assert math.hypot(pose.x - 20.0, pose.y - 35.0) < 0.5
+    assert abs(pose.heading - 12.0) < 0.5
+    assert pose.error < 0.5 and localizer.pose.position == (pose.x, pose.y)
+    assert localizer.stats()['levels'] == len(Localizer.levels)
+
+    # with no time to spare only the coarse level runs
+    localizer.reset(Robot((26.0, 30.0), 16.0))
+    localizer.localize(rotation, budget=0.0)
+    assert localizer.stats()['budget_stops'] == 1 and localizer.stats()['levels'] == len(Localizer.levels) + 1
+
+    # the pose goes to the robot as a message, and the pipeline can run the search
+    pose_message = LidarPoseMessage()
+    pose_message.x, pose_message.y, pose_message.heading, pose_message.error = 20.0, 35.0, 12.0, 0.25
+    decoded = decode_messages(pose_message.encode_binary())[0]
+    assert (decoded.status, decoded.x, decoded.y, decoded.heading, decoded.error) == ('ok', 20.0, 35.0, 12.0, 0.25)
+    localizer.reset(Robot((22.0, 33.0), 10.0))
+    results = standard_pipeline(localizer=localizer).run(rotation)
+    assert math.hypot(results['localize'].x - 20.0, results['localize'].y - 35.0) < 0.5
+
+    # the search keeps to the stage's budget, whatever it is configured to
+    pipeline = standard_pipeline(localizer=localizer)
+    pipeline.configure({'stages': {'localize': {'budget': 0.0}}})
+    stops = localizer.stats()['budget_stops']
+    pipeline.run(rotation)
+    assert localizer.stats()['budget_stops'] == stops + 1
+
+    # a lost match with no table keeps searching from the last good pose
+    localizer = Localizer(field, Robot((20.0, 35.0), 12.0))
+    good = localizer.pose
+    lost = localizer.localize(FakeRotation(field, Robot((60.0, 80.0), 40.0), rpm=300))
+    assert lost.error > Localizer.lost_error and localizer.tracking and localizer.pose is good
+    pose = localizer.localize(rotation)
+    assert math.hypot(pose.x - 20.0, pose.y - 35.0) < 0.5 and localizer.stats()['lost'] == 1
+
+    # rotations with no pose count as failures in the benchmark
+    assert run_benchmark(count=3)[4] == 0
+    monkeypatch.setattr(Localizer, 'localize', lambda self, rotation, budget=None: None)
+    position_error, _, close, _, failures = run_benchmark(count=3)
+    assert failures == 3 and close == 0 and np.isnan(position_error)
+
+
+def test_pose_table(tmpdir):
+    """The table finds the grid poses closest to the robot, and gets a lost localizer going"""
+    field = FieldModel()
+    table = build_pose_table(field, np.arange(-48, 49, 12), np.arange(0, 97, 12), np.arange(-90, 90, 10))
+    assert len(table) == 9 * 9 * 18 and table.table['ranges'].dtype == np.uint16
+    # the heading 0 scan from the origin sees the tower face straight ahead, and nothing behind
+    row = np.flatnonzero((table.table['x'] == 0) & (table.table['y'] == 0) & (table.table['heading'] == 0))[0]
+    assert table.table['ranges'][row, 0] == round(field.tower_range_from_origin() * 10)
+    assert table.table['ranges'][row, 180] == no_hit
+
+    file_name = str(tmpdir.join('pose_table.npy'))
+    table.save(file_name)
+    table = PoseTable.load(file_name)
+    assert isinstance(table.table, np.memmap)
+
+    robot = Robot((36.0, 60.0), -30.0)
+    rotation = FakeRotation(field, robot)
+    poses = table.best_poses(rotation, k=3)
+    assert len(poses) == 3 and poses[0].error <= poses[1].error <= poses[2].error
+    assert (poses[0].x, poses[0].y, poses[0].heading) == (36.0, 60.0, -30.0) and poses[0].error == pytest.approx(0, abs=0.05)
+
+    # without a seed the localizer starts from the table, then tracks from its own pose
+    localizer = Localizer(field, table=table)
+    pose = localizer.localize(FakeRotation(field, Robot((40.0, 55.0), -24.0)))
+    assert math.hypot(pose.x - 40.0, pose.y - 55.0) < 0.5 and abs(pose.heading + 24.0) < 0.5
+    localizer.localize(FakeRotation(field, Robot((41.0, 56.0), -25.0)))
+    assert localizer.stats()['warm_starts'] == 1 and localizer.tracking
+
+
+def test_scan_matcher():
+    """Consecutive rotations give back how far the robot drove and turned"""
+    grid = PointGrid([(0.0, 0.0), (5.0, 5.0), (5.5, 5.0), (40.0, -3.0)], 6.0)
+    index, distance = grid.nearest([(5.4, 4.0), (39.0, -3.0), (20.0, 20.0)])
+    assert index.tolist() == [2, 3, -1]
+    assert distance[0] == pytest.approx(math.hypot(0.1, 1.0)) and distance[2] == np.inf
+
+    field = FieldModel()
+    robot = Robot((10.0, 20.0), 5.0)
+    matcher = ScanMatcher(budget=1.0)
+    assert matcher.update(FakeRotation(field, robot, rpm=300)) is None
+    start = Robot(robot.position, robot.heading)
+    robot.turn(-1.5)
+    robot.move(6.0)
+    robot.turn(-1.5)
+    motion = matcher.update(FakeRotation(field, robot, rpm=300))
+    heading = math.radians(start.heading)
+    dx, dy = robot.position[0] - start.position[0], robot.position[1] - start.position[1]
+    assert motion.forward == pytest.approx(dx*math.sin(heading) + dy*math.cos(heading), abs=0.2)
+    assert motion.left == pytest.approx(dy*math.sin(heading) - dx*math.cos(heading), abs=0.3)
+    assert motion.turn == pytest.approx(-3.0, abs=0.05)
+    assert motion.converged and motion.interval == 0.2
+    assert matcher.stats()['iterations'] == motion.iterations <= ScanMatcher.max_iterations
+
+    # at the rotation rate it goes to the robot like the robot's own odometry
+    odometry_message = LidarOdometryMessage()
+    odometry_message.fill(motion)
+    decoded = decode_messages(odometry_message.encode_binary())[0]
+    assert decoded.status == 'ok' and decoded.speed == pytest.approx(motion.forward / 0.2, rel=1e-6)
+    assert decoded.turn_rate == pytest.approx(-15.0, abs=0.3)
+    odometry_message.fill(None)
+    assert odometry_message.status == 'error'
+    assert (odometry_message.speed, odometry_message.turn_rate) == (0, 0)
+    assert (odometry_message.forward, odometry_message.left, odometry_message.turn) == (0, 0, 0)
+
+    # out of time after the first iteration
+    matcher = ScanMatcher(budget=0.0)
+    matcher.update(FakeRotation(field, start, rpm=300))
+    motion = matcher.update(FakeRotation(field, robot, rpm=300))
+    assert motion.iterations == 1 and not motion.converged and matcher.stats()['budget_stops'] == 1
+
+    # a blocked lidar (every reading in error) is a failed match, not a crash, and the next
+    # good rotation becomes the reference
+    blocked = ArrayRotation.from_arrays(np.full(360, Reading.error_mask | 254, dtype=np.uint16),
+                                        np.zeros(360, dtype=np.uint16), np.ones(360, dtype=bool), 300)
+    matcher = ScanMatcher(budget=1.0)
+    assert matcher.update(blocked) is None
+    assert matcher.update(FakeRotation(field, start, rpm=300)) is None
+    assert matcher.stats()['failures'] == 1 and len(matcher.reference) > ScanMatcher.min_pairs
+    assert matcher.update(FakeRotation(field, robot, rpm=300)).turn == pytest.approx(-3.0, abs=0.05)
+    pipeline = standard_pipeline(matcher=ScanMatcher(budget=1.0))
+    for rotation in (FakeRotation(field, start, rpm=300), blocked, FakeRotation(field, robot, rpm=300)):
+        assert pipeline.run(rotation)['scan_match'] is None
+
+
 def test_analzyer_on_field_model():
     """
     Create a model of the field, then ask the laser to compute
@@ -85,6 +710,26 @@ def test_analzyer_on_field_model():
     assert sweep_range == (tower_range - movement)
 
 
+def test_heading_index():
+    """Heading indexed sweeps agree with the list scan, and can wrap around zero"""
+    field = FieldModel()
+    rotation = FakeRotation(field, Robot())
+    index = HeadingIndex(rotation.polar_data())
+
+    assert index.range_at_heading((-10, 11)) == Analyzer.range_at_heading(rotation.polar_data(), (-10, 11))
+    assert index.range_at_heading((350, 11)) == (0, field.tower_range_from_origin())
+    assert index.range_at_heading((20, 20)) == (0, 0)
+
+    polar_data = [(355, 50.0), (5, 40.0), (90, 30.0)]
+    index = HeadingIndex(polar_data)
+    sweeps = [(350, 10), (-10, 0), (0, 360), (100, 200), (89, 91)]
+    assert index.ranges_at_headings(sweeps) == [(5, 40.0), (-5, 50.0), (90, 30.0), (0, 0), (90, 30.0)]
+    assert index.ranges_at_headings(sweeps) == [index.range_at_heading(s) for s in sweeps]
+
+    headings, ranges = zip(*polar_data)
+    assert HeadingIndex.from_arrays(headings, ranges).ranges_at_headings(sweeps) == index.ranges_at_headings(sweeps)
+
+
 def test_sensor_messages():
     sm1 = SensorMessage(sender='foobar', message='hi')
     sm2 = SensorMessage(sender='tester', message='howdy')
@@ -114,6 +759,85 @@ def test_sensor_messages():
     assert lrah1.encode_message() == lrah2.encode_message()
     
 
+def test_binary_sensor_messages():
+    """Binary messages round trip, many to a buffer, with JSON still the default"""
+    range_at_heading = LidarRangeAtHeadingMessage()
+    range_at_heading.heading = -7
+    range_at_heading.range = 42.5
+    periodic = LidarPeriodicMessage()
+    periodic.rpm = 300
+    periodic.status = 'down'
+    wall = LidarWallMessage()
+    wall.heading, wall.range, wall.orientation = 12.5, 100.25, -30.0
+
+    assert json.loads(periodic.encode_message())['rpm'] == 300
+
+    buffer = range_at_heading.encode_binary() + periodic.encode_binary() + wall.encode_binary()
+    assert len(buffer) == 3*7 + 6 + 9 + 13
+    decoded = decode_messages(buffer)
+    assert [type(m) for m in decoded] == [LidarRangeAtHeadingMessage, LidarPeriodicMessage, LidarWallMessage]
+    assert (decoded[0].heading, decoded[0].range) == (-7, 42.5)
+    assert (decoded[1].rpm, decoded[1].status) == (300, 'down')
+    assert (decoded[2].status, decoded[2].heading, decoded[2].range, decoded[2].orientation) == ('ok', 12.5, 100.25, -30.0)
+    assert decoded[0].sequence < decoded[1].sequence < decoded[2].sequence
+
+    # the robot negotiates the format, and its own messages can be binary too
+    negotiate_wire_format(RobotMessage(json.dumps({'sender': 'robot', 'message': 'format', 'format': 'binary'})))
+    try:
+        assert type(decode_messages(periodic.encode_message())[0]) == LidarPeriodicMessage
+    finally:
+        negotiate_wire_format(RobotMessage('{"sender": "robot", "message": "format", "format": "json"}'))
+    assert periodic.encode_message().startswith('{')
+
+    sweep = RobotMessage('{"sender": "robot", "message": "sweep", "start": -20, "stop": 21}')
+    from_robot = RobotMessage(sweep.encode_message(BINARY, sequence=9))
+    assert (from_robot.sender, from_robot.message, from_robot.start, from_robot['stop']) == ('robot', 'sweep', -20, 21)
+    assert from_robot.sequence == 9
+
+
+def test_rotation_result_message():
+    """One rotation result carries every analysis output, in JSON or binary"""
+    range_at_heading = LidarRangeAtHeadingMessage()
+    range_at_heading.heading, range_at_heading.range = 3, 120.5
+    periodic = LidarPeriodicMessage()
+    periodic.rpm = 298
+    wall = LidarWallMessage()
+    wall.heading, wall.range, wall.orientation = -4.5, 130.0, 12.0
+
+    result = LidarRotationResultMessage()
+    result.collect(17, 1234.5, range_at_heading, periodic, wall)
+    contents = json.loads(result.encode_message())
+    assert (contents['rotation'], contents['timestamp'], contents['rpm']) == (17, 1234.5, 298)
+    assert (contents['heading'], contents['range'], contents['wall_range']) == (3, 120.5, 130.0)
+
+    result.collect(18, 1234.7, range_at_heading, periodic)
+    decoded = decode_messages(result.encode_binary())[0]
+    assert (decoded.rotation, decoded.timestamp, decoded.status, decoded.wall_status) == (18, 1234.7, 'ok', 'off')
+    assert (decoded.heading, decoded.range, decoded.pose_status) == (3, 120.5, 'off')
+
+    # the pose rides in the same frame
+    pose = LidarPoseMessage()
+    pose.x, pose.y, pose.heading, pose.error = 20.0, 35.5, -12.25, 0.5
+    result.collect(19, 1234.9, range_at_heading, periodic, wall, pose)
+    contents = json.loads(result.encode_message())
+    assert (contents['pose_status'], contents['pose_x'], contents['pose_y']) == ('ok', 20.0, 35.5)
+    decoded = decode_messages(result.encode_binary())[0]
+    assert (decoded.pose_status, decoded.pose_x, decoded.pose_y, decoded.pose_heading, decoded.pose_error) == \
+        ('ok', 20.0, 35.5, -12.25, 0.5)
+
+    # and so does the odometry, 'off' when there was no motion this rotation
+    assert decoded.odometry_status == 'off'
+    odometry = LidarOdometryMessage()
+    odometry.fill(ScanMotion(2.0, -0.5, 1.5, 0.2, 4, True))
+    result.collect(20, 1235.1, range_at_heading, periodic, wall, pose, odometry)
+    decoded = decode_messages(result.encode_binary())[0]
+    assert (decoded.odometry_status, decoded.speed, decoded.turn_rate) == ('ok', 10.0, 7.5)
+    assert (decoded.forward, decoded.left, decoded.turn) == (2.0, -0.5, 1.5)
+    result.collect(21, 1235.3, range_at_heading, periodic, wall, pose)
+    contents = json.loads(result.encode_message())
+    assert (contents['odometry_status'], contents['speed'], contents['forward']) == ('off', 0, 0)
+
+
 def test_r_squared():
     #  simple 45 degree line
     data = [(1,1), (2,2), (3,3), (4,4)]
@@ -128,14 +852,17 @@ def test_r_squared():
     #  horizontal line
     data = [(1,5), (2,5), (3,5), (4,5)]
     r2 = r_squared(data)
-    #print r2
-    #assert round(1000*r2) == 1000
+    assert round(1000*r2) == 1000
 
     #  vertical line
     data = [(5,1), (5,2), (5,3), (5,4)]
     r2 = r_squared(data)
-    #print r2
-    #assert r2 == 0
+    assert round(1000*r2) == 1000
+
+    #  not a line at all
+    data = [(5,1), (5,1), (5,1), (5,1)]
+    r2 = r_squared(data)
+    assert r2 == 0
 
 
     #  more interesting line
@@ -154,6 +881,23 @@ def test_r_squared():
         print("{:.2f}".format(r2),end=" => ")
         print(slice)
 
+def test_sliding_r_squared():
+    """All the sliding windows at once agree with one window at a time"""
+    cart_data = FakeRotation(FieldModel(), Robot((10, 20), 15)).cartesian_data()
+    for window in (4, 7):
+        r2 = sliding_r_squared(cart_data, window)
+        assert len(r2) == len(cart_data) - window + 1
+        expected = [r_squared(cart_data[i:i+window]) for i in range(len(r2))]
+        assert max(abs(a - b) for a, b in zip(r2, expected)) < 1e-6
+
+    # degenerate lines, far from the origin so the prefix sums are big
+    data = [(x, 150.1) for x in range(200)] + [(150.1, y) for y in range(200)] + [(3.3, 4.4)]*4
+    r2 = sliding_r_squared(data, 4)
+    assert (r2[:197] == 1.0).all()
+    assert (r2[200:397] == 1.0).all()
+    assert r2[-1] == 0.0
+    assert len(sliding_r_squared(data[:3], 4)) == 0
+
 def test_find_wall ():
     """quick sanity check to make sure that things run"""
     f = FieldModel()
@@ -170,9 +914,45 @@ def test_find_wall ():
     # Should add this function with some nicely colored output
     # into the field.py simulation.
     #
-    assert round(wall_magnitude,1) == 153.7
-    assert round(x,1) == 140.5
-    assert round(y,1) == 22.3
+    assert round(wall_magnitude,1) == 155.5
+    assert round(x,1) == 141.2
+    assert round(y,1) == 22.4
     
         
 
+
+def test_find_wall_noisy_scans():
+    """On noisy scans the wall is the one the old search, growing a run from every start, finds"""
+    def reference_find_wall(array):
+        best = None
+        for i in range(len(array)-3):
+            d = i+4
+            while not (r_squared(array[i:d]) < Analyzer.r2_min or d >= len(array)-1):
+                d = d+1
+            found = closest_point_and_magnitude(array[i:d])
+            if best is None or found[0] > best[0]:
+                best = found
+        return best
+
+    generator = np.random.RandomState(3)
+    field = FieldModel()
+    for _ in range(40):
+        robot = Robot((generator.uniform(-60, 60), generator.uniform(0, 80)), generator.uniform(-45, 45))
+        cart_data = np.array(FakeRotation(field, robot).cartesian_data())
+        cart_data = [tuple(point) for point in (cart_data + generator.normal(0, 0.3, cart_data.shape)).tolist()]
+        assert find_wall(cart_data) == reference_find_wall(cart_data)
+
+
+def test_find_wall_long_straight_wall():
+    """A long straight wall is one segment, and does not blow the recursion limit"""
+    wall = [(x/2.0, 0.25*x + 100) for x in range(-300, 300)]
+    # every start runs to the end of the wall
+    assert wall_segments(wall) == [(i, max(i+4, len(wall)-1)) for i in range(len(wall)-3)]
+
+    (wall_magnitude, point) = find_wall(wall)
+    assert round(wall_magnitude) == round(math.hypot(wall[-2][0]-wall[0][0], wall[-2][1]-wall[0][1]))
+
+    # the wall rises one inch for every two across
+    (heading, distance, orientation) = find_wall_midpoint(wall)
+    assert round(orientation, 1) == -153.4
+